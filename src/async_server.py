@@ -0,0 +1,105 @@
+import asyncio
+
+import metrics
+from ecmath import random_scalar
+from protocol import AsyncConnection, ProtocolError
+from server import Server
+
+
+# Server engine running all connections in one asyncio event loop. Group chat logic is shared with Server
+class AsyncServer(Server):
+    # Zero-Knowledge Key-Statement Proof
+    async def verify_client_key_async(self, client_socket, public_key, commitment):
+        challenge = random_scalar(self.curve)
+        client_socket.send({
+            'status': 'challenge',
+            'challenge': challenge,
+        })
+
+        request = await client_socket.recv()
+        if request is None or request.get('action') != 'prove' or public_key is None:
+            return False
+        with metrics.registry.timer('auth_verify_seconds'):
+            if self.authenticator is not None:
+                # Batch is checked in authenticator thread, event loop keeps serving other connections
+                return await asyncio.wrap_future(
+                    self.authenticator.submit(public_key, commitment, challenge, request['zkksp_response']))
+            return self.check_zkksp(self.curve, public_key, commitment, challenge, request['zkksp_response'])
+
+    # Regions hold no awaits, so samples of event loop thread belong to this connection. Next batch of stored
+    # messages is queued when previous ones are written
+    async def join_group_async(self, client_socket, username, group_name) -> bool:
+        with metrics.region('handle_client'):
+            joining = self.start_join(client_socket, username, group_name)
+        if joining is None:
+            return False
+        while True:
+            with metrics.region('handle_client'):
+                if not next(joining, False):
+                    return True
+            await client_socket.drain()
+
+    async def handle_client(self, reader, writer):
+        client_socket = AsyncConnection(reader, writer, self.queue_limit, self.slow_consumer)
+        print(f"[INFO] Connection from {client_socket.getpeername()}")
+        try:
+            await client_socket.server_handshake(self.codecs, self.curve)
+        except (ConnectionResetError, ProtocolError) as e:
+            print(f"[WARNING] Handshake failed: {e}")
+            client_socket.close()
+            return
+
+        try:
+            await self.serve_requests_async(client_socket)
+        finally:  # Session is cleaned up whatever ends the loop
+            self.disconnect_client(client_socket)
+
+    async def serve_requests_async(self, client_socket):
+        while True:
+            try:
+                request = await client_socket.recv()
+                if request is None:
+                    break
+
+                action = request['action']
+
+                if action == 'authentication':
+                    if self.active_sessions.get_username(client_socket) is not None:
+                        print(f"[WARNING] User '{self.active_sessions.get_username(client_socket)}' sent second "
+                              f"authentication request. Terminating connection.")
+                        break
+                    username = request['username']
+                    group_name = request['group_name']
+                    commitment = request['commitment']
+
+                    # Verify that user has private key (ZKKSP)
+                    public_key = self.database.get_public_key(username)
+                    if await self.verify_client_key_async(client_socket, public_key, commitment):
+                        metrics.registry.inc('auth_total', result='ok')
+                        print(f"[INFO] User {client_socket.getpeername()} authenticated as '{username}'.")
+                    else:
+                        metrics.registry.inc('auth_total', result='fail')
+                        print(f"[WARNING] User '{client_socket.getpeername()}' authentication as '{username}' FAIL.")
+                        client_socket.send({'status': 'denied', 'reason': "Authentication fail."})
+                        break
+
+                    if not await self.join_group_async(client_socket, username, group_name):
+                        break
+
+                else:
+                    with metrics.region('handle_client'):
+                        if not self.handle_request(client_socket, request):
+                            break
+
+            except (ConnectionResetError, ProtocolError):
+                break
+
+    async def serve(self):
+        self.presence.call = asyncio.get_running_loop().call_soon_threadsafe
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=self.backlog)
+        print(f"[INFO] Server started on {self.host}:{self.port} (asyncio, curve {self.curve.name})")
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
@@ -0,0 +1,142 @@
+"""
+Batched ZKKSP verification. Proofs from many connections are collected over a short window and checked
+with one random linear combination, on failure the batch is split to find bad proofs (as in unsigncryption_batch).
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from ecpy.curves import Curve
+
+from ecmath import decode_point, encode_point
+from signcryption import peer_keys, _find_bad
+
+AUTH_BATCH_WINDOW = 0.005  # Seconds to wait for more proofs after the first one
+AUTH_BATCH_SIZE = 64  # Max proofs in one batch
+AUTH_REPORT_INTERVAL = 10  # Seconds between login rate reports
+
+
+# ZKKSP response is a scalar below curve order, anything else (e.g. float from JSON client) fails the proof
+def valid_response(curve: Curve, zkksp_response) -> bool:
+    return type(zkksp_response) is int and 0 <= zkksp_response < curve.order
+
+
+class AuthBatcher:
+    def __init__(self, curve: Curve, window: float = AUTH_BATCH_WINDOW, max_size: int = AUTH_BATCH_SIZE,
+                 report_interval: float = AUTH_REPORT_INTERVAL):
+        self.curve = curve
+        self.window = window
+        self.max_size = max_size
+        self.report_interval = report_interval
+        self.pending = queue.Queue()  # (check, future)
+
+        # Stats since last report
+        self.verified = 0
+        self.batches = 0
+        self.busy_time = 0.0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Returns future with result of check z * G == C + c * P
+    def submit(self, public_key, commitment, challenge: int, zkksp_response: int) -> Future:
+        future = Future()
+        if not valid_response(self.curve, zkksp_response):
+            future.set_result(False)
+            return future
+        try:
+            public_key = peer_keys.get(self.curve, public_key)
+            commitment = decode_point(self.curve, commitment)
+        except (ValueError, TypeError):  # Not a point of curve or not an encoded point at all
+            future.set_result(False)
+            return future
+        # Same form as signature check s * G + R - t * P with R = -C
+        self.pending.put(((zkksp_response, -commitment, challenge, public_key), future))
+        return future
+
+    def verify(self, public_key, commitment, challenge: int, zkksp_response: int) -> bool:
+        return self.submit(public_key, commitment, challenge, zkksp_response).result()
+
+    def collect(self) -> list:
+        batch = [self.pending.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self.pending.get(timeout=timeout) if timeout > 0 else self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        last_report = time.perf_counter()
+        while True:
+            batch = self.collect()
+            start = time.perf_counter()
+            checks = [check for check, _ in batch]
+            bad = self.find_bad(checks)
+            for i, (_, future) in enumerate(batch):
+                future.set_result(i not in bad)
+
+            now = time.perf_counter()
+            self.verified += len(batch)
+            self.batches += 1
+            self.busy_time += now - start
+            if now - last_report >= self.report_interval:
+                self.report(now - last_report)
+                last_report = now
+
+    # Indexes of failed checks. Error in batch check falls back to checking every proof alone, an error there fails
+    # the proof: waiting handlers always get a result and the thread survives
+    def find_bad(self, checks: list) -> set:
+        try:
+            return set(_find_bad(self.curve, checks, list(range(len(checks)))))
+        except Exception as e:
+            print(f"[ERROR] ZKKSP batch check failed: {e!r}")
+        bad = set()
+        for i in range(len(checks)):
+            try:
+                bad.update(_find_bad(self.curve, checks, [i]))
+            except Exception:
+                bad.add(i)
+        return bad
+
+    # Logins in the interval and rate the verifier sustains (proofs per second of verification time)
+    def report(self, interval: float):
+        print(f"[INFO] Authentication: {self.verified} logins in {interval:.0f} s, "
+              f"{self.verified / self.batches:.1f} per batch, "
+              f"{self.verified / self.busy_time:.0f} logins/sec sustained")
+        self.verified = self.batches = 0
+        self.busy_time = 0.0
+
+
+def main():
+    # Verification throughput: every proof alone vs batches
+    import random
+    from constants import CURVE
+    from ecmath import mul_generator
+    from server import Server
+    from signcryption import gen_keys
+
+    n = 256
+    proofs = []
+    for _ in range(n):
+        private_key, public_key = gen_keys(CURVE)
+        r, challenge = random.randint(1, CURVE.order - 1), random.randint(1, CURVE.order - 1)
+        commitment = encode_point(CURVE, mul_generator(CURVE, r))
+        proofs.append((public_key, commitment, challenge, (r + challenge * private_key) % CURVE.order))
+
+    start = time.perf_counter()
+    assert all(Server.check_zkksp(CURVE, *proof) for proof in proofs)
+    single = n / (time.perf_counter() - start)
+    print(f"single checks: {single:.0f} logins/sec")
+    for size in (8, 32, 64):
+        batcher = AuthBatcher(CURVE, window=1.0, max_size=size, report_interval=float('inf'))
+        start = time.perf_counter()
+        futures = [batcher.submit(*proof) for proof in proofs]
+        assert all(future.result() for future in futures)
+        rate = n / (time.perf_counter() - start)
+        print(f"batches of {size}: {rate:.0f} logins/sec ({rate / single:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""
+Load-generation and latency benchmark for the whole client/server stack.
+
+Starts server.py in a subprocess with a generated database, then drives headless clients from this process:
+authentication rate, end-to-end message latency percentiles and relay throughput for every combination
+of group size and message size. Results are printed (or written) as JSON.
+--import-time measures startup instead: import time of client/server modules in fresh interpreters.
+--curves measures signcryption and ZKKSP latency on every suitable curve, without server.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ecpy.curves import Curve
+
+from client import ChatClient
+from constants import CURVE
+from ecmath import curve_by_name, is_supported, generator_table, mul_generator, encode_point, random_scalar
+from protocol import CODEC_NAMES
+from signcryption import gen_keys, signcryption, unsigncryption
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+IMPORT_TIME_MODULES = ['client', 'server']
+
+
+class BenchClient(ChatClient):
+    # Headless client recording arrival time of every delivered message
+
+    def __init__(self, host: str, port: int, username: str, group_name: str, private_key: int, codec: int,
+                 decrypt: bool, fanout: str, curve: Curve = CURVE):
+        super().__init__(username, group_name, private_key, fanout=fanout, on_message=self.record_arrival,
+                         curve=curve)
+        self.decrypt = decrypt
+        self.connect(host, port, (codec,))
+
+        self.lock = threading.Condition()
+        self.arrivals = []  # perf_counter() of every delivered message
+
+    def unsigncrypt(self, response: dict):
+        return super().unsigncrypt(response) if self.decrypt else ''
+
+    def record_arrival(self, sender, msg):
+        if msg is None:
+            raise RuntimeError(f"'{self.username}' got malicious message from '{sender}'")
+        with self.lock:
+            self.arrivals.append(time.perf_counter())
+            self.lock.notify_all()
+
+    def wait_arrivals(self, count: int, timeout: float) -> bool:
+        with self.lock:
+            return self.lock.wait_for(lambda: len(self.arrivals) >= count, timeout)
+
+
+def percentile(sorted_values, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def generate_database(path: str, group_sizes, curve: Curve = CURVE) -> dict:
+    # Group 'g{n}' with users 'u{n}_{i}' for every group size. Returns map username to private key
+    users, groups, private_keys = [], [], {}
+    for n, size in enumerate(group_sizes):
+        members = []
+        for i in range(size):
+            username = f"u{n}_{i}"
+            private_keys[username], public_key = gen_keys(curve)
+            users.append({'username': username, 'public_key': public_key})
+            members.append(username)
+        groups.append({'group_name': f"g{n}", 'members': members})
+    with open(path, 'w') as fp:
+        json.dump({'curve': curve.name, 'groups': groups, 'users': users}, fp)
+    return private_keys
+
+
+def free_port(host: str) -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def start_server(host: str, port: int, db_path: str, engine: str, shards: int = 1) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable, SERVER_PATH, host, str(port), db_path, '--engine', engine,
+                                '--shards', str(shards)],
+                               stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server didn't start")
+
+
+def run_scenario(host, port, n, group_size, msg_size, private_keys, args) -> dict:
+    # Every scenario has its own group, so it doesn't wait for sessions of previous one to close
+    group_name = f"g{n}"
+    usernames = [f"u{n}_{i}" for i in range(group_size)]
+    codec = CODEC_NAMES[args.protocol]
+
+    # Authentication rate: all members log in concurrently
+    def login(username):
+        client = BenchClient(host, port, username, group_name, private_keys[username], codec, args.decrypt,
+                             args.fanout, curve_by_name(args.curve))
+        client.authenticate()
+        return client
+
+    auth_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(group_size, 64)) as executor:
+        clients = list(executor.map(login, usernames))
+    auth_time = time.perf_counter() - auth_start
+    for client in clients:
+        client.start()
+
+    sender, receivers = clients[0], clients[1:]
+    # Wait until sender knows about every member
+    deadline = time.time() + 10
+    while len(sender.group_members) < group_size and time.time() < deadline:
+        time.sleep(0.01)
+    msg = 'x' * msg_size
+
+    # Latency: one message at a time, until every receiver got it. Includes signcryption of the message
+    latencies = []
+    lost = 0
+    for i in range(1, args.messages + 1):
+        start = time.perf_counter()
+        for request in sender.message_requests(msg):
+            sender.server.send(request)
+        for client in receivers:
+            if client.wait_arrivals(i, args.timeout):
+                latencies.append(client.arrivals[i - 1] - start)
+            else:
+                lost += 1
+    latencies.sort()
+
+    # Throughput: pre-signcrypted messages are sent back to back, server relay is the bottleneck
+    requests = [sender.message_requests(msg) for _ in range(args.messages)]
+    sent_bytes = sum(len(sender.server.codec.encode(r)) for batch in requests for r in batch)
+    expected = 2 * args.messages
+    start = time.perf_counter()
+    for batch in requests:
+        for request in batch:
+            sender.server.send(request)
+    delivered = 0
+    for client in receivers:
+        client.wait_arrivals(expected, args.timeout)
+        delivered += len(client.arrivals) - args.messages
+    elapsed = max((client.arrivals[-1] for client in receivers if client.arrivals), default=start) - start
+
+    for client in clients:
+        client.close()
+
+    return {
+        'group_size': group_size,
+        'msg_size': msg_size,
+        'auth': {'clients': group_size, 'seconds': auth_time, 'logins_per_sec': group_size / auth_time},
+        'latency': {'samples': len(latencies), 'lost': lost,
+                    'p50_ms': percentile(latencies, 50) * 1000, 'p90_ms': percentile(latencies, 90) * 1000,
+                    'p99_ms': percentile(latencies, 99) * 1000,
+                    'max_ms': (latencies[-1] if latencies else 0.0) * 1000},
+        'throughput': {'messages': args.messages, 'deliveries': delivered, 'seconds': elapsed,
+                       'deliveries_per_sec': delivered / elapsed if elapsed > 0 else 0.0,
+                       'upstream_bytes': sent_bytes},
+    }
+
+
+# Import time of module in fresh interpreters (python -X importtime): median total and slowest imports
+def import_time(module: str, runs: int) -> dict:
+    totals = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                 cwd=os.path.dirname(SERVER_PATH), capture_output=True, text=True, check=True)
+        totals.append(time.perf_counter() - start)
+        imports = []  # (self us, cumulative us, name)
+        for line in process.stderr.splitlines()[1:]:
+            self_us, cumulative_us, name = line.split(':', 1)[1].split('|')
+            imports.append((int(self_us), int(cumulative_us), name.strip()))
+    return {
+        'process_seconds': statistics.median(totals),
+        'import_seconds': imports[-1][1] / 1e6,  # Cumulative time of module itself (last line)
+        'slowest': [{'module': name, 'cumulative_seconds': cumulative / 1e6}
+                    for _, cumulative, name in sorted(imports, key=lambda item: -item[1])[1:11]],
+    }
+
+
+# Median seconds of function over samples calls, and result of the last call
+# setup - makes fresh arguments of function for every sample, it is not timed
+def _median_time(function, samples: int, setup=tuple):
+    times = []
+    for _ in range(samples):
+        args = setup()
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+# Signcryption and ZKKSP latency on every curve. Curves that are not suitable (curve_audit.check_curve)
+# or not supported by ecmath are reported with the reason and skipped
+def curve_matrix(curve_names, samples: int, msg_size: int) -> list:
+    from curve_audit import check_curve
+    from server import Server
+
+    msg = 'x' * msg_size
+    results = []
+    for name in curve_names:
+        curve = Curve.get_curve(name)
+        if curve is None:
+            results.append({'curve': name, 'skipped': "unknown curve"})
+            continue
+        reason = check_curve(curve) or (None if is_supported(curve) else "not a short Weierstrass curve")
+        if reason is not None:
+            results.append({'curve': curve.name, 'skipped': reason})
+            continue
+        generator_table(curve)  # Built once per process, not part of latency
+
+        keygen, (private_a, public_a) = _median_time(lambda: gen_keys(curve), samples)
+        private_b, public_b = gen_keys(curve)
+        signcrypt, _ = _median_time(lambda: signcryption(curve, msg, 'A', 'B', private_a, public_b), samples)
+        # Every sample gets a fresh message, as in real traffic: decoding of its R is not cached
+        unsigncrypt, text = _median_time(
+            lambda signcrypted: unsigncryption(curve, signcrypted, 'A', 'B', public_a, private_b), samples,
+            lambda: (signcryption(curve, msg, 'A', 'B', private_a, public_b),))
+        if text != msg:
+            raise RuntimeError(f"Unsigncryption failed on curve '{curve.name}'")
+
+        # Client: commitment and response to challenge, server: check of the proof
+        challenge = random_scalar(curve)
+
+        def prove():
+            r = random_scalar(curve)
+            return encode_point(curve, mul_generator(curve, r)), (r + challenge * private_a) % curve.order
+        zkksp_prove, _ = _median_time(prove, samples)
+        zkksp_verify, valid = _median_time(
+            lambda commitment, response: Server.check_zkksp(curve, public_a, commitment, challenge, response),
+            samples, prove)
+        if not valid:
+            raise RuntimeError(f"ZKKSP check failed on curve '{curve.name}'")
+
+        results.append({
+            'curve': curve.name,
+            'security_bits': curve.order.bit_length() // 2,
+            'keygen_ms': keygen * 1000,
+            'signcrypt_ms': signcrypt * 1000,
+            'unsigncrypt_ms': unsigncrypt * 1000,
+            'zkksp_prove_ms': zkksp_prove * 1000,
+            'zkksp_verify_ms': zkksp_verify * 1000,
+        })
+        print(f"[INFO] curve {curve.name} done", file=sys.stderr)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default='127.0.0.1', help="address to run server on")
+    parser.add_argument("--engine", choices=['threaded', 'asyncio'], default='threaded', help="server engine")
+    parser.add_argument("--shards", type=int, default=1, help="server worker processes (threaded engine)")
+    parser.add_argument("--protocol", choices=list(CODEC_NAMES), default='binary', help="message encoding")
+    parser.add_argument("--fanout", choices=['multi', 'single'], default='multi', help="client fan-out mode")
+    parser.add_argument("--group-sizes", type=int, nargs='+', default=[2, 8, 32], help="members per group")
+    parser.add_argument("--msg-sizes", type=int, nargs='+', default=[64, 1024, 16384], help="message sizes")
+    parser.add_argument("--messages", type=int, default=50, help="messages per scenario")
+    parser.add_argument("--decrypt", action='store_true', help="receivers unsigncrypt every message")
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for a delivery")
+    parser.add_argument("--output", type=str, help="write JSON results to file instead of stdout")
+    parser.add_argument("--import-time", action='store_true',
+                        help=f"measure import time of {', '.join(IMPORT_TIME_MODULES)} instead of the server")
+    parser.add_argument("--runs", type=int, default=10, help="interpreter starts per module for --import-time")
+    parser.add_argument("--curve", type=str, default=CURVE.name, help="curve of generated users and server")
+    parser.add_argument("--curves", type=str, nargs='*',
+                        help="measure signcryption/ZKKSP latency on these curves (none given: all curves) "
+                             "instead of the server, --messages samples of first --msg-sizes message")
+    args = parser.parse_args()
+    if min(args.group_sizes) < 2:
+        parser.error("group size must be at least 2")
+    try:
+        curve_by_name(args.curve)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.import_time:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        report = {
+            'timestamp': time.time(),
+            'config': {'runs': args.runs, 'python': sys.version.split()[0]},
+            'interpreter_seconds': time.perf_counter() - start,  # Floor: start of empty interpreter
+            'results': {module: import_time(module, args.runs) for module in IMPORT_TIME_MODULES},
+        }
+    elif args.curves is not None:
+        report = {
+            'timestamp': time.time(),
+            'config': {'samples': args.messages, 'msg_size': args.msg_sizes[0]},
+            'results': curve_matrix(args.curves or Curve.get_curve_names(), args.messages, args.msg_sizes[0]),
+        }
+    else:
+        report = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+def run_benchmark(args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'server_db.json')
+        scenarios = [(group_size, msg_size) for group_size in args.group_sizes for msg_size in args.msg_sizes]
+        private_keys = generate_database(db_path, [group_size for group_size, _ in scenarios],
+                                         curve_by_name(args.curve))
+        port = free_port(args.host)
+        server = start_server(args.host, port, db_path, args.engine, args.shards)
+        try:
+            results = []
+            for n, (group_size, msg_size) in enumerate(scenarios):
+                results.append(run_scenario(args.host, port, n, group_size, msg_size, private_keys, args))
+                print(f"[INFO] group_size={group_size} msg_size={msg_size} done", file=sys.stderr)
+        finally:
+            server.terminate()
+            server.wait()
+
+    return {
+        'timestamp': time.time(),
+        'config': {'engine': args.engine, 'shards': args.shards, 'protocol': args.protocol, 'fanout': args.fanout,
+                   'messages': args.messages, 'decrypt': args.decrypt, 'curve': args.curve},
+        'results': results,
+    }
+
+
+if __name__ == "__main__":
+    main()
@@ -1,142 +1,524 @@
 import argparse
-import random
+import asyncio
+import os
+import secrets
 import socket
+import tempfile
 import threading
+import queue
 import json
+from collections import namedtuple
+from concurrent.futures import Future
 
-from signcryption import signcryption, unsigncryption
-from constants import CURVE, BUFF_SIZE
+from ecpy.curves import Curve
 
+from signcryption import (signcryption, unsigncryption, signcryption_multi, unsigncryption_multi,
+                           unsigncryption_batch, peer_keys, StreamSigncrypter, StreamUnsigncrypter)
+from constants import CURVE, FILE_CHUNK_SIZE
+from ecmath import mul_generator, encode_point, curve_by_name, random_scalar
+from crypto_pool import CryptoPool
+from protocol import Connection, AsyncConnection, ProtocolError, CODEC_NAMES
 
-class Client:
-    def __init__(self, host: str, port: int, username: str, group_name: str, keys_path: str):
+# Incoming event. kind: 'message' (text is None if message is malicious), 'join', 'leave'
+# or 'file' (text is path of received file, None if file is malicious)
+ChatEvent = namedtuple('ChatEvent', ['kind', 'username', 'text'])
+
+
+class AuthenticationError(Exception):
+    pass
+
+
+# Metadata bound to file stream key wraps
+def _file_header(stream: int, name: str, size: int) -> bytes:
+    return f"{stream}\n{name}\n{size}".encode("utf-8")
+
+
+class IncomingFile:
+    # File being received: decrypted chunks go to temporary file, which is renamed after signature check
+    __slots__ = ('unsigncrypter', 'file', 'name', 'size', 'received')
+
+    def __init__(self, unsigncrypter: StreamUnsigncrypter, file, name: str, size: int):
+        self.unsigncrypter = unsigncrypter
+        self.file = file
+        self.name = name
+        self.size = size
+        self.received = 0
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.file.name)
+
+
+# Key files without "curve" are on the default curve
+def load_keys(keys_path: str) -> (int, list, Curve):
+    with open(keys_path, 'r') as fp:
+        keys = json.load(fp)
+    return keys["private"], keys["public"], curve_by_name(keys.get("curve", CURVE.name))
+
+
+class ClientCore:
+    # Transport independent client logic: ZKKSP messages, group members, signcryption of sent/received messages
+
+    def __init__(self, username: str, group_name: str, private_key: int, workers: int = 0, fanout: str = 'multi',
+                 download_dir: str = 'downloads', curve: Curve = CURVE):
         self.username = username
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.group_name = group_name
-        self.group_members = {}  # Map usernames to public keys
+        self.private_key = private_key
+        self.curve = curve  # Curve of private key, server must use the same one
+        self.group_members = {}  # Map usernames to public keys (PeerKey)
+        self.offline_members = {}  # Members that are not connected, server stores messages for them
+        self.members_lock = threading.Lock()  # Receive thread changes member maps while messages are sent
+        self.offline_delivery = False  # Server stores messages for offline members
+        self.backlog_size = 0  # Number of messages stored for this user when it authenticated
+        self.fanout = fanout  # 'multi' - one payload with key wraps, 'single' - signcrypt message to every member
+        self.download_dir = download_dir  # Received files are saved here
+        self.incoming = {}  # Map (sender, stream id) to IncomingFile
 
-        # Read keys
-        with open(keys_path, 'r') as fp:
-            keys = json.load(fp)
-            self.private_key = keys["private"]
-            self.public_key = keys["public"]
+        # Worker processes for signcryption/unsigncryption, started before any threads
+        self.pool = CryptoPool(self.curve, workers) if workers > 0 else None
 
-        # Connect to server
-        self.server.connect((host, port))
+    # Returns commitment secret and authentication request
+    def authentication_request(self):
+        commitment_r = random_scalar(self.curve)
+        commitment_R = mul_generator(self.curve, commitment_r)
+        return commitment_r, {'action': 'authentication',
+                              'username': self.username,
+                              'group_name': self.group_name,
+                              'commitment': encode_point(self.curve, commitment_R)}
 
-        # Authentication (ZKKSP)
-        self.authentication()
+    def prove_request(self, commitment_r: int, response: dict) -> dict:
+        if response.get('status') != 'challenge':
+            raise AuthenticationError("Server didn't accept challenge")
+        zkksp_response = (commitment_r + response['challenge'] * self.private_key) % self.curve.order
+        return {'action': 'prove',
+                'zkksp_response': zkksp_response}
 
-        # Receive messages thread
-        threading.Thread(target=self.receive_messages).start()
-
-        # Sending messages in an infinite loop
-        while True:
-            message = input()
-            self.send_message(message)
-
-    # Authenticate (ZKKSP) and connect to group
-    def authentication(self):
-        # Send user info and commitment
-        commitment_r = random.randint(1, CURVE.order - 1)
-        commitment_R = commitment_r * CURVE.generator
-        data = {'action': 'authentication',
-                'username': self.username,
-                'group_name': self.group_name,
-                'commitment': CURVE.encode_point(commitment_R)}
-        self.send(data)
+    def authentication_result(self, response: dict):
+        if response.get('status') == 'success':
+            self.group_members.update({username: peer_keys.get(self.curve, public_key)
+                                       for username, public_key in response['members'].items()})
+            self.offline_members.update({username: peer_keys.get(self.curve, public_key)
+                                         for username, public_key in response['offline'].items()})
+            self.offline_delivery = bool(response['offline_delivery'])
+            self.backlog_size = response['backlog']
+        elif response.get('status') == 'denied':
+            raise AuthenticationError(response['reason'])
+        else:
+            raise AuthenticationError("Unexpected response from server")
 
-        response = self.recv()
-        if response['status'] == 'challenge':
-            #  Send zkksp_response
-            challenge = response['challenge']
-            zkksp_response = (commitment_r + challenge * self.private_key) % CURVE.order
-            data = {'action': 'prove',
-                    'zkksp_response': zkksp_response}
-            self.send(data)
+    # Other members of group, offline - with offline members (server stores messages for them)
+    def recipients(self, offline: bool = False) -> dict:
+        with self.members_lock:
+            recipients = {username: public_key for username, public_key in self.group_members.items()
+                          if username != self.username}  # exclude himself
+            if offline:
+                recipients.update(self.offline_members)
+        return recipients
 
-            response = self.recv()
-            if response['status'] == 'success':
-                members = response['members']
-                self.group_members.update(members)
-                print(f"[INFO] Successfully connected to group '{self.group_name}'")
-                print("Users in chat:")
-                for username in self.group_members:
-                    print(f'- {username}')
-            elif response['status'] == 'denied':
-                print(f"[ERROR] Access to group '{self.group_name}' denied. Reason: {response['reason']}")
-                exit()
+    # Requests to send message to every other member of group
+    def message_requests(self, msg: str) -> list:
+        recipients = self.recipients(self.offline_delivery)
+        if self.fanout == 'multi' and len(recipients) > 1:
+            # Encrypt message once, signcrypt message key to every member
+            if self.pool is not None:
+                payload, wraps = self.pool.signcryption_multi(msg, self.username, recipients, self.private_key)
             else:
-                print(f"[ERROR] Unexpected response from server.")
-                exit()
+                payload, wraps = signcryption_multi(self.curve, msg, self.username, recipients, self.private_key)
+            return [{'action': 'send_multi', 'group': self.group_name, 'payload': payload, 'wraps': wraps}]
+
+        if self.pool is not None:
+            # Signcrypt message to every member in parallel, send in order
+            signcrypted = self.pool.signcryption_all(msg, self.username, recipients, self.private_key)
+        else:
+            signcrypted = {username: signcryption(self.curve, msg, self.username, username, self.private_key,
+                                                  public_key)
+                           for username, public_key in recipients.items()}
+        return [{'action': 'send_message', 'group': self.group_name, 'reciever': username,
+                 'signcrypted_msg': signcrypted_msg}
+                for username, signcrypted_msg in signcrypted.items()]
+
+    # Requests to send file to connected members, file is read and signcrypted chunk by chunk
+    def file_requests(self, path: str):
+        name, size = os.path.basename(path), os.path.getsize(path)
+        stream = secrets.randbits(63)
+        recipients = self.recipients()
+        signcrypter = StreamSigncrypter(self.curve, self.username, recipients, self.private_key,
+                                        _file_header(stream, name, size))
+        yield {'action': 'file_start', 'group': self.group_name, 'stream': stream, 'name': name, 'size': size,
+               'wraps': signcrypter.start()}
+        with open(path, 'rb') as fp:
+            while chunk := fp.read(FILE_CHUNK_SIZE):
+                yield {'action': 'file_chunk', 'stream': stream, 'data': signcrypter.chunk(chunk)}
+        yield {'action': 'file_end', 'stream': stream, 'wraps': signcrypter.finish()}
+
+    # Returns event when file is received or turns out malicious, otherwise None
+    def handle_file(self, response: dict) -> ChatEvent | None:
+        sender, key = response['sender'], (response['sender'], response['stream'])
+        action = response['action']
+        if action == 'file_offer':
+            sender_pub_key = self.public_key(sender)
+            if sender_pub_key is None or key in self.incoming:
+                return None
+            try:
+                unsigncrypter = StreamUnsigncrypter(self.curve, response['signcrypted_msg'], sender, self.username,
+                                                    sender_pub_key, self.private_key,
+                                                    _file_header(response['stream'], response['name'],
+                                                                 response['size']))
+            except ValueError:
+                return ChatEvent('file', sender, None)
+            os.makedirs(self.download_dir, exist_ok=True)
+            file = tempfile.NamedTemporaryFile(dir=self.download_dir, prefix='.part-', delete=False)
+            self.incoming[key] = IncomingFile(unsigncrypter, file, response['name'], response['size'])
+            return None
+
+        incoming = self.incoming.get(key)
+        if incoming is None:
+            return None
+        try:
+            if action == 'file_data':
+                data = incoming.unsigncrypter.chunk(response['data'])
+                incoming.received += len(data)
+                if incoming.received > incoming.size:
+                    raise ValueError("File is larger than offered")
+                incoming.file.write(data)
+                return None
+            del self.incoming[key]
+            incoming.unsigncrypter.finish(response['signcrypted_msg'])
+            if incoming.received != incoming.size:
+                raise ValueError("File is smaller than offered")
+        except ValueError:
+            self.incoming.pop(key, None)
+            incoming.discard()
+            return ChatEvent('file', sender, None)
+        incoming.file.close()
+        path = self.download_path(incoming.name)
+        os.replace(incoming.file.name, path)
+        return ChatEvent('file', sender, path)
+
+    # Free path in download directory for received file name
+    def download_path(self, name: str) -> str:
+        base, ext = os.path.splitext(os.path.basename(name).lstrip('.') or 'file')
+        path, n = os.path.join(self.download_dir, base + ext), 1
+        while os.path.exists(path):
+            path, n = os.path.join(self.download_dir, f"{base} ({n}){ext}"), n + 1
+        return path
+
+    # Returns message text (None if malicious) or Future with it, if worker pool is used
+    def unsigncrypt(self, response: dict):
+        sender_name = response['sender']
+        sender_pub_key = self.public_key(sender_name)
+        if sender_pub_key is None:  # Not a member of group
+            return None
+        if response['action'] == 'msg':
+            if self.pool is not None:
+                return self.pool.unsigncryption(response['signcrypted_msg'], sender_name, self.username,
+                                                sender_pub_key, self.private_key)
+            func, args = unsigncryption, (response['signcrypted_msg'],)
         else:
-            print("[ERROR] Server didn't accept challenge")
-            exit()
+            if self.pool is not None:
+                return self.pool.unsigncryption_multi(response['payload'], response['signcrypted_msg'],
+                                                      sender_name, self.username, sender_pub_key,
+                                                      self.private_key)
+            func, args = unsigncryption_multi, (response['payload'], response['signcrypted_msg'])
+        try:
+            return func(self.curve, *args, sender_name, self.username, sender_pub_key, self.private_key)
+        except ValueError:
+            return None
+
+    # Stored messages come after success response, until presence changes
+    @staticmethod
+    def stored(response: dict) -> bool:
+        return response.get('action') in ('msg', 'multi_msg')
+
+    # Messages stored for this user while it was offline. Signatures of single messages are verified in one batch
+    def unsigncrypt_backlog(self, responses: list) -> list:
+        single = [i for i, response in enumerate(responses)
+                  if response['action'] == 'msg' and self.pool is None and self.public_key(response['sender'])]
+        texts = {}
+        if single:
+            items = [(responses[i]['signcrypted_msg'], responses[i]['sender'], self.username,
+                      self.public_key(responses[i]['sender'])) for i in single]
+            texts = dict(zip(single, unsigncryption_batch(self.curve, items, self.private_key)))
+        return [ChatEvent('message', response['sender'], texts[i] if i in texts else self.unsigncrypt(response))
+                for i, response in enumerate(responses)]
+
+    def public_key(self, username: str):
+        peer = self.group_members.get(username)
+        return peer if peer is not None else self.offline_members.get(username)
+
+    # Update group state from server message, returns events for it (none for parts of file transfer)
+    def handle_response(self, response: dict) -> list:
+        action = response['action']
+        if action in ('msg', 'multi_msg'):
+            return [ChatEvent('message', response['sender'], self.unsigncrypt(response))]
+        elif action == 'presence':
+            return self.apply_presence(response)
+        elif action in ('file_offer', 'file_data', 'file_done'):
+            event = self.handle_file(response)
+            return [event] if event is not None else []
+        else:
+            raise ProtocolError(f"Unknown action in handle_response(): {action}")
+
+    # Presence may repeat changes that are known already, events are returned only for actual changes
+    def apply_presence(self, response: dict) -> list:
+        if response.get('action') != 'presence':
+            raise ProtocolError("Expected presence message")
+        events = []
+        with self.members_lock:
+            for username in response['left']:
+                peer = self.group_members.pop(username, None)
+                if peer is None:
+                    continue
+                peer_keys.invalidate(self.curve, peer.encoded)  # Key may be replaced before member joins again
+                if self.offline_delivery:
+                    self.offline_members[username] = peer
+                for key in [key for key in self.incoming if key[0] == username]:
+                    self.incoming.pop(key).discard()  # Unfinished files of member
+                if username != self.username:
+                    events.append(ChatEvent('leave', username, None))
+            for username, public_key in response['joined'].items():
+                peer = peer_keys.get(self.curve, public_key)
+                known = self.group_members.get(username)
+                self.offline_members.pop(username, None)
+                self.group_members[username] = peer
+                if username != self.username and (known is None or known.encoded != peer.encoded):
+                    events.append(ChatEvent('join', username, None))
+        return events
+
+
+class ChatClient(ClientCore):
+    """
+    Blocking client library. Incoming events are passed to callbacks from the receive thread:
+    on_message(sender, text), on_member_join(username), on_member_leave(username), on_file(sender, path).
+    """
+
+    def __init__(self, username: str, group_name: str, private_key: int, workers: int = 0, fanout: str = 'multi',
+                 on_message=None, on_member_join=None, on_member_leave=None, on_file=None,
+                 download_dir: str = 'downloads', curve: Curve = CURVE):
+        super().__init__(username, group_name, private_key, workers, fanout, download_dir, curve)
+        self.on_message = on_message
+        self.on_member_join = on_member_join
+        self.on_member_leave = on_member_leave
+        self.on_file = on_file
+        self.server = None
+        self.dispatch_queue = queue.Queue()  # Events with messages unsigncrypted by worker pool
+        self.backlog = []  # Events of stored messages, dispatched by start()
+
+    def connect(self, host: str, port: int, codecs=tuple(CODEC_NAMES.values()), compressed: bool = True):
+        # Connect to server and negotiate message encoding. Raises ProtocolError if server uses other curve
+        self.server = Connection(socket.create_connection((host, port)))
+        self.server.client_handshake(codecs, compressed, self.curve)
+
+    # Authenticate (ZKKSP) and connect to group. Raises AuthenticationError if access denied
+    def authenticate(self):
+        commitment_r, data = self.authentication_request()
+        self.send(data)
+        self.send(self.prove_request(commitment_r, self.recv()))
+        self.authentication_result(self.recv())
+        backlog, response = [], self.recv()
+        while self.stored(response):
+            backlog.append(response)
+            response = self.recv()
+        self.backlog = self.unsigncrypt_backlog(backlog)
+        self.apply_presence(response)  # Changes since member lists of success response
+
+    # Dispatch stored messages, start receive thread
+    def start(self):
+        if self.pool is not None:
+            threading.Thread(target=self.dispatch_pool_events, daemon=True).start()
+        for event in self.backlog:
+            self.handle_event(event)
+        self.backlog = []
+        threading.Thread(target=self.receive_messages).start()
 
     def send(self, data):
-        self.server.send(json.dumps(data).encode())
+        self.server.send(data)
 
     def recv(self):
-        return json.loads(self.server.recv(BUFF_SIZE).decode())
+        response = self.server.recv()
+        if response is None:
+            raise ConnectionResetError("Server closed connection")
+        return response
+
+    def send_message(self, msg: str):
+        for request in self.message_requests(msg):
+            self.send(request)
+
+    def send_file(self, path: str):
+        for request in self.file_requests(path):
+            self.send(request)
 
     def receive_messages(self):
         while True:
             try:
-                response = self.recv()
-
-                if response['action'] == 'new_member':
-                    username = response['member_name']
-                    public_key = response['member_public_key']
-                    self.group_members[username] = public_key
-                    # self.group_members.append({'username': username,
-                    #                            'public_key': public_key})
-                    print(f"[INFO] New member: {username}")
-                elif response['action'] == 'msg':
-                    # Get signcrypted message
-                    sender_name = response['sender']
-                    R, C, s = response['signcrypted_msg']
-                    signcrypted_msg = R, C, s
-
-                    # Find sender public key
-                    sender_pub_key = self.group_members[sender_name]
-
-                    # Unsigncrypt
-                    try:
-                        msg = unsigncryption(CURVE, signcrypted_msg, sender_name, self.username,
-                                             sender_pub_key,
-                                             self.private_key)
-                    except ValueError:
-                        msg = None
-                    if msg is None:
-                        print(f"[WARNING] user '{sender_name}' sent malicious message")
-                    else:
-                        print(f"{sender_name}: {msg}")
-                elif response['action'] == 'member_leave':
-                    del self.group_members[response['username']]
-                    print(f"[INFO] Member leave: {response['username']}")
-                else:
-                    raise ValueError(f"Unknown action in receive_messages(): {response['action']}")
-            except (ConnectionResetError, json.JSONDecodeError):
+                events = self.handle_response(self.recv())
+            except (OSError, ProtocolError):
                 break
+            for event in events:
+                self.handle_event(event)
+
+    def handle_event(self, event: ChatEvent):
+        if isinstance(event.text, Future):
+            self.dispatch_queue.put(event)
+        else:
+            self.dispatch(event)
 
-    def send_message(self, msg):
-        for username, public_key in self.group_members.items():
-            if username != self.username:  # exclude himself
-                # Signcrypt message to every member in chat and send
-                (R, C, s) = signcryption(CURVE, msg, self.username, username, self.private_key,
-                                         public_key)
-                signcrypted_msg = (R, C, s)
-                self.send({'action': 'send_message', 'group': self.group_name, 'reciever': username,
-                           'signcrypted_msg': signcrypted_msg})
+    # Events from worker pool, in order they were received
+    def dispatch_pool_events(self):
+        while True:
+            event = self.dispatch_queue.get()
+            self.dispatch(event._replace(text=event.text.result()))
 
+    def dispatch(self, event: ChatEvent):
+        if event.kind == 'message' and self.on_message is not None:
+            self.on_message(event.username, event.text)
+        elif event.kind == 'join' and self.on_member_join is not None:
+            self.on_member_join(event.username)
+        elif event.kind == 'leave' and self.on_member_leave is not None:
+            self.on_member_leave(event.username)
+        elif event.kind == 'file' and self.on_file is not None:
+            self.on_file(event.username, event.text)
 
-if __name__ == "__main__":
+    def close(self):
+        self.server.close()
+
+
+class AsyncChatClient(ClientCore):
+    """
+    asyncio client library, one event loop can host many clients. Incoming events: async for event in events().
+    """
+
+    def __init__(self, username: str, group_name: str, private_key: int, workers: int = 0, fanout: str = 'multi',
+                 download_dir: str = 'downloads', curve: Curve = CURVE):
+        super().__init__(username, group_name, private_key, workers, fanout, download_dir, curve)
+        self.server = None
+        self.event_queue = asyncio.Queue()  # Events for events(), None when connection is closed
+        self.reader_task = None
+
+    async def connect(self, host: str, port: int, codecs=tuple(CODEC_NAMES.values()), compressed: bool = True):
+        reader, writer = await asyncio.open_connection(host, port)
+        self.server = AsyncConnection(reader, writer)
+        await self.server.client_handshake(codecs, compressed, self.curve)
+
+    # Authenticate (ZKKSP) and connect to group, then start receiving. Raises AuthenticationError if access denied
+    async def authenticate(self):
+        commitment_r, data = self.authentication_request()
+        self.server.send(data)
+        self.server.send(self.prove_request(commitment_r, await self.recv()))
+        self.authentication_result(await self.recv())
+        backlog, response = [], await self.recv()
+        while self.stored(response):
+            backlog.append(response)
+            response = await self.recv()
+        for event in self.unsigncrypt_backlog(backlog):
+            self.event_queue.put_nowait(event)
+        self.apply_presence(response)  # Changes since member lists of success response
+        self.reader_task = asyncio.create_task(self.receive_messages())
+
+    async def recv(self):
+        response = await self.server.recv()
+        if response is None:
+            raise ConnectionResetError("Server closed connection")
+        return response
+
+    async def send_message(self, msg: str):
+        for request in self.message_requests(msg):
+            self.server.send(request)
+
+    # Waits for every chunk to be written, so file is not read into memory as a whole
+    async def send_file(self, path: str):
+        for request in self.file_requests(path):
+            self.server.send(request)
+            await self.server.drain()
+
+    # Group members are updated here, even if nobody consumes events()
+    async def receive_messages(self):
+        try:
+            while True:
+                for event in self.handle_response(await self.recv()):
+                    self.event_queue.put_nowait(event)
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            self.event_queue.put_nowait(None)
+
+    async def events(self):
+        while True:
+            event = await self.event_queue.get()
+            if event is None:
+                return
+            if isinstance(event.text, Future):
+                event = event._replace(text=await asyncio.wrap_future(event.text))
+            yield event
+
+    def close(self):
+        self.server.close()
+
+
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("host", type=str, help="server IP address")
     parser.add_argument("port", type=int, help="server port")
     parser.add_argument("username", type=str, help="username")
     parser.add_argument("groupname", type=str, help="group name")
     parser.add_argument("keys_path", type=str, help="path to json with public/private key pair")
+    parser.add_argument("--protocol", choices=list(CODEC_NAMES), default='binary',
+                        help="message encoding to request from server")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="worker processes for signcryption/unsigncryption (0 - no pool)")
+    parser.add_argument("--fanout", choices=['multi', 'single'], default='multi',
+                        help="send one payload with per-member key wraps or signcrypt message to every member")
+    parser.add_argument("--download-dir", type=str, default='downloads', help="directory for received files")
+    parser.add_argument("--points", choices=['compressed', 'uncompressed'], default='compressed',
+                        help="elliptic curve point encoding to request from server")
     args = parser.parse_args()
 
-    client = Client(args.host, args.port, args.username, args.groupname, args.keys_path)
+    def show_message(sender_name, msg):
+        if msg is None:
+            print(f"[WARNING] user '{sender_name}' sent malicious message")
+        else:
+            print(f"{sender_name}: {msg}")
+
+    def show_file(sender_name, path):
+        if path is None:
+            print(f"[WARNING] user '{sender_name}' sent malicious file")
+        else:
+            print(f"[INFO] {sender_name} sent file: {path}")
+
+    private_key, _, curve = load_keys(args.keys_path)
+    client = ChatClient(args.username, args.groupname, private_key, args.workers, args.fanout,
+                        on_message=show_message,
+                        on_member_join=lambda username: print(f"[INFO] New member: {username}"),
+                        on_member_leave=lambda username: print(f"[INFO] Member leave: {username}"),
+                        on_file=show_file, download_dir=args.download_dir, curve=curve)
+    try:
+        client.connect(args.host, args.port, (CODEC_NAMES[args.protocol],), args.points == 'compressed')
+    except ProtocolError as e:
+        print(f"[ERROR] Can't connect to server: {e}")
+        exit()
+    try:
+        client.authenticate()
+    except AuthenticationError as e:
+        print(f"[ERROR] Access to group '{args.groupname}' denied. Reason: {e}")
+        exit()
+    print(f"[INFO] Successfully connected to group '{args.groupname}'")
+    print("Users in chat:")
+    for username in client.group_members:
+        print(f'- {username}')
+    client.start()
+
+    # Sending messages in an infinite loop. '/send-file <path>' sends file
+    while True:
+        message = input()
+        if message.startswith('/send-file '):
+            path = message[len('/send-file '):].strip()
+            try:
+                client.send_file(path)
+            except OSError as e:
+                print(f"[ERROR] Can't send file: {e}")
+        else:
+            client.send_message(message)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,17 @@
 from ecpy.curves import Curve
 
-# Curve for signcryption. Parameters: https://neuromancer.sk/std/nist/P-192
+# Default curve for signcryption, used when database or key file doesn't name one.
+# Parameters: https://neuromancer.sk/std/nist/P-192
 CURVE = Curve.get_curve('NIST-P192')
 IV = b'\x00' * 15 + b'\xb3'  # Input vector for AES256-CBC
-BUFF_SIZE = 2048  # Client-server buffer-size
+BUFF_SIZE = 65536  # Client-server socket recv buffer-size
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Max size of one protocol frame
+LISTEN_BACKLOG = 128  # Server listen() backlog
+FILE_CHUNK_SIZE = 64 * 1024  # Plaintext bytes per chunk of file transfer
+LOG_SEGMENT_SIZE = 32 * 1024 * 1024  # Size of one message log segment file
+LOG_MAX_SEGMENTS = 8  # Segments kept per group, older ones are deleted
+LOG_REPLAY_BATCH = 1024 * 1024  # Bytes of stored messages sent to joining member at once
+LOG_SAVE_INTERVAL = 5  # Seconds between saves of changed delivery cursors of message log
+SEND_QUEUE_LIMIT = 4 * 1024 * 1024  # Bytes queued in memory for one connection before slow consumer policy applies
+SEND_SPILL_LIMIT = 256 * 1024 * 1024  # Bytes spilled to disk for one connection before it is disconnected
+SLOW_CONSUMER_POLICY = 'spill'  # What to do with frames for a connection over SEND_QUEUE_LIMIT (protocol.py)
@@ -0,0 +1,78 @@
+"""
+Process pool for signcryption/unsigncryption. Elliptic curve math is pure Python and holds the GIL,
+so messages to (or from) different members are processed in parallel by worker processes.
+"""
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import List, Dict
+
+from ecpy.curves import Curve
+
+from ecmath import generator_table
+from signcryption import _signcrypt, _encrypt_payload, unsigncryption, unsigncryption_multi
+
+_curve = None  # Curve of worker process
+
+
+def _init_worker(curve_name: str):
+    global _curve
+    _curve = Curve.get_curve(curve_name)
+    generator_table(_curve)  # Build fixed-base table once per worker
+
+
+def _signcrypt_task(data: bytes, send_id: str, recv_id: str, send_priv_key: int, recv_pub_key: List[int]):
+    return _signcrypt(_curve, data, send_id, recv_id, send_priv_key, recv_pub_key)
+
+
+def _unsigncrypt_task(signcrypted_data, send_id: str, recv_id: str, send_pub_key: List[int],
+                      recv_priv_key: int) -> str | None:
+    try:
+        return unsigncryption(_curve, signcrypted_data, send_id, recv_id, send_pub_key, recv_priv_key)
+    except ValueError:
+        return None
+
+
+def _unsigncrypt_multi_task(payload: bytes, wrap, send_id: str, recv_id: str, send_pub_key: List[int],
+                            recv_priv_key: int) -> str | None:
+    try:
+        return unsigncryption_multi(_curve, payload, wrap, send_id, recv_id, send_pub_key, recv_priv_key)
+    except ValueError:
+        return None
+
+
+class CryptoPool:
+    def __init__(self, curve: Curve, processes: int):
+        self.executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                            initargs=(curve.name,))
+        # Start workers now: forking later, from a process with running threads, may deadlock
+        self.executor.submit(int).result()
+
+    # Signcrypt message to every recipient in parallel. Returns map recipient id to (R, C, s) in recipients order
+    def signcryption_all(self, message: str, send_id: str, recipients: Dict[str, List[int]],
+                         send_priv_key: int) -> Dict[str, tuple]:
+        return self._signcrypt_all(message.encode("utf-8"), send_id, recipients, send_priv_key)
+
+    # Same as signcryption.signcryption_multi, key wraps are computed in parallel
+    def signcryption_multi(self, message: str, send_id: str, recipients: Dict[str, List[int]],
+                           send_priv_key: int) -> (bytes, Dict[str, tuple]):
+        payload, key_data = _encrypt_payload(message)
+        return payload, self._signcrypt_all(key_data, send_id, recipients, send_priv_key)
+
+    def _signcrypt_all(self, data: bytes, send_id: str, recipients: Dict[str, List[int]], send_priv_key: int):
+        recv_ids = list(recipients)
+        results = self.executor.map(_signcrypt_task, [data] * len(recv_ids), [send_id] * len(recv_ids), recv_ids,
+                                    [send_priv_key] * len(recv_ids), [recipients[r] for r in recv_ids])
+        return dict(zip(recv_ids, results))
+
+    # Returns future with message, None if message is malicious
+    def unsigncryption(self, signcrypted_data, send_id: str, recv_id: str, send_pub_key: List[int],
+                       recv_priv_key: int) -> Future:
+        return self.executor.submit(_unsigncrypt_task, signcrypted_data, send_id, recv_id, send_pub_key,
+                                    recv_priv_key)
+
+    def unsigncryption_multi(self, payload: bytes, wrap, send_id: str, recv_id: str, send_pub_key: List[int],
+                             recv_priv_key: int) -> Future:
+        return self.executor.submit(_unsigncrypt_multi_task, payload, wrap, send_id, recv_id, send_pub_key,
+                                    recv_priv_key)
+
+    def shutdown(self):
+        self.executor.shutdown()
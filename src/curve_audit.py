@@ -0,0 +1,91 @@
+"""
+Checks if elliptic curves are suitable for signcryption. Audit tooling only, not imported by client or server,
+so their startup doesn't depend on it. Primality is checked with Miller-Rabin.
+
+Command line: curve_audit.py [curve_name ...] (default: all curves known to ecpy)
+"""
+import argparse
+import secrets
+from math import isqrt
+
+from ecpy.curves import Curve, TwistedEdwardCurve
+
+MILLER_RABIN_ROUNDS = 40  # Error probability of a composite passing is at most 4^-40
+_SMALL_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+
+
+def is_probable_prime(n: int, rounds: int = MILLER_RABIN_ROUNDS) -> bool:
+    if n < 2:
+        return False
+    for p in _SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+
+    d, r = n - 1, 0
+    while not d & 1:
+        d >>= 1
+        r += 1
+    # Fixed small bases first (deterministic for n < 3.3 * 10^24), then random ones
+    bases = list(_SMALL_PRIMES) + [secrets.randbelow(n - 3) + 2 for _ in range(rounds)]
+    for a in bases:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(r - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+# Returns None if curve is suitable, otherwise reason why it's not suitable
+def check_curve(curve: Curve) -> str | None:
+    if type(curve) == TwistedEdwardCurve:
+        return "TwistedEdwardCurve"
+
+    q = curve.field
+    n = curve.order
+    a, b = curve.a, curve.b
+
+    if not is_probable_prime(q):
+        return "'q' is not prime"
+
+    # Check non singular
+    if (4 * a ** 3 + 27 * b ** 2) % q == 0:
+        return "singular curve"
+
+    # Guard against small subgroup attacks
+    if n <= 4 * isqrt(q):
+        return "small subgroup attacks"
+
+    # Protect against other known attacks on special classes of elliptic curves (MOV: small embedding degree)
+    for i in range(1, 21):
+        if (q ** i - 1) % n == 0:
+            return "small subgroup attacks"
+
+    # Intractability of ECDLP
+    if n <= 2 ** 160:
+        return "ECDLP is tractable"
+
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check if curves are suitable for signcryption")
+    parser.add_argument("curves", nargs='*', help="curve names (default: all curves known to ecpy)")
+    args = parser.parse_args()
+
+    print("Checking if curves suitable for signcryption...")
+    for curve_name in args.curves or Curve.get_curve_names():
+        curve = Curve.get_curve(curve_name)
+        res = check_curve(curve)
+        if res:
+            print(f"{curve.name}: BAD ({res})")
+        else:
+            print(f"{curve.name}: OKAY")
+
+
+if __name__ == "__main__":
+    main()
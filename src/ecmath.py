@@ -0,0 +1,398 @@
+"""
+Fast scalar multiplication on short Weierstrass curves (ecpy's WeierstrassCurve):
+fixed-base generator tables and interleaved wNAF multi-scalar multiplication.
+
+Points are kept in Jacobian coordinates (X, Y, Z) during computation, Z == 0 is the point at infinity.
+
+Also SEC1 point encoding: compressed (02/03 | x) and uncompressed (04 | x | y) points, decoding checks that
+the point is on the curve, square roots of compressed points are cached.
+"""
+import secrets
+import threading
+from collections import OrderedDict
+
+from ecpy.curves import Curve, Point, WeierstrassCurve
+
+FIXED_BASE_WINDOW = 5  # Bits per window of fixed-base table
+WNAF_WINDOW = 4  # wNAF width for variable-base multiplication
+DECOMPRESS_CACHE_SIZE = 4096  # Decompressed points kept in memory
+
+_INFINITY = (1, 1, 0)
+
+
+def _dbl(P, q, a):
+    X1, Y1, Z1 = P
+    if not Z1 or not Y1:
+        return _INFINITY
+    XX = (X1 * X1) % q
+    YY = (Y1 * Y1) % q
+    YYYY = (YY * YY) % q
+    ZZ = (Z1 * Z1) % q
+    S = (2 * ((X1 + YY) * (X1 + YY) - XX - YYYY)) % q
+    M = (3 * XX + a * ZZ * ZZ) % q
+    X3 = (M * M - 2 * S) % q
+    Y3 = (M * (S - X3) - 8 * YYYY) % q
+    Z3 = ((Y1 + Z1) * (Y1 + Z1) - YY - ZZ) % q
+    return X3, Y3, Z3
+
+
+def _add(P, Q, q, a):
+    X1, Y1, Z1 = P
+    X2, Y2, Z2 = Q
+    if not Z1:
+        return Q
+    if not Z2:
+        return P
+    Z1Z1 = (Z1 * Z1) % q
+    Z2Z2 = (Z2 * Z2) % q
+    U1 = (X1 * Z2Z2) % q
+    U2 = (X2 * Z1Z1) % q
+    S1 = (Y1 * Z2 * Z2Z2) % q
+    S2 = (Y2 * Z1 * Z1Z1) % q
+    H = (U2 - U1) % q
+    r = (2 * (S2 - S1)) % q
+    if not H:
+        return _dbl(P, q, a) if not r else _INFINITY
+    I = (4 * H * H) % q
+    J = (H * I) % q
+    V = (U1 * I) % q
+    X3 = (r * r - J - 2 * V) % q
+    Y3 = (r * (V - X3) - 2 * S1 * J) % q
+    Z3 = (((Z1 + Z2) * (Z1 + Z2) - Z1Z1 - Z2Z2) * H) % q
+    return X3, Y3, Z3
+
+
+# Mixed addition: Q is affine (x2, y2)
+def _add_affine(P, x2, y2, q, a):
+    X1, Y1, Z1 = P
+    if not Z1:
+        return x2, y2, 1
+    Z1Z1 = (Z1 * Z1) % q
+    U2 = (x2 * Z1Z1) % q
+    S2 = (y2 * Z1 * Z1Z1) % q
+    H = (U2 - X1) % q
+    r = (2 * (S2 - Y1)) % q
+    if not H:
+        return _dbl(P, q, a) if not r else _INFINITY
+    HH = (H * H) % q
+    I = (4 * HH) % q
+    J = (H * I) % q
+    V = (X1 * I) % q
+    X3 = (r * r - J - 2 * V) % q
+    Y3 = (r * (V - X3) - 2 * Y1 * J) % q
+    Z3 = ((Z1 + H) * (Z1 + H) - Z1Z1 - HH) % q
+    return X3, Y3, Z3
+
+
+def _to_affine(P, q):
+    X, Y, Z = P
+    inv_z = pow(Z, -1, q)
+    inv_z2 = (inv_z * inv_z) % q
+    return (X * inv_z2) % q, (Y * inv_z2 * inv_z) % q
+
+
+# Convert many Jacobian points with a single inversion (Montgomery's trick)
+def _batch_to_affine(points, q):
+    prefix = []
+    acc = 1
+    for X, Y, Z in points:
+        prefix.append(acc)
+        acc = (acc * Z) % q
+    inv = pow(acc, -1, q)
+    res = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        inv_z = (inv * prefix[i]) % q
+        inv = (inv * Z) % q
+        inv_z2 = (inv_z * inv_z) % q
+        res[i] = ((X * inv_z2) % q, (Y * inv_z2 * inv_z) % q)
+    return res
+
+
+def to_point(curve: Curve, P) -> Point:
+    if not P[2]:
+        return curve.infinity
+    x, y = _to_affine(P, curve.field)
+    return Point(x, y, curve, False)
+
+
+def from_point(P: Point):
+    if P.is_infinity:
+        return _INFINITY
+    return P.x, P.y, 1
+
+
+def is_supported(curve: Curve) -> bool:
+    return isinstance(curve, WeierstrassCurve)
+
+
+# Curve of a deployment (database, key file, handshake) by ecpy name. Only supported curves are accepted,
+# whether they are suitable at all is checked by curve_audit.py
+def curve_by_name(name: str) -> Curve:
+    curve = Curve.get_curve(name) if isinstance(name, str) else None
+    if curve is None:
+        raise ValueError(f"Unknown curve {name!r}")
+    if not is_supported(curve):
+        raise ValueError(f"Curve '{name}' is not a short Weierstrass curve")
+    return curve
+
+
+class FixedBaseTable:
+    """
+    Windowed fixed-base table: rows[i][j - 1] = j * 2^(window * i) * base, stored affine.
+    k * base is then the sum of one table entry per window of k, no doublings needed.
+    """
+
+    def __init__(self, curve: Curve, base: Point, window: int = FIXED_BASE_WINDOW):
+        self.curve = curve
+        self.base = base
+        self.window = window
+        q, a = curve.field, curve.a
+        n_rows = (curve.order.bit_length() + window - 1) // window
+        row_size = (1 << window) - 1
+
+        points = []
+        row_base = from_point(base)
+        for _ in range(n_rows):
+            acc = row_base
+            points.append(acc)
+            for _ in range(row_size - 1):
+                acc = _add(acc, row_base, q, a)
+                points.append(acc)
+            row_base = _add(acc, row_base, q, a)  # 2^window * row_base
+        affine = _batch_to_affine(points, q)
+        self.rows = [affine[i * row_size:(i + 1) * row_size] for i in range(n_rows)]
+
+    def mul_jacobian(self, k: int):
+        k %= self.curve.order
+        q, a = self.curve.field, self.curve.a
+        mask = (1 << self.window) - 1
+        acc = _INFINITY
+        for row in self.rows:
+            if not k:
+                break
+            digit = k & mask
+            if digit:
+                x, y = row[digit - 1]
+                acc = _add_affine(acc, x, y, q, a)
+            k >>= self.window
+        return acc
+
+    def mul(self, k: int) -> Point:
+        return to_point(self.curve, self.mul_jacobian(k))
+
+
+_generator_tables = {}  # Map curve name to FixedBaseTable of its generator
+
+
+def generator_table(curve: Curve) -> FixedBaseTable:
+    table = _generator_tables.get(curve.name)
+    if table is None:
+        table = FixedBaseTable(curve, curve.generator)
+        _generator_tables[curve.name] = table
+    return table
+
+
+# k * curve.generator
+def mul_generator(curve: Curve, k: int) -> Point:
+    if not is_supported(curve):
+        return k * curve.generator
+    return generator_table(curve).mul(k)
+
+
+# Secret scalar in [1, order - 1] from CSPRNG: private keys, nonces, challenges
+def random_scalar(curve: Curve) -> int:
+    return secrets.randbelow(curve.order - 1) + 1
+
+
+# Width-w non-adjacent form of k, least significant digit first
+def _wnaf(k: int, w: int) -> list:
+    digits = []
+    full = 1 << w
+    half = full >> 1
+    while k:
+        if k & 1:
+            d = k & (full - 1)
+            if d >= half:
+                d -= full
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+    return digits
+
+
+# Affine odd multiples P, 3P, 5P, ..., (2^(w-1) - 1)P
+def _odd_multiples(P, w, q, a):
+    P2 = _dbl(P, q, a)
+    points = [P]
+    for _ in range((1 << (w - 2)) - 1):
+        points.append(_add(points[-1], P2, q, a))
+    if any(not Z for _, _, Z in points):  # Small order point, can't happen on prime order curves
+        raise ValueError("Point of small order in multi-scalar multiplication")
+    return _batch_to_affine(points, q)
+
+
+def multi_scalar_mul_jacobian(curve: Curve, terms, gen_scalar: int = 0):
+    """
+    Computes gen_scalar * G + sum(k * P for k, P in terms) with one shared doubling chain
+    (interleaved wNAF, Shamir's trick). The generator part goes through its fixed-base table,
+    P may also be a FixedBaseTable of the point.
+    """
+    q, a, n = curve.field, curve.a, curve.order
+    acc = generator_table(curve).mul_jacobian(gen_scalar) if gen_scalar % n else _INFINITY
+
+    tables, nafs, singles = [], [], []
+    for k, P in terms:
+        k %= n
+        if not k:
+            continue
+        if isinstance(P, FixedBaseTable):
+            acc = _add(acc, P.mul_jacobian(k), q, a)
+            continue
+        if P.is_infinity:
+            continue
+        if k == 1 or k == n - 1:
+            singles.append((P.x, P.y if k == 1 else q - P.y))
+            continue
+        tables.append(_odd_multiples(from_point(P), WNAF_WINDOW, q, a))
+        nafs.append(_wnaf(k, WNAF_WINDOW))
+
+    res = _INFINITY
+    for i in range(max((len(naf) for naf in nafs), default=0) - 1, -1, -1):
+        res = _dbl(res, q, a)
+        for table, naf in zip(tables, nafs):
+            if i < len(naf) and naf[i]:
+                d = naf[i]
+                if d > 0:
+                    x, y = table[d >> 1]
+                    res = _add_affine(res, x, y, q, a)
+                else:
+                    x, y = table[(-d) >> 1]
+                    res = _add_affine(res, x, q - y, q, a)
+
+    for x, y in singles:
+        res = _add_affine(res, x, y, q, a)
+    return _add(res, acc, q, a)
+
+
+def multi_scalar_mul(curve: Curve, terms, gen_scalar: int = 0) -> Point:
+    if not is_supported(curve):
+        res = gen_scalar * curve.generator
+        for k, P in terms:
+            res = res + k * (P.base if isinstance(P, FixedBaseTable) else P)
+        return res
+    return to_point(curve, multi_scalar_mul_jacobian(curve, terms, gen_scalar))
+
+
+def is_identity(curve: Curve, terms, gen_scalar: int = 0) -> bool:
+    if not is_supported(curve):
+        return multi_scalar_mul(curve, terms, gen_scalar).is_infinity
+    return not multi_scalar_mul_jacobian(curve, terms, gen_scalar)[2]
+
+
+_decompressed = OrderedDict()  # Map (curve name, compressed encoding) to y
+_decompressed_lock = threading.Lock()
+_non_residues = {}  # Map field prime to quadratic non-residue (Tonelli-Shanks)
+
+
+# Square root of a modulo prime q, None if a is not a square
+def sqrt_mod(a: int, q: int) -> int | None:
+    a %= q
+    if a == 0:
+        return 0
+    if q % 4 == 3:  # NIST P-192/256/384/521: one exponentiation
+        y = pow(a, (q + 1) >> 2, q)
+        return y if y * y % q == a else None
+    # Tonelli-Shanks for q - 1 = s * 2^e (e.g. NIST P-224, e = 96)
+    s, e = q - 1, 0
+    while not s & 1:
+        s >>= 1
+        e += 1
+    z = _non_residues.get(q)
+    if z is None:
+        z = 2
+        while pow(z, (q - 1) >> 1, q) != q - 1:
+            z += 1
+        _non_residues[q] = z
+    y, b, g = pow(a, (s + 1) >> 1, q), pow(a, s, q), pow(z, s, q)
+    while b != 1:
+        # Least m with b^(2^m) == 1, a is not a square if there is none below e
+        m, t = 0, b
+        while t != 1:
+            t = t * t % q
+            m += 1
+            if m == e:
+                return None
+        gs = pow(g, 1 << (e - m - 1), q)
+        y, g = y * gs % q, gs * gs % q
+        b, e = b * g % q, m
+    return y
+
+
+def _recover_y(curve: Curve, encoded: bytes) -> int:
+    key = (curve.name, encoded)
+    with _decompressed_lock:
+        y = _decompressed.get(key)
+        if y is not None:
+            _decompressed.move_to_end(key)
+            return y
+    q = curve.field
+    x = int.from_bytes(encoded[1:], 'big')
+    rhs = (x * x * x + curve.a * x + curve.b) % q
+    y = sqrt_mod(rhs, q)
+    if x >= q or y is None:
+        raise ValueError("Point is not on curve")
+    if (y ^ encoded[0]) & 1:
+        y = (q - y) % q
+    with _decompressed_lock:
+        _decompressed[key] = y
+        if len(_decompressed) > DECOMPRESS_CACHE_SIZE:
+            _decompressed.popitem(last=False)
+    return y
+
+
+# Benchmarks of fresh points must not hit the cache
+def clear_decompressed():
+    with _decompressed_lock:
+        _decompressed.clear()
+
+
+def encode_point(curve: Curve, P: Point, compressed: bool = True) -> list:
+    if not is_supported(curve):
+        return curve.encode_point(P)
+    return curve.encode_point(P, compressed)
+
+
+# Decodes compressed or uncompressed point, ValueError if it is malformed or not on curve
+def decode_point(curve: Curve, encoded) -> Point:
+    if not is_supported(curve):
+        return curve.decode_point(encoded)
+    encoded = bytes(encoded)
+    size = (curve.size + 7) >> 3
+    if len(encoded) == 1 + size and encoded[0] in (2, 3):
+        return Point(int.from_bytes(encoded[1:], 'big'), _recover_y(curve, encoded), curve, False)
+    if len(encoded) == 1 + 2 * size and encoded[0] == 4:
+        q = curve.field
+        x, y = int.from_bytes(encoded[1:1 + size], 'big'), int.from_bytes(encoded[1 + size:], 'big')
+        if x >= q or y >= q or (y * y - x * x * x - curve.a * x - curve.b) % q:
+            raise ValueError("Point is not on curve")
+        return Point(x, y, curve, False)
+    raise ValueError("Invalid encoded point")
+
+
+# Same point in compressed/uncompressed form, only prefix and parity of y are needed to compress.
+# ValueError if encoding is malformed, or point is not on curve (checked only if it is decompressed)
+def convert_point(curve: Curve, encoded, compressed: bool) -> list:
+    if not is_supported(curve):
+        return encoded
+    size = (curve.size + 7) >> 3
+    if not (len(encoded) == 1 + size and encoded[0] in (2, 3) or len(encoded) == 1 + 2 * size and encoded[0] == 4):
+        raise ValueError("Invalid encoded point")
+    if bool(compressed) == (encoded[0] != 4):
+        return encoded
+    if compressed:
+        size = (len(encoded) - 1) // 2
+        return [2 | (encoded[-1] & 1), *encoded[1:1 + size]]
+    return [4, *encoded[1:], *_recover_y(curve, bytes(encoded)).to_bytes(len(encoded) - 1, 'big')]
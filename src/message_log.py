@@ -0,0 +1,245 @@
+"""
+Append-only message log of the server, one directory per group.
+
+Every relayed request (send_message/send_multi) is appended to the current segment of its group. Segments are
+preallocated files, memory-mapped for writes and zero-copy reads, named by global position of their first record.
+Record: body length (U32), sender length (U16), recipients length (U32), then body: sender, recipients (U16 length
+and name each), request encoded with BinaryCodec. Zero length marks the end of written data. Body is written before
+its header, so a torn write is never read as a record.
+
+Records are read as slices of the map: payloads of requests stay Opaque and go to binary connections uncopied.
+
+For every recipient the log keeps positions of records addressed to it (rebuilt from segments on startup) and
+a cursor - position of the next record it has not received yet. Index is rebuilt from record headers, requests
+are not decoded. Cursors are saved to cursors.json on disconnect of a member, on rotation and every save_interval
+seconds, so after a crash members get again the messages of the last interval (delivery is at least once).
+When the group has more than max_segments segments, the oldest one is deleted.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+
+from constants import LOG_SEGMENT_SIZE, LOG_MAX_SEGMENTS, LOG_SAVE_INTERVAL
+from protocol import BinaryCodec
+
+RECORD_HEADER = struct.Struct('!IHI')
+NAME_HEADER = struct.Struct('!H')
+
+
+def _pack_names(names) -> bytes:
+    out = bytearray()
+    for name in names:
+        name = name.encode("utf-8")
+        out += NAME_HEADER.pack(len(name))
+        out += name
+    return bytes(out)
+
+
+def _unpack_names(data: bytes) -> list:
+    names, pos = [], 0
+    while pos < len(data):
+        (size,), pos = NAME_HEADER.unpack_from(data, pos), pos + NAME_HEADER.size
+        names.append(str(data[pos:pos + size], 'utf-8'))
+        pos += size
+    return names
+
+
+class Segment:
+    def __init__(self, path: str, base: int, size: int):
+        self.path = path
+        self.base = base  # Global position of first record
+        if not os.path.exists(path):
+            with open(path, 'wb') as fp:
+                fp.truncate(size)  # Sparse file, disk blocks are allocated on write
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.end = 0  # Offset after last record
+
+    # Records of segment: (offset, recipients), requests are not decoded. Sets end of segment
+    def scan(self):
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(self.map):
+            body_len, sender_len, recipients_len = RECORD_HEADER.unpack_from(self.map, offset)
+            if not body_len:
+                break
+            start = offset + RECORD_HEADER.size + sender_len
+            yield offset, _unpack_names(self.map[start:start + recipients_len])
+            offset += RECORD_HEADER.size + body_len
+        self.end = offset
+
+    # Sender, request and size of record. Payloads of request are Opaque slices of the map, not copies
+    def read(self, offset: int):
+        body_len, sender_len, recipients_len = RECORD_HEADER.unpack_from(self.map, offset)
+        start = offset + RECORD_HEADER.size
+        body = memoryview(self.map)[start:start + body_len]
+        return str(body[:sender_len], 'utf-8'), \
+            BinaryCodec.decode(body[sender_len + recipients_len:], opaque=True), RECORD_HEADER.size + body_len
+
+    # Returns offset of record, None if it doesn't fit. sender and recipients are encoded already
+    def append(self, sender: bytes, recipients: bytes, body: bytes) -> int | None:
+        offset = self.end
+        size = RECORD_HEADER.size + len(sender) + len(recipients) + len(body)
+        if offset + size > len(self.map):
+            return None
+        start = offset + RECORD_HEADER.size
+        self.map[start:start + len(sender)] = sender
+        start += len(sender)
+        self.map[start:start + len(recipients)] = recipients
+        self.map[start + len(recipients):offset + size] = body
+        RECORD_HEADER.pack_into(self.map, offset, size - RECORD_HEADER.size, len(sender), len(recipients))
+        self.end = offset + size
+        return offset
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:  # Slices of records are still queued for sending, map is closed when they are released
+            pass
+        self.file.close()
+
+
+class GroupLog:
+    """
+    Log of one group. Callers hold lock while appending and delivering, so records reach every recipient
+    in log order. Joining member gets no new messages until its stored ones are sent (Sessions.joining).
+    """
+
+    def __init__(self, path: str, segment_size: int = LOG_SEGMENT_SIZE, max_segments: int = LOG_MAX_SEGMENTS):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.lock = threading.RLock()
+        self.positions = {}  # Map recipient to sorted positions of records addressed to it
+        self.cursors = {}  # Map recipient to position of first record it didn't receive
+        self.changed = False  # Cursors changed since last save
+
+        os.makedirs(path, exist_ok=True)
+        self.segments = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.log'):
+                segment = Segment(os.path.join(path, name), int(name[:-4]), segment_size)
+                for offset, recipients in segment.scan():
+                    self._index(segment.base + offset, recipients)
+                self.segments.append(segment)
+        if not self.segments:
+            self.segments.append(self._new_segment(0))
+
+        cursors_path = os.path.join(path, 'cursors.json')
+        if os.path.exists(cursors_path):
+            with open(cursors_path, 'r') as fp:
+                self.cursors = json.load(fp)
+
+    def _new_segment(self, base: int) -> Segment:
+        return Segment(os.path.join(self.path, f"{base:020d}.log"), base, self.segment_size)
+
+    def _index(self, position: int, recipients: list):
+        for recipient in recipients:
+            self.positions.setdefault(recipient, []).append(position)
+
+    # Returns position of record, None if request is larger than segment. recipients - members of group
+    # the request is addressed to, caller checks them
+    def append(self, sender: str, request: dict, recipients: list) -> int | None:
+        sender, names, body = sender.encode("utf-8"), _pack_names(recipients), BinaryCodec.encode(request)
+        segment = self.segments[-1]
+        offset = segment.append(sender, names, body)
+        if offset is None:
+            if RECORD_HEADER.size + len(sender) + len(names) + len(body) > self.segment_size:
+                return None
+            segment = self._rotate()
+            offset = segment.append(sender, names, body)
+        position = segment.base + offset
+        self._index(position, recipients)
+        return position
+
+    def _rotate(self) -> Segment:
+        segment = self._new_segment(self.segments[-1].base + self.segments[-1].end)
+        self.segments.append(segment)
+        while len(self.segments) > self.max_segments:
+            # Retention: records of the oldest segment are lost for recipients that didn't get them
+            oldest = self.segments.pop(0)
+            oldest.close()
+            os.remove(oldest.path)
+        start = self.segments[0].base
+        for recipient, positions in list(self.positions.items()):
+            del positions[:bisect_left(positions, start)]
+            if not positions:
+                del self.positions[recipient]
+        self.save()
+        return segment
+
+    def read(self, position: int):
+        for segment in reversed(self.segments):
+            if segment.base <= position:
+                return segment.read(position - segment.base)
+        raise KeyError(f"Position {position} is out of retained log")
+
+    # Number of records addressed to recipient, that it didn't receive
+    def pending(self, recipient: str) -> int:
+        positions = self.positions.get(recipient, [])
+        return len(positions) - bisect_left(positions, self.cursors.get(recipient, 0))
+
+    # Records addressed to recipient, that it didn't receive: (position, sender, request).
+    # max_size - bytes of records to return (at least one record), None - all of them
+    def backlog(self, recipient: str, max_size: int = None) -> list:
+        positions = self.positions.get(recipient, [])
+        records, size = [], 0
+        for i in range(bisect_left(positions, self.cursors.get(recipient, 0)), len(positions)):
+            if max_size is not None and size >= max_size:
+                break
+            sender, request, record_size = self.read(positions[i])
+            records.append((positions[i], sender, request))
+            size += record_size
+        return records
+
+    def delivered(self, recipient: str, position: int):
+        self.cursors[recipient] = max(self.cursors.get(recipient, 0), position + 1)
+        self.changed = True
+
+    def save(self):
+        with self.lock:
+            self.changed = False
+            tmp_path = os.path.join(self.path, 'cursors.json.tmp')
+            with open(tmp_path, 'w') as fp:
+                json.dump(self.cursors, fp)
+            os.replace(tmp_path, os.path.join(self.path, 'cursors.json'))
+
+    def close(self):
+        self.save()
+        for segment in self.segments:
+            segment.close()
+
+
+class MessageLog:
+    # Logs of all groups in root directory, opened on first use. Changed cursors are saved every save_interval seconds
+
+    def __init__(self, root: str, segment_size: int = LOG_SEGMENT_SIZE, max_segments: int = LOG_MAX_SEGMENTS,
+                 save_interval: float = LOG_SAVE_INTERVAL):
+        self.root = root
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.save_interval = save_interval
+        self.groups = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def group(self, group_name: str) -> GroupLog:
+        with self.lock:
+            log = self.groups.get(group_name)
+            if log is None:
+                # Directory name is hex of group name, so any group name is a valid path
+                path = os.path.join(self.root, group_name.encode("utf-8").hex())
+                log = self.groups[group_name] = GroupLog(path, self.segment_size, self.max_segments)
+            return log
+
+    def run(self):
+        while True:
+            time.sleep(self.save_interval)
+            with self.lock:
+                logs = list(self.groups.values())
+            for log in logs:
+                if log.changed:
+                    log.save()
@@ -0,0 +1,246 @@
+"""
+Runtime metrics and sampling profiler.
+
+registry collects counters, latency histograms and gauges (functions called on render) of this process and renders
+them in Prometheus text format. start() exposes them on a local HTTP endpoint (/metrics) and/or prints them
+to log periodically.
+
+Profiler is opt-in: it samples stacks of threads that are inside a profiled region (request handling, signcryption
+functions) and keeps counts of collapsed stacks ("region;file:function;... count", input of flamegraph tools).
+Collapsed stacks are served at /profile and written to a file.
+"""
+import functools
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples
+PROFILE_WRITE_INTERVAL = 10  # Seconds between writes of collapsed stacks to file
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format(name: str, labels: tuple) -> str:
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # Map (name, labels) to value
+        self.histograms = {}  # Map (name, labels) to Histogram
+        self.gauges = {}  # Map name to function returning {labels: value}, labels as tuple of (key, value)
+
+    def inc(self, name: str, value: int = 1, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name: str, function):
+        self.gauges[name] = function
+
+    def timer(self, name: str, **labels):
+        return _Timer(self, name, labels)
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{_format(name, labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                total = 0
+                for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), histogram.counts):
+                    total += count
+                    lines.append(f"{_format(name + '_bucket', labels + (('le', bound),))} {total}")
+                lines.append(f"{_format(name + '_sum', labels)} {histogram.sum:.6f}")
+                lines.append(f"{_format(name + '_count', labels)} {histogram.count}")
+        for name, function in sorted(self.gauges.items()):
+            for labels, value in sorted(function().items()):
+                lines.append(f"{_format(name, labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics: Metrics, name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+registry = Metrics()
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = PROFILE_INTERVAL, path: str = None):
+        self.interval = interval
+        self.path = path
+        self.regions = {}  # Map thread id to name of outermost region it is in
+        self.stacks = Counter()  # Map collapsed stack to number of samples
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def enter(self, name: str) -> bool:
+        thread_id = threading.get_ident()
+        if thread_id in self.regions:  # Nested region is part of the outer one
+            return False
+        self.regions[thread_id] = name
+        return True
+
+    def leave(self):
+        self.regions.pop(threading.get_ident(), None)
+
+    def sample(self):
+        frames = sys._current_frames()
+        for thread_id, name in list(self.regions.items()):
+            frame = frames.get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            stack.append(name)
+            with self.lock:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        with self.lock:
+            return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def write(self):
+        with open(self.path + '.tmp', 'w') as fp:
+            fp.write(self.collapsed())
+        os.replace(self.path + '.tmp', self.path)
+
+    def run(self):
+        last_write = time.perf_counter()
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+            if self.path is not None and time.perf_counter() - last_write >= PROFILE_WRITE_INTERVAL:
+                self.write()
+                last_write = time.perf_counter()
+
+
+profiler = None  # SamplingProfiler, when enabled
+
+
+class _Region:
+    __slots__ = ('name', 'entered')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.entered = profiler is not None and profiler.enter(self.name)
+
+    def __exit__(self, *exc):
+        if self.entered:
+            profiler.leave()
+
+
+# Code in region is sampled by profiler, if it is enabled
+def region(name: str) -> _Region:
+    return _Region(name)
+
+
+# Decorator: calls are timed to histogram `metric` with label fn=<function name> and profiled as region
+def instrumented(metric: str):
+    def decorator(function):
+        name = function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with region(name):
+                    return function(*args, **kwargs)
+            finally:
+                registry.observe(metric, time.perf_counter() - start, fn=name)
+        return wrapper
+    return decorator
+
+
+# http.server is imported only when endpoint is enabled, it is slow to import
+def _serve(port: int):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = registry.render()
+            elif self.path == '/profile' and profiler is not None:
+                body = profiler.collapsed()
+            else:
+                self.send_error(404)
+                return
+            body = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def _dump(interval: float):
+    while True:
+        time.sleep(interval)
+        print(f"[INFO] Metrics:\n{registry.render()}", end='')
+
+
+def start(port: int = None, interval: float = None, profile_path: str = None):
+    """
+    port - serve /metrics (and /profile) on 127.0.0.1:port, interval - print metrics every interval seconds,
+    profile_path - enable sampling profiler, collapsed stacks are written to this file.
+    """
+    global profiler
+    if profile_path is not None:
+        profiler = SamplingProfiler(path=profile_path)
+    if port is not None:
+        _serve(port)
+        print(f"[INFO] Metrics on http://127.0.0.1:{port}/metrics")
+    if interval:
+        threading.Thread(target=_dump, args=(interval,), daemon=True).start()
@@ -0,0 +1,136 @@
+"""
+Coalesced presence of group members. Joins and leaves are collected per group and sent to members of the group
+once per window as one 'presence' message, encoded once per codec of connections.
+Joining member gets the member lists as of the last presence message (encoded once until the next one) and changes
+collected since then, so it gets no presence message before its success response. If presence messages were sent
+while its stored messages were sent, their changes are added to its changes.
+"""
+import threading
+import time
+
+import metrics
+from protocol import pre_encode
+
+PRESENCE_WINDOW = 0.05  # Seconds to collect joins and leaves of a group for one presence message
+
+
+class GroupPresence:
+    __slots__ = ('lock', 'members', 'joined', 'left', 'snapshot')
+
+    def __init__(self):
+        self.lock = threading.Lock()  # Held while members of group change or presence is sent to them
+        # Online members as of last presence message: username -> public key. Every presence message replaces it,
+        # so members seen by joining member stay as they were
+        self.members = {}
+        self.joined = {}  # Joined since last presence message: username -> public key
+        self.left = set()  # Left since last presence message
+        self.snapshot = None  # (members, offline) fields of success message, None - changed since encoded
+
+    # Presence message of changes since last one
+    def delta(self) -> dict:
+        return {'action': 'presence', 'joined': self.joined, 'left': sorted(self.left)}
+
+
+class Presence:
+    """
+    database - offline members are listed from it, if offline is True (messages are stored for them).
+    Snapshot of offline members is refreshed with the next presence message of the group.
+    call - runs flush in thread of connections (asyncio engine: loop.call_soon_threadsafe), None - in flusher thread.
+    """
+
+    def __init__(self, curve, database, sessions, send_to, window: float = PRESENCE_WINDOW, offline: bool = False,
+                 call=None):
+        self.curve = curve
+        self.database = database
+        self.sessions = sessions
+        self.send_to = send_to  # Server.send_to
+        self.window = window
+        self.offline = offline
+        self.call = call
+        self.lock = threading.Lock()  # Guards groups and dirty, never held while taking lock of group
+        self.groups = {}  # Map group name to GroupPresence
+        self.dirty = set()  # Names of groups with changes since last flush
+        self.changed = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def group(self, group_name: str) -> GroupPresence:
+        with self.lock:
+            group = self.groups.get(group_name)
+            if group is None:
+                group = self.groups[group_name] = GroupPresence()
+            return group
+
+    def _mark(self, group_name: str):
+        with self.lock:
+            self.dirty.add(group_name)
+        self.changed.set()
+
+    # Member lists for success message of joining member: (members, offline), caller holds group.lock
+    def snapshot(self, group_name: str, group: GroupPresence) -> tuple:
+        if group.snapshot is None:
+            offline = {}
+            if self.offline:
+                offline = {usr: self.database.get_public_key(usr)
+                           for usr in self.database.get_group_members(group_name) if usr not in group.members}
+            group.snapshot = (pre_encode(self.curve, 'members', group.members),
+                              pre_encode(self.curve, 'members', offline))
+            metrics.registry.inc('presence_snapshots_total')
+        return group.snapshot
+
+    # Adds joining member, returns presence message for it with changes since its snapshot. seen - group.members
+    # when snapshot was taken, None - now. Caller holds group.lock
+    def join(self, group_name: str, group: GroupPresence, username: str, public_key, seen: dict = None) -> dict:
+        group.left.discard(username)
+        group.joined[username] = public_key
+        self._mark(group_name)
+        if seen is None or seen is group.members:
+            return group.delta()
+        members = {usr: key for usr, key in group.members.items() if usr not in group.left}
+        members.update(group.joined)
+        return {'action': 'presence', 'joined': {usr: key for usr, key in members.items() if seen.get(usr) != key},
+                'left': sorted(usr for usr in seen if usr not in members)}
+
+    def leave(self, group_name: str, username: str):
+        group = self.group(group_name)
+        with group.lock:
+            group.joined.pop(username, None)
+            group.left.add(username)
+        self._mark(group_name)
+
+    # Sends changes of group now, if member joined after last presence message, so other members know its key
+    # before they get its messages. Called by member's own handler, after its join
+    def announce(self, group_name: str, username: str):
+        group = self.group(group_name)
+        if username in group.joined:
+            self._flush_group(group_name, group)
+
+    # Sends collected changes of every group to its members
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        for group_name in dirty:
+            self._flush_group(group_name, self.group(group_name))
+
+    def _flush_group(self, group_name: str, group: GroupPresence):
+        with group.lock:
+            if not group.joined and not group.left:
+                return
+            message = group.delta()
+            members = {usr: key for usr, key in group.members.items() if usr not in group.left}
+            members.update(group.joined)
+            group.members, group.joined, group.left, group.snapshot = members, {}, set(), None
+            frames = {}  # Message is encoded once per codec
+            with metrics.registry.timer('broadcast_seconds', event='presence'):
+                for sock in self.sessions.get_group_sockets(group_name):
+                    self.send_to(sock, message, frames)
+        metrics.registry.inc('presence_changes_total', len(message['joined']) + len(message['left']))
+
+    def run(self):
+        while True:
+            self.changed.wait()
+            time.sleep(self.window)  # Changes of the window go to one message
+            self.changed.clear()
+            if self.call is not None:
+                self.call(self.flush)
+            else:
+                self.flush()
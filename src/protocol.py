@@ -0,0 +1,922 @@
+"""
+Client-server wire protocol.
+
+Connection starts with a handshake: client sends MAGIC + number of codecs + codec ids in order of preference,
+server answers MAGIC + chosen codec id + length-prefixed (1 byte) name of its curve. Client checks that its keys
+are on that curve. After that every message is a frame: 4-byte big-endian payload length
+followed by the payload, encoded by the chosen codec (JSON or compact binary).
+Codec id with COMPRESSED_POINTS bit set means that points are sent compressed (SEC1, 02/03 | x) in this connection,
+otherwise uncompressed (04 | x | y). Points of outgoing messages are converted to the form of the connection.
+
+Messages are dicts with 'action' (or 'status' for server responses) key. In memory points are lists of ints
+(as returned by ecmath.encode_point) and signcrypted messages are (R, C, s) tuples with C as bytes.
+Server connections decode payload fields of binary messages (bytes, signcrypted) to Opaque slices of the frame:
+server only routes them, and they are sent on in wire encoding, without being copied (scatter/gather writes).
+"""
+import asyncio
+import itertools
+import json
+import socket
+import struct
+import tempfile
+import threading
+from collections import deque
+from base64 import b64encode, b64decode
+
+from constants import CURVE, BUFF_SIZE, MAX_FRAME_SIZE, SEND_QUEUE_LIMIT, SEND_SPILL_LIMIT, SLOW_CONSUMER_POLICY
+from ecmath import convert_point, curve_by_name
+import metrics
+
+MAGIC = b'SGC2'
+FRAME_HEADER = struct.Struct('!I')
+
+JSON_CODEC = 0
+BINARY_CODEC = 1
+CODEC_NAMES = {'json': JSON_CODEC, 'binary': BINARY_CODEC}
+COMPRESSED_POINTS = 0x80  # Flag of codec id
+SLOW_CONSUMER_POLICIES = ('drop', 'disconnect', 'spill')
+WRITE_BATCH_SIZE = 1024 * 1024  # Max bytes taken from outbound queue for one write
+CLOSE_TIMEOUT = 5  # Seconds close() waits for writer to send queued frames
+SPLICE_SIZE = 1024  # Opaque fields from this size are sent as separate buffers instead of being copied to frame
+IOV_MAX = 1024  # Max buffers of one sendmsg()
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Frame for other connection was not queued, because outbound queue of its receiver is full
+class SlowConsumerError(ConnectionError):
+    def __init__(self, message: str, evicted: bool):
+        super().__init__(message)
+        self.evicted = evicted  # Receiver was disconnected
+
+
+# Message schemas: type id -> (key, value, fields). Field kinds:
+#   str - utf-8 string, int - non-negative integer, point - encoded point, bytes - raw bytes,
+#   signcrypted - (R, C, s) tuple, members - dict username -> point, wraps - dict username -> signcrypted,
+#   names - list of str
+SCHEMAS = {
+    # Client -> server
+    1: ('action', 'authentication', [('username', 'str'), ('group_name', 'str'), ('commitment', 'point')]),
+    2: ('action', 'prove', [('zkksp_response', 'int')]),
+    3: ('action', 'send_message', [('group', 'str'), ('reciever', 'str'), ('signcrypted_msg', 'signcrypted')]),
+    4: ('action', 'send_multi', [('group', 'str'), ('payload', 'bytes'), ('wraps', 'wraps')]),
+    # File transfer: start with key wraps, chunks, end with signatures of chunk chain (signcryption.StreamSigncrypter)
+    5: ('action', 'file_start', [('group', 'str'), ('stream', 'int'), ('name', 'str'), ('size', 'int'),
+                                 ('wraps', 'wraps')]),
+    6: ('action', 'file_chunk', [('stream', 'int'), ('data', 'bytes')]),
+    7: ('action', 'file_end', [('stream', 'int'), ('wraps', 'wraps')]),
+    # Server -> client
+    16: ('status', 'challenge', [('challenge', 'int')]),
+    # offline - members that are not connected, offline_delivery - 1 if server stores messages for them,
+    # backlog - number of stored messages for this user. They are sent right after success, with messages stored
+    # meanwhile (ones that can't be converted for connection are skipped), then presence changes since success
+    17: ('status', 'success', [('members', 'members'), ('offline', 'members'), ('offline_delivery', 'int'),
+                               ('backlog', 'int')]),
+    18: ('status', 'denied', [('reason', 'str')]),
+    19: ('action', 'msg', [('sender', 'str'), ('signcrypted_msg', 'signcrypted')]),
+    22: ('action', 'multi_msg', [('sender', 'str'), ('payload', 'bytes'), ('signcrypted_msg', 'signcrypted')]),
+    23: ('action', 'file_offer', [('sender', 'str'), ('stream', 'int'), ('name', 'str'), ('size', 'int'),
+                                  ('signcrypted_msg', 'signcrypted')]),
+    24: ('action', 'file_data', [('sender', 'str'), ('stream', 'int'), ('data', 'bytes')]),
+    25: ('action', 'file_done', [('sender', 'str'), ('stream', 'int'), ('signcrypted_msg', 'signcrypted')]),
+    # Changes of group members since last presence message, sent periodically (applying it again changes nothing)
+    26: ('action', 'presence', [('joined', 'members'), ('left', 'names')]),
+}
+_TYPE_IDS = {(key, value): type_id for type_id, (key, value, _) in SCHEMAS.items()}
+
+
+def _message_type(message: dict) -> int:
+    key = 'action' if 'action' in message else 'status'
+    try:
+        return _TYPE_IDS[(key, message.get(key))]
+    except (KeyError, TypeError):  # TypeError: value from JSON is not hashable
+        raise ProtocolError(f"Unknown message: {key}={message.get(key)!r}")
+
+
+def _to_json(kind: str, value):
+    if kind == 'signcrypted':
+        R, C, s = value
+        return [R, b64encode(C).decode(), s]
+    elif kind == 'bytes':
+        return b64encode(value).decode()
+    elif kind == 'wraps':
+        return {recv_id: _to_json('signcrypted', wrap) for recv_id, wrap in value.items()}
+    return value
+
+
+# Value of field from JSON. ProtocolError if it has other type than its kind or binary codec can't encode it
+def _from_json(kind: str, value):
+    if kind == 'str':
+        if not isinstance(value, str) or len(value.encode()) > 0xFFFF:
+            raise ProtocolError(f"Invalid {kind} in JSON message")
+        return value
+    elif kind == 'int':
+        if type(value) is not int or value < 0 or value.bit_length() > 8 * 0xFFFF:
+            raise ProtocolError(f"Invalid {kind} in JSON message")
+        return value
+    elif kind == 'point':
+        if not isinstance(value, list) or len(value) > 0xFF or not all(type(b) is int and 0 <= b <= 0xFF
+                                                                        for b in value):
+            raise ProtocolError(f"Invalid {kind} in JSON message")
+        return value
+    elif kind == 'bytes':
+        if not isinstance(value, str):
+            raise ProtocolError(f"Invalid {kind} in JSON message")
+        return b64decode(value, validate=True)
+    elif kind == 'signcrypted':
+        if not isinstance(value, list) or len(value) != 3:
+            raise ProtocolError(f"Invalid {kind} in JSON message")
+        R, C, s = value
+        return _from_json('point', R), _from_json('bytes', C), _from_json('int', s)
+    elif kind in ('members', 'wraps'):
+        if not isinstance(value, dict):
+            raise ProtocolError(f"Invalid {kind} in JSON message")
+        item_kind = 'point' if kind == 'members' else 'signcrypted'
+        return {_from_json('str', username): _from_json(item_kind, item) for username, item in value.items()}
+    elif kind == 'names':
+        if not isinstance(value, list):
+            raise ProtocolError(f"Invalid {kind} in JSON message")
+        return [_from_json('str', name) for name in value]
+    raise ProtocolError(f"Unknown field kind {kind}")
+
+
+class JsonCodec:
+    code = JSON_CODEC
+
+    @staticmethod
+    def encode(message: dict) -> bytes:
+        _, _, fields = SCHEMAS[_message_type(message)]
+        data = dict(message)
+        for name, kind in fields:
+            data[name] = _to_json(kind, data[name])
+        return json.dumps(data).encode()
+
+    @staticmethod
+    def decode(payload) -> dict:
+        try:
+            data = json.loads(bytes(payload).decode())
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise ProtocolError(f"Malformed JSON message: {e}")
+        if not isinstance(data, dict):
+            raise ProtocolError("JSON message is not an object")
+        _, _, fields = SCHEMAS[_message_type(data)]
+        try:
+            for name, kind in fields:
+                data[name] = _from_json(kind, data[name])
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise ProtocolError(f"Malformed JSON message: {e}")
+        return data
+
+
+class BinaryCodec:
+    code = BINARY_CODEC
+
+    _U8 = struct.Struct('!B')
+    _U16 = struct.Struct('!H')
+    _U32 = struct.Struct('!I')
+
+    @classmethod
+    def _pack(cls, out: bytearray, kind: str, value):
+        if isinstance(value, Opaque):
+            out += value.data
+        elif kind == 'str':
+            value = value.encode()
+            out += cls._U16.pack(len(value))
+            out += value
+        elif kind == 'int':
+            value = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+            out += cls._U16.pack(len(value))
+            out += value
+        elif kind == 'point':
+            out += cls._U8.pack(len(value))
+            out += bytes(value)
+        elif kind == 'bytes':
+            out += cls._U32.pack(len(value))
+            out += value
+        elif kind == 'signcrypted':
+            R, C, s = value
+            cls._pack(out, 'point', R)
+            cls._pack(out, 'bytes', C)
+            cls._pack(out, 'int', s)
+        elif kind == 'members':
+            out += cls._U32.pack(len(value))
+            for username, public_key in value.items():
+                cls._pack(out, 'str', username)
+                cls._pack(out, 'point', public_key)
+        elif kind == 'wraps':
+            out += cls._U32.pack(len(value))
+            for username, wrap in value.items():
+                cls._pack(out, 'str', username)
+                cls._pack(out, 'signcrypted', wrap)
+        elif kind == 'names':
+            out += cls._U32.pack(len(value))
+            for name in value:
+                cls._pack(out, 'str', name)
+
+    # Position after field of kind 'bytes' or 'signcrypted', which is not decoded
+    @classmethod
+    def _skip(cls, data: memoryview, pos: int, kind: str) -> int:
+        if kind == 'signcrypted':
+            (size,), pos = cls._U8.unpack_from(data, pos), pos + 1  # R
+            pos += size
+            (size,), pos = cls._U32.unpack_from(data, pos), pos + 4  # C
+            pos += size
+            (size,), pos = cls._U16.unpack_from(data, pos), pos + 2  # s
+            return pos + size
+        (size,), pos = cls._U32.unpack_from(data, pos), pos + 4
+        return pos + size
+
+    @classmethod
+    def _unpack(cls, data: memoryview, pos: int, kind: str, opaque: bool = False):
+        if opaque and kind in ('bytes', 'signcrypted'):
+            end = cls._skip(data, pos, kind)
+            compressed = data[pos + 1] != 4 if kind == 'signcrypted' else None  # SEC1 tag of R, 04 - uncompressed
+            return Opaque(data[pos:end], kind, compressed), end
+        elif kind == 'str':
+            (size,), pos = cls._U16.unpack_from(data, pos), pos + 2
+            return str(data[pos:pos + size], 'utf-8'), pos + size
+        elif kind == 'int':
+            (size,), pos = cls._U16.unpack_from(data, pos), pos + 2
+            return int.from_bytes(data[pos:pos + size], 'big'), pos + size
+        elif kind == 'point':
+            (size,), pos = cls._U8.unpack_from(data, pos), pos + 1
+            return list(data[pos:pos + size]), pos + size
+        elif kind == 'bytes':
+            (size,), pos = cls._U32.unpack_from(data, pos), pos + 4
+            return bytes(data[pos:pos + size]), pos + size
+        elif kind == 'signcrypted':
+            R, pos = cls._unpack(data, pos, 'point')
+            C, pos = cls._unpack(data, pos, 'bytes')
+            s, pos = cls._unpack(data, pos, 'int')
+            return (R, C, s), pos
+        elif kind == 'members':
+            (count,), pos = cls._U32.unpack_from(data, pos), pos + 4
+            members = {}
+            for _ in range(count):
+                username, pos = cls._unpack(data, pos, 'str')
+                members[username], pos = cls._unpack(data, pos, 'point')
+            return members, pos
+        elif kind == 'wraps':
+            (count,), pos = cls._U32.unpack_from(data, pos), pos + 4
+            wraps = {}
+            for _ in range(count):
+                username, pos = cls._unpack(data, pos, 'str')
+                wraps[username], pos = cls._unpack(data, pos, 'signcrypted', opaque)
+            return wraps, pos
+        elif kind == 'names':
+            (count,), pos = cls._U32.unpack_from(data, pos), pos + 4
+            names = []
+            for _ in range(count):
+                name, pos = cls._unpack(data, pos, 'str')
+                names.append(name)
+            return names, pos
+
+    @classmethod
+    def encode(cls, message: dict) -> bytes:
+        return b''.join(cls.encode_parts(message))
+
+    # Encoded message as list of buffers: large Opaque fields are not copied
+    @classmethod
+    def encode_parts(cls, message: dict) -> list:
+        type_id = _message_type(message)
+        _, _, fields = SCHEMAS[type_id]
+        out = bytearray(cls._U8.pack(type_id))
+        parts = [out]
+        for name, kind in fields:
+            value = message[name]
+            if isinstance(value, Opaque) and len(value.data) >= SPLICE_SIZE:
+                out = bytearray()
+                parts += (value.data, out)
+            else:
+                cls._pack(out, kind, value)
+        return [part for part in parts if part]
+
+    # opaque - bytes and signcrypted fields are not decoded, they are returned as Opaque
+    @classmethod
+    def decode(cls, payload, opaque: bool = False) -> dict:
+        data = memoryview(payload)
+        try:
+            key, value, fields = SCHEMAS[data[0]]
+        except (KeyError, IndexError):
+            raise ProtocolError("Unknown binary message type")
+        message = {key: value}
+        pos = 1
+        try:
+            for name, kind in fields:
+                message[name], pos = cls._unpack(data, pos, kind, opaque)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise ProtocolError(f"Malformed binary message: {e}")
+        if pos != len(data):
+            raise ProtocolError("Trailing bytes in binary message")
+        return message
+
+
+class Opaque:
+    """
+    Field in its binary wire encoding: payload of received message (kind 'bytes' or 'signcrypted', data is
+    a memoryview of the frame) or field encoded once for many messages (pre_encode()).
+    Binary connections send it as it is, if its points are in their form, others decode it.
+    compressed - form of its points, None if there are no points.
+    """
+    __slots__ = ('data', 'kind', 'compressed')
+
+    def __init__(self, data: memoryview, kind: str, compressed: bool | None = None):
+        self.data = data
+        self.kind = kind
+        self.compressed = compressed
+
+    def value(self):
+        return BinaryCodec._unpack(self.data, 0, self.kind)[0]
+
+
+CODECS = {JSON_CODEC: JsonCodec, BINARY_CODEC: BinaryCodec}
+# Fields converted for connection: type id -> fields with points or opaque payloads
+_POINT_KINDS = ('point', 'signcrypted', 'members', 'wraps')
+_CONVERTED_FIELDS = {type_id: [(name, kind) for name, kind in fields if kind in _POINT_KINDS or kind == 'bytes']
+                     for type_id, (_, _, fields) in SCHEMAS.items()}
+
+
+# Value of field for connection with given point form. Opaque values are decoded only if they can't be sent as
+# they are: to JSON connection or with points in other form
+def _convert(curve, kind: str, value, compressed: bool, binary: bool):
+    if isinstance(value, Opaque):
+        if binary and value.compressed in (None, compressed):
+            return value
+        value = value.value()
+    if kind == 'bytes':
+        return value
+    elif kind == 'point':
+        return convert_point(curve, value, compressed)
+    elif kind == 'signcrypted':
+        R, C, s = value
+        return convert_point(curve, R, compressed), C, s
+    return {username: _convert(curve, 'point' if kind == 'members' else 'signcrypted', item, compressed, binary)
+            for username, item in value.items()}
+
+
+# Field encoded once, to be sent in many messages (e.g. member list of a group)
+def pre_encode(curve, kind: str, value, compressed: bool = True) -> Opaque:
+    out = bytearray()
+    BinaryCodec._pack(out, kind, _convert(curve, kind, value, compressed, True))
+    return Opaque(memoryview(bytes(out)), kind, compressed if kind in _POINT_KINDS else None)
+
+
+# Frame of message sent to many connections, frames - cache of its frames by codec id
+def _shared_frame(codec, message: dict, frames: dict) -> list:
+    frame = frames.get(codec.code)
+    if frame is None:
+        frame = frames[codec.code] = codec.frame(message)
+    return frame
+
+
+# Frames of messages as one list of buffers and number of messages that can't be encoded (see PointCodec._convert)
+def _frames(codec, messages) -> tuple:
+    parts, skipped = [], 0
+    for message in messages:
+        try:
+            parts += codec.frame(message)
+        except ProtocolError:
+            skipped += 1
+    return parts, skipped
+
+
+class PointCodec:
+    """
+    Codec of a connection: JSON or binary codec, points of outgoing messages are converted to compressed
+    or uncompressed form. Received points are left as they are, decoding accepts both forms.
+    opaque - binary messages are decoded with payload fields left as Opaque (server connections).
+    """
+
+    def __init__(self, code: int, curve=CURVE, opaque: bool = False):
+        self.code = code
+        self.codec = CODECS[code & ~COMPRESSED_POINTS]
+        self.compressed = bool(code & COMPRESSED_POINTS)
+        self.curve = curve
+        self.opaque = opaque and self.codec is BinaryCodec
+
+    # ProtocolError if message has a point that can't be converted (malformed or not on curve)
+    def _convert(self, message: dict) -> dict:
+        fields = _CONVERTED_FIELDS[_message_type(message)]
+        if fields:
+            message = dict(message)
+            binary = self.codec is BinaryCodec
+            try:
+                for name, kind in fields:
+                    message[name] = _convert(self.curve, kind, message[name], self.compressed, binary)
+            except ValueError as e:
+                raise ProtocolError(f"Invalid point in '{name}': {e}")
+        return message
+
+    def encode(self, message: dict) -> bytes:
+        return self.codec.encode(self._convert(message))
+
+    # Frame of message as list of buffers (see BinaryCodec.encode_parts)
+    def frame(self, message: dict) -> list:
+        message = self._convert(message)
+        parts = self.codec.encode_parts(message) if self.codec is BinaryCodec else [self.codec.encode(message)]
+        return [FRAME_HEADER.pack(sum(len(part) for part in parts)) + parts[0], *parts[1:]]
+
+    def decode(self, payload) -> dict:
+        if self.opaque:
+            return BinaryCodec.decode(payload, opaque=True)
+        return self.codec.decode(payload)
+
+
+def codec_for(code: int, curve=CURVE, opaque: bool = False) -> PointCodec:
+    if code & ~COMPRESSED_POINTS not in CODECS:
+        raise ProtocolError(f"Unknown codec {code}")
+    return PointCodec(code, curve, opaque)
+
+
+# Codec ids offered by client: every codec with compressed points first, if compressed
+def offered_codes(codecs, compressed: bool = True) -> bytes:
+    if not compressed:
+        return bytes(codecs)
+    return bytes(code for codec in codecs for code in (codec | COMPRESSED_POINTS, codec))
+
+
+def encode_frame(payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+# sendall() of a list of buffers: they are written with scatter/gather sendmsg(), not joined
+def _sendall(sock: socket.socket, buffers: list):
+    if len(buffers) == 1 or not hasattr(sock, 'sendmsg'):
+        sock.sendall(buffers[0] if len(buffers) == 1 else b''.join(buffers))
+        return
+    views = deque(memoryview(buffer) for buffer in buffers if len(buffer))
+    while views:
+        sent = sock.sendmsg(list(itertools.islice(views, IOV_MAX)))
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.popleft())
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+class FrameReader:
+    """
+    Buffers received bytes and splits them into frame payloads, any number of frames per feed().
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data: bytes) -> list:
+        self.buffer += data
+        frames = []
+        pos = 0
+        with memoryview(self.buffer) as view:  # Payload is copied once, slice of bytearray would copy it twice
+            while len(view) - pos >= FRAME_HEADER.size:
+                (size,) = FRAME_HEADER.unpack_from(view, pos)
+                if size > self.max_frame_size:
+                    raise ProtocolError(f"Frame too large: {size} bytes")
+                end = pos + FRAME_HEADER.size + size
+                if len(view) < end:
+                    break
+                frames.append(bytes(view[pos + FRAME_HEADER.size:end]))
+                pos = end
+        if pos:
+            del self.buffer[:pos]
+        return frames
+
+
+# Pick first codec offered by client that server supports
+def _choose_codec(header: bytes, offered: bytes, supported) -> int:
+    if header[:len(MAGIC)] != MAGIC:
+        raise ProtocolError("Client didn't start with protocol handshake")
+    for code in offered:
+        if code & ~COMPRESSED_POINTS in supported:
+            return code
+    raise ProtocolError("No common codec with client")
+
+
+def _handshake_answer(code: int, curve) -> bytes:
+    name = curve.name.encode()
+    return MAGIC + bytes([code, len(name)]) + name
+
+
+# Curve announced by server. Client with keys on other curve (expected) can't use the server
+def _server_curve(name: bytes, expected):
+    try:
+        curve = curve_by_name(name.decode())
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ProtocolError(f"Server uses unsupported curve: {e}")
+    if expected is not None and curve.name != expected.name:
+        raise ProtocolError(f"Server uses curve '{curve.name}', keys are on '{expected.name}'")
+    return curve
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be written to one connection. Not thread-safe, owner locks it.
+    Frames are lists of buffers (PointCodec.frame), get() returns a batch of buffers for one gathered write.
+
+    Own frames (answers to requests of the connection) are always queued. Frames from other connections (post())
+    over the limit are handled by policy: drop - frame is dropped, disconnect - receiver is evicted,
+    spill - this and later frames go to a temp file until writer catches up, evicted over spill_limit.
+    """
+
+    def __init__(self, limit: int = SEND_QUEUE_LIMIT, policy: str = SLOW_CONSUMER_POLICY,
+                 spill_limit: int = SEND_SPILL_LIMIT):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy '{policy}'")
+        self.limit = limit
+        self.policy = policy
+        self.spill_limit = spill_limit
+        self.frames = deque()
+        self.size = 0  # Bytes in memory
+        self.spill = None  # Temp file with frames queued after the ones in memory
+        self.spill_read = 0
+        self.spill_write = 0
+        self.closing = False  # Writer sends what is queued and stops
+        self.closed = False
+
+        # Metrics
+        self.peak = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def depth(self) -> int:
+        return self.size + self.spill_write - self.spill_read
+
+    # Returns False if frame was not queued
+    def put(self, frame: list, own: bool = True) -> bool:
+        if self.closed:
+            return False
+        size = sum(len(part) for part in frame)
+        if self.spill is None:
+            if own or self.size + size <= self.limit:
+                self.frames.extend(frame)
+                self.size += size
+                self.peak = max(self.peak, self.size)
+                return True
+            if self.policy == 'spill':
+                self.spill = tempfile.TemporaryFile(prefix='sgc-spill-')
+        if self.spill is not None and (own or self.spill_write - self.spill_read + size <= self.spill_limit):
+            self.spill.seek(self.spill_write)
+            self.spill.writelines(frame)
+            self.spill_write += size
+            self.spilled += size
+            self.peak = max(self.peak, self.depth())
+            return True
+        self.dropped += 1
+        return False
+
+    # Next buffers to write, None if queue is empty. Frames in memory go before spilled ones
+    def get(self) -> list | None:
+        if self.frames:
+            batch = [self.frames.popleft()]
+            size = len(batch[0])
+            while self.frames and size + len(self.frames[0]) <= WRITE_BATCH_SIZE:
+                batch.append(self.frames.popleft())
+                size += len(batch[-1])
+            self.size -= size
+            return batch
+        if self.spill is not None:
+            self.spill.seek(self.spill_read)
+            data = self.spill.read(min(WRITE_BATCH_SIZE, self.spill_write - self.spill_read))
+            self.spill_read += len(data)
+            if self.spill_read == self.spill_write:  # Writer caught up, back to memory
+                self.spill.close()
+                self.spill = None
+                self.spill_read = self.spill_write = 0
+            return [data]
+        return None
+
+    def clear(self):
+        self.closed = True
+        self.frames.clear()
+        self.size = 0
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+            self.spill_read = self.spill_write = 0
+
+    def stats(self) -> dict:
+        return {'queued': self.depth(), 'peak': self.peak, 'dropped': self.dropped, 'spilled': self.spilled}
+
+
+class Connection:
+    """
+    Message-level wrapper over a connected blocking socket. send() is thread-safe.
+    After start_writer() frames are written by writer thread from bounded outbound queue: send() waits while the
+    queue is full (backpressure for own handler), post() never waits (see OutboundQueue).
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.peername = sock.getpeername()
+        self.codec = None
+        self.reader = FrameReader()
+        self.pending = deque()  # Frames already received, but not returned by recv() yet
+        self.send_lock = threading.Lock()
+        self.outbound = None
+        self.writable = threading.Condition()  # Outbound queue changed
+        self.writing = False  # Writer thread is in sendall()
+
+    def _recv_exact(self, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError("Connection closed during handshake")
+            data += chunk
+        return bytes(data)
+
+    # Offer codecs (in order of preference) to server, returns chosen one. curve - curve of client's keys,
+    # None accepts any curve of server (codec.curve)
+    def client_handshake(self, codecs=(BINARY_CODEC, JSON_CODEC), compressed: bool = True, curve=None) -> int:
+        offered = offered_codes(codecs, compressed)
+        self.sock.sendall(MAGIC + bytes([len(offered)]) + offered)
+        answer = self._recv_exact(len(MAGIC) + 2)
+        if answer[:len(MAGIC)] != MAGIC or answer[-2] not in offered:
+            raise ProtocolError("Unexpected handshake answer from server")
+        self.codec = codec_for(answer[-2], _server_curve(self._recv_exact(answer[-1]), curve))
+        return self.codec.code
+
+    def server_handshake(self, supported=(BINARY_CODEC, JSON_CODEC), curve=CURVE) -> int:
+        header = self._recv_exact(len(MAGIC) + 1)
+        code = _choose_codec(header, self._recv_exact(header[-1]), supported)
+        self.codec = codec_for(code, curve, opaque=True)
+        self.sock.sendall(_handshake_answer(code, curve))
+        return code
+
+    def start_writer(self, limit: int = SEND_QUEUE_LIMIT, policy: str = SLOW_CONSUMER_POLICY,
+                     spill_limit: int = SEND_SPILL_LIMIT):
+        self.outbound = OutboundQueue(limit, policy, spill_limit)
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            with self.writable:
+                self.writing = False
+                data = self.outbound.get()
+                while data is None and not self.outbound.closing and not self.outbound.closed:
+                    self.writable.wait()
+                    data = self.outbound.get()
+                self.writing = data is not None
+                self.writable.notify_all()  # Senders waiting for space, close() waiting for writer
+                if data is None:
+                    return
+            try:
+                _sendall(self.sock, data)
+            except OSError:
+                self.evict()
+                return
+            metrics.registry.inc('bytes_out_total', sum(len(part) for part in data))
+
+    # wait - wait while outbound queue is over limit. False: frame is queued anyway, for sends under locks
+    # that other connections need (a stalled reader must not block them)
+    def _write(self, frame: list, wait: bool = True):
+        if self.outbound is None:
+            with self.send_lock:
+                _sendall(self.sock, frame)
+            metrics.registry.inc('bytes_out_total', sum(len(part) for part in frame))
+            return
+        with self.writable:
+            while wait and self.outbound.depth() >= self.outbound.limit and not self.outbound.closed:
+                self.writable.wait()
+            if not self.outbound.put(frame):
+                raise ConnectionResetError("Connection closed")
+            self.writable.notify_all()
+
+    def send(self, message: dict, wait: bool = True):
+        self._write(self.codec.frame(message), wait)
+
+    # Send messages with one write
+    def send_many(self, messages):
+        self._write([part for message in messages for part in self.codec.frame(message)])
+
+    # Messages encoded to one frame for send_frame(), messages that can't be encoded for connection
+    # are skipped. Returns (frame, number of skipped messages)
+    def encode_many(self, messages) -> tuple:
+        return _frames(self.codec, messages)
+
+    def send_frame(self, frame: list, wait: bool = True):
+        self._write(frame, wait)
+
+    # Send message of other connection, never waits. Raises SlowConsumerError if outbound queue is full.
+    # frames - cache of frames by codec id, when the same message is posted to many connections
+    def post(self, message: dict, frames: dict = None):
+        frame = self.codec.frame(message) if frames is None else _shared_frame(self.codec, message, frames)
+        if self.outbound is None:
+            self._write(frame)
+            return
+        with self.writable:
+            if self.outbound.closed:  # Receiver left or was evicted already, it is not a slow consumer
+                raise ConnectionResetError("Connection closed")
+            queued = self.outbound.put(frame, own=False)
+            self.writable.notify_all()
+        if not queued:
+            if self.outbound.policy == 'drop' and not self.outbound.closed:
+                raise SlowConsumerError("outbound queue is full, message dropped", False)
+            self.evict()
+            raise SlowConsumerError("outbound queue is full, disconnected", True)
+
+    # Drop queued frames and shut socket down, handler of connection sees it closed and cleans up
+    def evict(self):
+        if self.outbound is not None:
+            with self.writable:
+                self.outbound.clear()
+                self.writable.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def queue_stats(self) -> dict | None:
+        return self.outbound.stats() if self.outbound is not None else None
+
+    # Returns next message, None if connection closed
+    def recv(self) -> dict | None:
+        if not self._fill():
+            return None
+        return self.codec.decode(self.pending.popleft())
+
+    # Returns next message without consuming it, None if connection closed
+    def peek(self) -> dict | None:
+        if not self._fill():
+            return None
+        return self.codec.decode(self.pending[0])
+
+    def _fill(self) -> bool:
+        while not self.pending:
+            data = self.sock.recv(BUFF_SIZE)
+            if not data:
+                return False
+            metrics.registry.inc('bytes_in_total', len(data))
+            self.pending.extend(self.reader.feed(data))
+        return True
+
+    # Received, but not consumed bytes. With codec they let other process continue the connection (attach())
+    def detach(self) -> bytes:
+        return b''.join(encode_frame(frame) for frame in self.pending) + bytes(self.reader.buffer)
+
+    # Connection after handshake, handed over by other process
+    @classmethod
+    def attach(cls, sock: socket.socket, codec: int, buffered: bytes, curve=CURVE):
+        connection = cls(sock)
+        connection.codec = codec_for(codec, curve, opaque=True)
+        connection.pending.extend(connection.reader.feed(buffered))
+        return connection
+
+    def getpeername(self):
+        return self.peername
+
+    def close(self):
+        if self.outbound is not None:  # Let writer send queued frames (e.g. reason of denial)
+            with self.writable:
+                self.outbound.closing = True
+                self.writable.notify_all()
+                self.writable.wait_for(lambda: self.outbound.closed or not (self.outbound.depth() or self.writing),
+                                       CLOSE_TIMEOUT)
+                self.outbound.clear()
+                self.writable.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # Wakes up thread blocked in recv, close alone doesn't
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class AsyncConnection:
+    """
+    Message-level wrapper over asyncio streams. send() never blocks: frames are put to the connection's
+    bounded outbound queue (see OutboundQueue), which is drained by its own writer task.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, limit: int = SEND_QUEUE_LIMIT,
+                 policy: str = SLOW_CONSUMER_POLICY, spill_limit: int = SEND_SPILL_LIMIT):
+        self.reader = reader
+        self.writer = writer
+        self.peername = writer.get_extra_info('peername')
+        self.codec = None
+        self.frames = FrameReader()
+        self.pending = deque()
+        self.outbound = OutboundQueue(limit, policy, spill_limit)
+        self.wakeup = asyncio.Event()  # Frames were queued
+        self.idle = asyncio.Event()  # Outbound queue is empty
+        self.idle.set()
+        self.writer_task = None
+        self.closed = False
+
+    async def client_handshake(self, codecs=(BINARY_CODEC, JSON_CODEC), compressed: bool = True,
+                               curve=None) -> int:
+        offered = offered_codes(codecs, compressed)
+        self.writer.write(MAGIC + bytes([len(offered)]) + offered)
+        try:
+            answer = await self.reader.readexactly(len(MAGIC) + 2)
+            name = await self.reader.readexactly(answer[-1])
+        except asyncio.IncompleteReadError:
+            raise ConnectionResetError("Connection closed during handshake")
+        if answer[:len(MAGIC)] != MAGIC or answer[-2] not in offered:
+            raise ProtocolError("Unexpected handshake answer from server")
+        self.codec = codec_for(answer[-2], _server_curve(name, curve))
+        self.writer_task = asyncio.create_task(self._write_loop())
+        return self.codec.code
+
+    async def server_handshake(self, supported=(BINARY_CODEC, JSON_CODEC), curve=CURVE) -> int:
+        try:
+            header = await self.reader.readexactly(len(MAGIC) + 1)
+            offered = await self.reader.readexactly(header[-1])
+        except asyncio.IncompleteReadError:
+            raise ConnectionResetError("Connection closed during handshake")
+        code = _choose_codec(header, offered, supported)
+        self.codec = codec_for(code, curve, opaque=True)
+        self.writer.write(_handshake_answer(code, curve))
+        self.writer_task = asyncio.create_task(self._write_loop())
+        return code
+
+    async def _write_loop(self):
+        try:
+            while True:
+                data = self.outbound.get()
+                if data is None:
+                    if self.outbound.closing or self.outbound.closed:
+                        break
+                    self.idle.set()
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                self.writer.writelines(data)
+                metrics.registry.inc('bytes_out_total', sum(len(part) for part in data))
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.closed = True
+            self.outbound.clear()
+            self.writer.close()
+            self.idle.set()  # Unblock drain()
+
+    def _put(self, frame: list, own: bool = True) -> bool:
+        if self.closed or not self.outbound.put(frame, own):
+            return False
+        self.idle.clear()
+        self.wakeup.set()
+        return True
+
+    # Own messages never wait for queue space, wait is accepted for the interface of Connection
+    def send(self, message: dict, wait: bool = True):
+        self._put(self.codec.frame(message))
+
+    def send_many(self, messages):
+        self._put([part for message in messages for part in self.codec.frame(message)])
+
+    def encode_many(self, messages) -> tuple:
+        return _frames(self.codec, messages)
+
+    def send_frame(self, frame: list, wait: bool = True):
+        if not self._put(frame):
+            raise ConnectionResetError("Connection closed")
+
+    # Send message of other connection. Raises SlowConsumerError if outbound queue is full.
+    # frames - cache of frames by codec id, when the same message is posted to many connections
+    def post(self, message: dict, frames: dict = None):
+        if self.closed:
+            raise ConnectionResetError("Connection closed")
+        frame = self.codec.frame(message) if frames is None else _shared_frame(self.codec, message, frames)
+        if not self._put(frame, own=False):
+            if self.outbound.policy == 'drop':
+                raise SlowConsumerError("outbound queue is full, message dropped", False)
+            self.evict()
+            raise SlowConsumerError("outbound queue is full, disconnected", True)
+
+    # Drop queued frames and abort transport, handler of connection sees it closed and cleans up
+    def evict(self):
+        self.closed = True
+        self.outbound.clear()
+        self.wakeup.set()
+        self.writer.transport.abort()
+
+    def queue_stats(self) -> dict:
+        return self.outbound.stats()
+
+    # Wait until queued frames are passed to transport
+    async def drain(self):
+        await self.idle.wait()
+
+    async def recv(self) -> dict | None:
+        while not self.pending:
+            data = await self.reader.read(BUFF_SIZE)
+            if not data:
+                return None
+            metrics.registry.inc('bytes_in_total', len(data))
+            self.pending.extend(self.frames.feed(data))
+        return self.codec.decode(self.pending.popleft())
+
+    def getpeername(self):
+        return self.peername
+
+    # Writer task sends queued frames and closes the stream
+    def close(self):
+        if self.writer_task is None:
+            self.writer.close()
+        else:
+            self.outbound.closing = True
+            self.wakeup.set()
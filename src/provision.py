@@ -0,0 +1,153 @@
+"""
+Bulk provisioning of users: generates key pairs in a pool of worker processes, writes a key file for every
+user and adds users (and optionally their group membership) to the server database in batches.
+Keys are generated with CSPRNG (signcryption.gen_keys).
+
+Command line:
+    provision.py server.db 10000 --prefix user --group load --keys-dir keys
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from ecpy.curves import Curve
+
+from constants import CURVE
+from ecmath import curve_by_name, generator_table
+from signcryption import gen_keys
+from storage import connect, get_curve, set_curve, upsert_users
+
+PROVISION_CHUNK = 256  # Users per task of worker process
+PROGRESS_INTERVAL = 5  # Seconds between progress reports
+
+_curve = None  # Curve of worker process
+
+
+def _init_worker(curve_name: str):
+    global _curve
+    _curve = Curve.get_curve(curve_name)
+    generator_table(_curve)  # Build fixed-base table once per worker
+
+
+def write_key_file(path: str, private_key: int, public_key: list, curve: Curve):
+    # Private key, readable by owner only
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as fp:
+        json.dump({'private': private_key, 'public': public_key, 'curve': curve.name}, fp)
+
+
+# Generates keys of users and writes their key files, returns [(username, public_key)]
+def _provision_chunk(usernames: list, keys_dir: str) -> list:
+    users = []
+    for username in usernames:
+        private_key, public_key = gen_keys(_curve)
+        write_key_file(os.path.join(keys_dir, f"{username}_key.json"), private_key, public_key, _curve)
+        users.append((username, public_key))
+    return users
+
+
+class JsonStore:
+    # JSON database is changed in memory and written once, after all keys are generated
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data = {'users': [], 'groups': []}
+        if os.path.exists(path):
+            with open(path, 'r') as fp:
+                self.data = json.load(fp)
+        self.curve = curve_by_name(self.data.get('curve', CURVE.name))
+        self.users = {user['username']: user for user in self.data['users']}
+        self.groups = {group['group_name']: group for group in self.data['groups']}
+
+    def set_curve(self, curve: Curve):
+        if curve.name != self.curve.name and self.users:
+            raise ValueError(f"Keys of database are on curve '{self.curve.name}', not '{curve.name}'")
+        self.curve = curve
+
+    def add(self, users: list, group_name: str = None):
+        for username, public_key in users:
+            self.users[username] = {'username': username, 'public_key': public_key}
+        if group_name is not None:
+            group = self.groups.setdefault(group_name, {'group_name': group_name, 'members': []})
+            members = set(group['members'])
+            group['members'] += [username for username, _ in users if username not in members]
+
+    def close(self):
+        self.data.update({'curve': self.curve.name, 'users': list(self.users.values()),
+                          'groups': list(self.groups.values())})
+        with open(self.path + '.tmp', 'w') as fp:
+            json.dump(self.data, fp)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class SqliteStore:
+    # Every batch of users is committed, running server sees them right away
+
+    def __init__(self, path: str):
+        self.conn = connect(path)
+        self.curve = get_curve(self.conn)
+
+    def set_curve(self, curve: Curve):
+        with self.conn:
+            set_curve(self.conn, curve)
+        self.curve = curve
+
+    def add(self, users: list, group_name: str = None):
+        upsert_users(self.conn, self.curve, users, group_name)
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate key files of many users and add them to server database")
+    parser.add_argument("db_path", type=str,
+                        help="users and groups: .json file or SQLite database (created if missing)")
+    parser.add_argument("count", type=int, help="number of users")
+    parser.add_argument("--prefix", type=str, default='user', help="usernames are PREFIX<index>")
+    parser.add_argument("--start", type=int, default=0, help="index of the first user")
+    parser.add_argument("--group", type=str, help="add users to this group")
+    parser.add_argument("--keys-dir", type=str, default='keys', help="directory for key files <username>_key.json")
+    parser.add_argument("--curve", type=str, help="curve of keys (default: curve of database)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="key generation processes")
+    parser.add_argument("--chunk", type=int, default=PROVISION_CHUNK, help="users per task of worker process")
+    args = parser.parse_args()
+    if args.count < 1 or args.workers < 1 or args.chunk < 1:
+        parser.error("count, workers and chunk must be positive")
+    if os.path.basename(args.prefix) != args.prefix:
+        parser.error("prefix must not contain path separators")
+
+    store = JsonStore(args.db_path) if args.db_path.endswith('.json') else SqliteStore(args.db_path)
+    try:
+        if args.curve is not None:
+            store.set_curve(curve_by_name(args.curve))
+    except ValueError as e:
+        print(f"[ERROR] {e}")
+        return
+    os.makedirs(args.keys_dir, exist_ok=True)
+
+    usernames = [f"{args.prefix}{i}" for i in range(args.start, args.start + args.count)]
+    chunks = [usernames[i:i + args.chunk] for i in range(0, len(usernames), args.chunk)]
+    start = last_report = time.perf_counter()
+    done = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(store.curve.name,)) as executor:
+        # Results come in order of chunks, every batch goes to database as soon as it is generated
+        for users in executor.map(_provision_chunk, chunks, itertools.repeat(args.keys_dir)):
+            store.add(users, args.group)
+            done += len(users)
+            if time.perf_counter() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.perf_counter()
+                print(f"[INFO] {done}/{args.count} users, {done / (last_report - start):.0f} keys/sec")
+    store.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"[INFO] Provisioned {done} users on curve {store.curve.name} in {elapsed:.2f} s "
+          f"({done / elapsed:.0f} keys/sec), key files in '{args.keys_dir}'")
+
+
+if __name__ == "__main__":
+    main()
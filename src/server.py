@@ -1,76 +1,352 @@
 import socket
 import threading
-import random
-import json
+import time
 import argparse
+from contextlib import nullcontext
 
-from constants import CURVE, BUFF_SIZE
-from server_structs import ServerDatabase, Sessions
+import metrics
+from constants import LISTEN_BACKLOG, LOG_REPLAY_BATCH, SEND_QUEUE_LIMIT, SLOW_CONSUMER_POLICY
+from auth_batch import AuthBatcher, AUTH_BATCH_WINDOW, valid_response
+from ecmath import is_identity, decode_point, random_scalar
+from message_log import MessageLog
+from presence import Presence, PRESENCE_WINDOW
+from signcryption import peer_keys
+from protocol import Connection, ProtocolError, SlowConsumerError, CODEC_NAMES, SLOW_CONSUMER_POLICIES
+from server_structs import Sessions
+from storage import open_database
+
+QUEUE_REPORT_INTERVAL = 10  # Seconds between reports of outbound queues that are not empty
 
 
 # Server class to handle client connections and group chat logic
 class Server:
-    def __init__(self, host: str, port: int, db_path: str):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind((host, port))
-        self.server.listen(5)
-        print(f"[INFO] Server started on {host}:{port}")
-
-        self.database = ServerDatabase(db_path)
+    def __init__(self, host: str, port: int, db_path: str, codecs=tuple(CODEC_NAMES.values()),
+                 backlog: int = LISTEN_BACKLOG, auth_window: float = AUTH_BATCH_WINDOW, log_dir: str = None,
+                 queue_limit: int = SEND_QUEUE_LIMIT, slow_consumer: str = SLOW_CONSUMER_POLICY,
+                 presence_window: float = PRESENCE_WINDOW):
+        self.host = host  # Listening address, socket is created by bind
+        self.port = port
+        self.backlog = backlog
+        self.codecs = codecs  # Codecs that clients may choose in handshake
+        self.server = None  # Listening socket
+
+        self.database = open_database(db_path)
+        self.curve = self.database.curve  # Curve of all keys, announced to clients in handshake
         self.active_sessions = Sessions()
-
+        self.streams = {}  # Map sender socket to its file streams: stream id -> recipients
+        # Batched ZKKSP checks, None - every proof is checked in its handler
+        self.authenticator = AuthBatcher(self.curve, auth_window) if auth_window > 0 else None
+        # Stored messages for offline members, None - messages to offline members are dropped
+        self.message_log = MessageLog(log_dir) if log_dir else None
+        # Joins and leaves are sent to group members in batches
+        self.presence = Presence(self.curve, self.database, self.active_sessions, self.send_to, presence_window,
+                                 self.message_log is not None)
+        # Bytes queued for a client before slow consumer policy applies (protocol.OutboundQueue)
+        self.queue_limit = queue_limit
+        self.slow_consumer = slow_consumer
+        threading.Thread(target=self.report_queues, daemon=True).start()
+        self.register_metrics()
+
+    def bind(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind((self.host, self.port))
+        self.server.listen(self.backlog)
+        print(f"[INFO] Server started on {self.host}:{self.port} (curve {self.curve.name})")
+
+    # Gauges computed when metrics are rendered
+    def register_metrics(self):
+        metrics.registry.gauge('active_sessions', lambda: {
+            (('group', group_name),): count for group_name, count in self.active_sessions.group_sizes().items()})
+        metrics.registry.gauge('outbound_queued_bytes', lambda: {
+            (('group', group_name), ('user', username)): stats['queued']
+            for (username, group_name), stats in self.queue_stats().items() if stats is not None})
+
+    # Send to other client, never waits for it. Failed write means recipient disconnected or was evicted,
+    # its own handler cleans the session up. frames - cache of encoded data, when it is sent to many clients
     @staticmethod
-    def encode_data(data):
-        return json.dumps(data).encode()
+    def send_to(recipient_socket, data, frames: dict = None) -> bool:
+        try:
+            recipient_socket.post(data, frames)
+            return True
+        except SlowConsumerError as e:
+            if e.evicted:
+                print(f"[WARNING] Slow consumer {recipient_socket.getpeername()}: {e}.")
+            return False
+        except ProtocolError as e:  # Invalid point from sender, it can't be converted for recipient
+            print(f"[WARNING] Message to {recipient_socket.getpeername()} not sent: {e}.")
+            return False
+        except OSError:
+            return False
+
+    # Outbound queue metrics of connected users: (username, group_name) -> stats
+    def queue_stats(self) -> dict:
+        return {(session.username, session.group_name): session.socket.queue_stats()
+                for session in self.active_sessions.get_sessions()}
 
+    # Reports users with queued data or new drops since last report
+    def report_queues(self, interval: float = QUEUE_REPORT_INTERVAL):
+        dropped = {}
+        while True:
+            time.sleep(interval)
+            stats = self.queue_stats()
+            for user, user_stats in stats.items():
+                if user_stats is not None and (user_stats['queued'] or user_stats['dropped'] > dropped.get(user, 0)):
+                    print(f"[INFO] Outbound queue of '{user[0]}' ({user[1]}): {user_stats['queued']} bytes queued, "
+                          f"peak {user_stats['peak']}, {user_stats['spilled']} spilled, "
+                          f"{user_stats['dropped']} dropped")
+            dropped = {user: user_stats['dropped'] for user, user_stats in stats.items() if user_stats is not None}
+
+    # Message for recipient of relayed send_message/send_multi request
     @staticmethod
-    def decode_data(data):
-        return json.loads(data.decode())
+    def envelope(sender, request, recipient) -> dict:
+        if request['action'] == 'send_message':
+            return {'action': 'msg', 'sender': sender, 'signcrypted_msg': request['signcrypted_msg']}
+        return {'action': 'multi_msg', 'sender': sender, 'payload': request['payload'],
+                'signcrypted_msg': request['wraps'][recipient]}
 
     def send_msg(self, sender_socket, reciever_username, signcrypted_msg):
-        data = self.encode_data({
-            'action': 'msg',
-            'sender': self.active_sessions.get_username(sender_socket),
-            'signcrypted_msg': signcrypted_msg
-        })
+        group_name = self.active_sessions.get_group_name(sender_socket)
+        self.relay(sender_socket, {'action': 'send_message', 'group': group_name, 'reciever': reciever_username,
+                                   'signcrypted_msg': signcrypted_msg}, [reciever_username])
 
+    # Send one encrypted payload to several recipients, every recipient gets its own key wrap
+    def send_multi(self, sender_socket, payload, wraps):
+        group_name = self.active_sessions.get_group_name(sender_socket)
+        self.relay(sender_socket, {'action': 'send_multi', 'group': group_name, 'payload': payload, 'wraps': wraps},
+                   list(wraps))
+
+    def relay(self, sender_socket, request, recipients):
+        with metrics.registry.timer('relay_seconds', action=request['action']):
+            delivered = self._relay(sender_socket, request, recipients)
+        metrics.registry.inc('relayed_total', action=request['action'])
+        metrics.registry.inc('relay_deliveries_total', delivered)
+
+    # Returns number of recipients the request was sent to
+    def _relay(self, sender_socket, request, recipients) -> int:
+        sender = self.active_sessions.get_username(sender_socket)
         group_name = self.active_sessions.get_group_name(sender_socket)
-        recipient_socket = self.active_sessions.get_socket(reciever_username, group_name)
-        if recipient_socket is not None:
-            recipient_socket.send(data)
+        delivered = 0
+        if self.message_log is None:
+            for recipient in recipients:
+                recipient_socket = self.active_sessions.get_socket(recipient, group_name)
+                if recipient_socket is not None and self.send_to(recipient_socket,
+                                                                 self.envelope(sender, request, recipient)):
+                    delivered += 1
+            return delivered
+
+        # Request is stored first, offline members get it on next login. Names that are not members of group
+        # are not stored, they would grow index of the log
+        recipients = [recipient for recipient in recipients
+                      if self.database.check_access_to_group(recipient, group_name)]
+        log = self.message_log.group(group_name)
+        with log.lock:
+            position = log.append(sender, request, recipients)
+            if position is None:
+                print(f"[WARNING] Message from '{sender}' is too large for message log.")
+            for recipient in recipients:
+                recipient_socket = self.active_sessions.get_socket(recipient, group_name)
+                if recipient_socket is not None and self.send_to(recipient_socket,
+                                                                 self.envelope(sender, request, recipient)):
+                    delivered += 1
+                    if position is not None:
+                        log.delivered(recipient, position)
+        return delivered
 
     # Zero-Knowledge Key-Statement Proof
     def verify_client_key(self, client_socket, public_key, commitment):
-        public_key = CURVE.decode_point(public_key)
-        commitment = CURVE.decode_point(commitment)
-
-        challenge = random.randint(1, CURVE.order - 1)
-        data = self.encode_data({
+        challenge = random_scalar(self.curve)
+        client_socket.send({
             'status': 'challenge',
             'challenge': challenge,
         })
-        client_socket.send(data)
 
-        data = client_socket.recv(BUFF_SIZE)
-        request = self.decode_data(data)
-        zkksp_response = request['zkksp_response']
+        request = client_socket.recv()
+        if request is None or request.get('action') != 'prove' or public_key is None:
+            return False
+        with metrics.registry.timer('auth_verify_seconds'):
+            if self.authenticator is not None:
+                return self.authenticator.verify(public_key, commitment, challenge, request['zkksp_response'])
+            return self.check_zkksp(self.curve, public_key, commitment, challenge, request['zkksp_response'])
 
-        if zkksp_response * CURVE.generator == commitment + challenge * public_key:
-            return True
-        else:
+    @staticmethod
+    def check_zkksp(curve, public_key, commitment, challenge, zkksp_response) -> bool:
+        if not valid_response(curve, zkksp_response):
             return False
+        try:
+            public_key = peer_keys.get(curve, public_key)
+            commitment = decode_point(curve, commitment)
+        except (ValueError, TypeError):  # Not a point of curve or not an encoded point at all
+            return False
+        # z * G == C + c * P  <=>  z * G - C - c * P is the point at infinity
+        return is_identity(curve, [(-challenge, public_key.base()), (-1, commitment)], gen_scalar=zkksp_response)
 
-    def handle_client(self, client_socket):
+    # File transfer. Chunks are relayed as they come, to recipients that got file offer, nothing is stored
+    def file_start(self, sender_socket, request):
+        sender = self.active_sessions.get_username(sender_socket)
+        group_name = self.active_sessions.get_group_name(sender_socket)
+        recipients = []
+        for recipient, wrap in request['wraps'].items():
+            recipient_socket = self.active_sessions.get_socket(recipient, group_name)
+            if recipient_socket is not None and self.send_to(recipient_socket, {
+                'action': 'file_offer',
+                'sender': sender,
+                'stream': request['stream'],
+                'name': request['name'],
+                'size': request['size'],
+                'signcrypted_msg': wrap
+            }):
+                recipients.append(recipient)
+        self.streams.setdefault(sender_socket, {})[request['stream']] = recipients
+
+    def file_chunk(self, sender_socket, request):
+        recipients = self.streams.get(sender_socket, {}).get(request['stream'], [])
+        group_name = self.active_sessions.get_group_name(sender_socket)
+        data = {
+            'action': 'file_data',
+            'sender': self.active_sessions.get_username(sender_socket),
+            'stream': request['stream'],
+            'data': request['data']
+        }
+        frames = {}  # Chunk is encoded once per codec
+        for recipient in recipients:
+            recipient_socket = self.active_sessions.get_socket(recipient, group_name)
+            if recipient_socket is not None:
+                self.send_to(recipient_socket, data, frames)
+
+    def file_end(self, sender_socket, request):
+        recipients = self.streams.get(sender_socket, {}).pop(request['stream'], [])
+        sender = self.active_sessions.get_username(sender_socket)
+        group_name = self.active_sessions.get_group_name(sender_socket)
+        for recipient in recipients:
+            recipient_socket = self.active_sessions.get_socket(recipient, group_name)
+            if recipient_socket is not None and recipient in request['wraps']:
+                self.send_to(recipient_socket, {
+                    'action': 'file_done',
+                    'sender': sender,
+                    'stream': request['stream'],
+                    'signcrypted_msg': request['wraps'][recipient]
+                })
+
+    # Checks after successful ZKKSP: access to group, no duplicate session. Adds session, sends success response,
+    # stored messages and presence changes. Returns False if connection should be terminated
+    def join_group(self, client_socket, username, group_name) -> bool:
+        joining = self.start_join(client_socket, username, group_name)
+        if joining is None:
+            return False
+        for _ in joining:  # Batches of stored messages wait while outbound queue of client is over limit
+            pass
+        return True
+
+    # Access checks, session and success response. Returns generator of the rest of join (see _join), which yields
+    # after every batch of stored messages, None if user can't join
+    def start_join(self, client_socket, username, group_name):
+        # Check user access to group
+        if not self.database.check_access_to_group(username, group_name):
+            data = {'status': 'denied',
+                    'reason': f"You have no access to group '{group_name}'."}
+            client_socket.send(data)
+            print(
+                f"[WARNING] User '{username}' has no access to group '{group_name}'. Terminating connection.")
+            return None
+        else:
+            print(f"[INFO] User '{username}' connected to group '{group_name}'.")
+
+        # Other connections don't see session until its stored messages and presence changes are sent, so
+        # it gets messages in log order and presence of group only after success response
+        presence = self.presence.group(group_name)
+        log = self.message_log.group(group_name) if self.message_log is not None else None
+        with presence.lock, log.lock if log is not None else nullcontext():
+            # Save active session
+            if not self.active_sessions.add_session(client_socket, username, group_name, joining=True):
+                # There is active session with user already
+                data = {'status': 'denied',
+                        'reason': f"You already have active session."}
+                client_socket.send(data)
+                print(
+                    f"[WARNING] User '{username}' tried to connect, but already have active session. Terminating.")
+                return None
+
+            # Send success code and members info, member lists are encoded once per presence message of group
+            members_data, offline_data = self.presence.snapshot(group_name, presence)
+            data = {'status': 'success',
+                    'members': members_data,
+                    'offline': offline_data,
+                    'offline_delivery': int(log is not None),
+                    'backlog': log.pending(username) if log is not None else 0}
+            # Group locks are held, so nothing here waits for the client to read (its queue may go over limit)
+            client_socket.send(data, wait=False)
+            seen = presence.members
+        return self._join(client_socket, username, group_name, presence, log, seen)
+
+    # Stored messages are sent in batches without group locks, relays to group don't wait for them. Messages
+    # stored meanwhile go in the last batch, under locks, with presence changes since snapshot (seen members)
+    def _join(self, client_socket, username, group_name, presence, log, seen):
+        stored = skipped = 0
+        while log is not None:
+            with log.lock:
+                backlog = log.backlog(username, LOG_REPLAY_BATCH)
+            if not backlog:
+                break
+            skipped += self.send_backlog(client_socket, log, username, backlog)
+            stored += len(backlog)
+            yield True
+
+        with presence.lock, log.lock if log is not None else nullcontext():
+            backlog = log.backlog(username) if log is not None else []
+            if backlog:
+                skipped += self.send_backlog(client_socket, log, username, backlog, wait=False)
+                stored += len(backlog)
+            # Changes since snapshot, including this member
+            client_socket.send(self.presence.join(group_name, presence, username,
+                                                  self.database.get_public_key(username), seen), wait=False)
+            self.active_sessions.joined(client_socket)
+        if stored:
+            print(f"[INFO] Sent {stored - skipped} stored messages to '{username}'"
+                  f"{f' ({skipped} with invalid points skipped)' if skipped else ''}.")
+
+    # Stored messages in one write, ones with points that can't be converted for connection are skipped.
+    # Returns number of skipped messages
+    def send_backlog(self, client_socket, log, username, backlog, wait: bool = True) -> int:
+        frame, skipped = client_socket.encode_many([self.envelope(sender, request, username)
+                                                    for _, sender, request in backlog])
+        if frame:
+            client_socket.send_frame(frame, wait)
+        with log.lock:
+            log.delivered(username, backlog[-1][0])
+        return skipped
+
+    def handle_client(self, sock):
+        try:
+            client_socket = Connection(sock)
+            client_socket.server_handshake(self.codecs, self.curve)
+        except (ConnectionResetError, ProtocolError, OSError) as e:
+            print(f"[WARNING] Handshake failed: {e}")
+            sock.close()
+            return
+        self.serve_connection(client_socket)
+
+    # Request loop of connection after handshake
+    def serve_connection(self, client_socket):
+        client_socket.start_writer(self.queue_limit, self.slow_consumer)
+        try:
+            self.serve_requests(client_socket)
+        finally:  # Session is cleaned up whatever ends the loop
+            self.disconnect_client(client_socket)
+
+    def serve_requests(self, client_socket):
         while True:
             try:
-                data = client_socket.recv(BUFF_SIZE)
-                if not data:
+                request = client_socket.recv()
+                if request is None:
                     break
 
-                request = self.decode_data(data)
                 action = request['action']
 
                 if action == 'authentication':
+                    if self.active_sessions.get_username(client_socket) is not None:
+                        print(f"[WARNING] User '{self.active_sessions.get_username(client_socket)}' sent second "
+                              f"authentication request. Terminating connection.")
+                        break
                     username = request['username']
                     group_name = request['group_name']
                     commitment = request['commitment']
@@ -78,97 +354,67 @@ class Server:
                     # Verify that user has private key (ZKKSP)
                     public_key = self.database.get_public_key(username)
                     if self.verify_client_key(client_socket, public_key, commitment):
+                        metrics.registry.inc('auth_total', result='ok')
                         print(f"[INFO] User {client_socket.getpeername()} authenticated as '{username}'.")
                     else:
+                        metrics.registry.inc('auth_total', result='fail')
                         print(f"[WARNING] User '{client_socket.getpeername()}' authentication as '{username}' FAIL.")
-                        client_socket.send(
-                            self.encode_data({'status': 'denied', 'reason': "Authentication fail."}))
+                        client_socket.send({'status': 'denied', 'reason': "Authentication fail."})
                         break
 
-                    # Check user access to group
-                    if not self.database.check_access_to_group(username, group_name):
-                        data = self.encode_data({'status': 'denied',
-                                                 'reason': f"You have no access to group '{group_name}'."})
-                        client_socket.send(data)
-                        print(
-                            f"[WARNING] User '{username}' has no access to group '{group_name}'. Terminating connection.")
-                        break
-                    else:
-                        print(f"[INFO] User '{username}' connected to group '{group_name}'.")
-
-                    if self.active_sessions.get_socket(username,
-                                                       group_name) is not None:  # There is active session with user already
-                        data = self.encode_data({'status': 'denied',
-                                                 'reason': f"You already have active session."})
-                        client_socket.send(data)
-                        print(
-                            f"[WARNING] User '{username}' tried to connect, but already have active session. Terminating.")
-                        break
+                    with metrics.region('handle_client'):
+                        if not self.join_group(client_socket, username, group_name):
+                            break
 
-                    # Save active session
-                    self.active_sessions.add_session(client_socket, username, group_name)
-
-                    # Send success code and members info
-                    group_usernames = self.active_sessions.get_group_members(client_socket)
-                    public_keys = [self.database.get_public_key(usr) for usr in group_usernames]
-                    members_data = {}
-                    for username, public_key in zip(group_usernames, public_keys):
-                        members_data[username] = public_key
-                    data = self.encode_data({'status': 'success',
-                                             'members': members_data})
-                    client_socket.send(data)
-
-                    # Tell group members that there is new active member
-                    self.broadcast_new_member(client_socket)
-
-                elif action == 'send_message':
-                    # sender = self.active_sessions.get_username(client_socket)
-                    reciever = request['reciever']
-                    signcrypted_msg = request['signcrypted_msg']
-                    self.send_msg(client_socket, reciever, signcrypted_msg)
                 else:
-                    print(
-                        f"[WARNING] Unknown action '{action}. Terminating connection.")
-                    break
+                    with metrics.region('handle_client'):
+                        if not self.handle_request(client_socket, request):
+                            break
 
-            except (ConnectionResetError, json.JSONDecodeError):
+            except (ConnectionResetError, ProtocolError):
                 break
 
-        # Client disconnected
+    # Handle request of authenticated client. Returns False if connection should be terminated
+    def handle_request(self, client_socket, request) -> bool:
+        action = request['action']
+        if self.active_sessions.get_username(client_socket) is None:
+            print(f"[WARNING] Action '{action}' before authentication. Terminating connection.")
+            return False
+        if action in ('send_message', 'send_multi', 'file_start'):
+            self.presence.announce(self.active_sessions.get_group_name(client_socket),
+                                   self.active_sessions.get_username(client_socket))
+
+        if action == 'send_message':
+            reciever = request['reciever']
+            signcrypted_msg = request['signcrypted_msg']
+            self.send_msg(client_socket, reciever, signcrypted_msg)
+        elif action == 'send_multi':
+            self.send_multi(client_socket, request['payload'], request['wraps'])
+        elif action == 'file_start':
+            self.file_start(client_socket, request)
+        elif action == 'file_chunk':
+            self.file_chunk(client_socket, request)
+        elif action == 'file_end':
+            self.file_end(client_socket, request)
+        else:
+            print(
+                f"[WARNING] Unknown action '{action}. Terminating connection.")
+            return False
+        return True
+
+    def disconnect_client(self, client_socket):
         print(f"[INFO] Client disconnected: {client_socket.getpeername()}")
         if self.active_sessions.get_username(client_socket) is not None:  # Check if client was authenticated
-            self.broadcast_member_disconnect(client_socket)
+            self.presence.leave(self.active_sessions.get_group_name(client_socket),
+                                self.active_sessions.get_username(client_socket))
+            if self.message_log is not None:
+                self.message_log.group(self.active_sessions.get_group_name(client_socket)).save()
+        self.streams.pop(client_socket, None)
         self.active_sessions.del_session(client_socket)
         client_socket.close()
 
-    def broadcast_new_member(self, new_member_socket):
-        # New member data
-        new_username = self.active_sessions.get_username(new_member_socket)
-        new_public_key = self.database.get_public_key(new_username)
-
-        # Send message to other group members
-        members_sockets = self.active_sessions.get_other_group_sockets(new_member_socket)
-        for sock in members_sockets:
-            data = self.encode_data({
-                'action': 'new_member',
-                'member_name': new_username,
-                'member_public_key': new_public_key
-            })
-            sock.send(data)
-
-    def broadcast_member_disconnect(self, client_socket):
-        username = self.active_sessions.get_username(client_socket)
-
-        # Send message to other group members
-        members_sockets = self.active_sessions.get_other_group_sockets(client_socket)
-        for sock in members_sockets:
-            data = self.encode_data({
-                'action': 'member_leave',
-                'username': username
-            })
-            sock.send(data)
-
     def run(self):
+        self.bind()
         while True:
             client_socket, addr = self.server.accept()
             print(f"[INFO] Connection from {addr}")
@@ -179,8 +425,45 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("host", type=str, help="server IP address")
     parser.add_argument("port", type=int, help="server port")
-    parser.add_argument("db_path", type=str, help="path to json with server data about users and groups")
+    parser.add_argument("db_path", type=str, help="users and groups: .json file or SQLite database (see storage.py)")
+    parser.add_argument("--protocol", choices=['any', *CODEC_NAMES], default='any',
+                        help="message encodings accepted from clients")
+    parser.add_argument("--engine", choices=['threaded', 'asyncio'], default='threaded',
+                        help="thread per connection or single asyncio event loop")
+    parser.add_argument("--backlog", type=int, default=LISTEN_BACKLOG, help="listen backlog size")
+    parser.add_argument("--auth-window", type=float, default=AUTH_BATCH_WINDOW,
+                        help="seconds to collect ZKKSP proofs for one batch check (0 - check every proof alone)")
+    parser.add_argument("--presence-window", type=float, default=PRESENCE_WINDOW,
+                        help="seconds to collect joins and leaves of a group for one presence message")
+    parser.add_argument("--log-dir", type=str,
+                        help="directory of message log, messages are stored for offline members (default: not stored)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="worker processes, every group is served by one of them (threaded engine only)")
+    parser.add_argument("--queue-limit", type=int, default=SEND_QUEUE_LIMIT,
+                        help="bytes queued for one client before slow consumer policy applies")
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default=SLOW_CONSUMER_POLICY,
+                        help="messages for client over queue limit: drop them, disconnect client or spill to disk")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve metrics at http://127.0.0.1:PORT/metrics (shard i uses PORT + 1 + i)")
+    parser.add_argument("--metrics-interval", type=float, help="print metrics to log every METRICS_INTERVAL seconds")
+    parser.add_argument("--profile", type=str, metavar="PATH",
+                        help="enable sampling profiler, write collapsed stacks to PATH (also served at /profile)")
     args = parser.parse_args()
-
-    server = Server(args.host, args.port, args.db_path)
+    if args.shards > 1 and args.engine != 'threaded':
+        parser.error("--shards requires threaded engine")
+
+    codecs = tuple(CODEC_NAMES.values()) if args.protocol == 'any' else (CODEC_NAMES[args.protocol],)
+    metrics.start(args.metrics_port, args.metrics_interval, args.profile)
+    if args.shards > 1:
+        from sharded_server import ShardDispatcher
+        server = ShardDispatcher(args.host, args.port, args.db_path, args.shards, codecs, args.backlog,
+                                 args.auth_window, args.log_dir, args.queue_limit, args.slow_consumer,
+                                 args.metrics_port, args.metrics_interval, args.profile, args.presence_window)
+    elif args.engine == 'asyncio':
+        from async_server import AsyncServer
+        server = AsyncServer(args.host, args.port, args.db_path, codecs, args.backlog, args.auth_window,
+                             args.log_dir, args.queue_limit, args.slow_consumer, args.presence_window)
+    else:
+        server = Server(args.host, args.port, args.db_path, codecs, args.backlog, args.auth_window, args.log_dir,
+                        args.queue_limit, args.slow_consumer, args.presence_window)
     server.run()
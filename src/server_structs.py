@@ -1,7 +1,13 @@
 import json
+import threading
+
+from constants import CURVE
+from ecmath import curve_by_name
 
 
 class User:
+    __slots__ = ('username', 'public_key')
+
     def __init__(self, username, public_key):
         self.username = username
         self.public_key = public_key
@@ -20,58 +26,77 @@ class Group:
 
 
 class Session:
-    def __init__(self, username, group_name):
+    __slots__ = ('socket', 'username', 'group_name')
+
+    def __init__(self, socket, username, group_name):
+        self.socket = socket
         self.username = username
         self.group_name = group_name
 
 
 class Sessions:
+    # Thread-safe registry of active sessions, indexed by socket, by (username, group_name) and by group
 
     def __init__(self):
         self.sessions = {}  # Map socket to Session
-
-    def add_session(self, socket, username, group_name):
-        self.sessions[socket] = Session(username, group_name)
+        self.user_sockets = {}  # Map (username, group_name) to socket
+        self.groups = {}  # Map group_name to set of Sessions
+        self.joining = set()  # Sockets of sessions that get nothing from other connections yet (see joined)
+        self.lock = threading.RLock()
+
+    # Returns False if user already has active session in this group, or socket already has a session.
+    # joining - other connections don't see session until joined() (success response must be sent first)
+    def add_session(self, socket, username, group_name, joining: bool = False) -> bool:
+        with self.lock:
+            if (username, group_name) in self.user_sockets or socket in self.sessions:
+                return False
+            session = Session(socket, username, group_name)
+            self.sessions[socket] = session
+            self.user_sockets[(username, group_name)] = socket
+            self.groups.setdefault(group_name, set()).add(session)
+            if joining:
+                self.joining.add(socket)
+            return True
+
+    def joined(self, socket):
+        with self.lock:
+            self.joining.discard(socket)
 
     def del_session(self, socket):
-        try:
-            del self.sessions[socket]
-        except KeyError:
-            pass
+        with self.lock:
+            session = self.sessions.pop(socket, None)
+            if session is None:
+                return
+            self.joining.discard(socket)
+            del self.user_sockets[(session.username, session.group_name)]
+            group = self.groups[session.group_name]
+            group.discard(session)
+            if not group:
+                del self.groups[session.group_name]
+
+    def get_sessions(self) -> list:
+        with self.lock:
+            return list(self.sessions.values())
+
+    def group_sizes(self) -> dict:
+        with self.lock:
+            return {group_name: len(group) for group_name, group in self.groups.items()}
 
     def get_username(self, socket):
-        try:
-            return self.sessions[socket].username
-        except KeyError:
-            return None
+        session = self.sessions.get(socket)
+        return session.username if session is not None else None
 
     def get_group_name(self, socket):
         return self.sessions[socket].group_name
 
+    # None if user has no session in group or its session is joining
     def get_socket(self, username, group_name):
-        for socket, session in self.sessions.items():
-            if (session.username, session.group_name) == (username, group_name):
-                return socket
-        return None
-
-    def get_group_members(self, socket):
-        group_name = self.sessions[socket].group_name
-        res = []
-        for sock, session in self.sessions.items():
-            if session.group_name == group_name:
-                res.append(session.username)
-        return res
-
-    def get_other_group_sockets(self, socket):
-        # socket - new member socket
-        # returns: sockets, that belong to same group as socket
-        res = []
-        group_name = self.sessions[socket].group_name
-        for sock, session in self.sessions.items():
-            if sock != socket:  # exclude argument
-                if session.group_name == group_name:
-                    res.append(sock)
-        return res
+        socket = self.user_sockets.get((username, group_name))
+        return None if socket in self.joining else socket
+
+    def get_group_sockets(self, group_name):
+        with self.lock:
+            return [session.socket for session in self.groups.get(group_name, ()) if session.socket not in self.joining]
 
 
 class ServerDatabase:
@@ -83,6 +108,9 @@ class ServerDatabase:
         with open(path, 'r') as fp:
             data = json.load(fp)
 
+        # Curve of all keys in database, clients are told to use it in handshake
+        self.curve = curve_by_name(data.get("curve", CURVE.name))
+
         # Get users data
         for user_info in data["users"]:
             username, public_key = user_info['username'], user_info['public_key']
@@ -102,5 +130,11 @@ class ServerDatabase:
         except KeyError:  # no such group
             return False
 
+    def get_group_members(self, group_name) -> list:
+        group = self.groups.get(group_name)
+        return list(group.members) if group is not None else []
+
+    # Returns None if there is no such user
     def get_public_key(self, username):
-        return self.users[username].public_key
+        user = self.users.get(username)
+        return user.public_key if user is not None else None
@@ -0,0 +1,137 @@
+"""
+Multi-process server: groups are split between worker processes, so relay work and ZKKSP checks use all cores.
+
+Front dispatcher accepts connections, does the protocol handshake and reads the authentication request to learn
+group_name. Then the socket (with negotiated codec and not consumed bytes) is passed to the worker owning the
+group over a unix socket. All sessions of a group live in one worker, so group state needs no sharing.
+Unix only (socket.send_fds).
+"""
+import multiprocessing
+import socket
+import struct
+import threading
+import zlib
+
+import metrics
+from auth_batch import AUTH_BATCH_WINDOW
+from constants import LISTEN_BACKLOG, SEND_QUEUE_LIMIT, SLOW_CONSUMER_POLICY
+from presence import PRESENCE_WINDOW
+from protocol import Connection, ProtocolError, CODEC_NAMES
+from server import Server
+from storage import open_database
+
+HANDOFF_TIMEOUT = 10  # Seconds for client to finish handshake and send authentication request
+MAX_HANDOFF_SIZE = 65536  # Max bytes received before handoff (authentication request is much smaller)
+HANDOFF_HEADER = struct.Struct('!B')  # Codec id, followed by not consumed bytes
+
+
+# Worker index for group
+def shard_of(group_name: str, shards: int) -> int:
+    return zlib.crc32(group_name.encode("utf-8")) % shards
+
+
+class ShardServer(Server):
+    # Worker process: serves connections handed over by dispatcher, group chat logic is shared with Server
+
+    def __init__(self, shard: int, channel: socket.socket, db_path: str, auth_window: float = AUTH_BATCH_WINDOW,
+                 log_dir: str = None, queue_limit: int = SEND_QUEUE_LIMIT, slow_consumer: str = SLOW_CONSUMER_POLICY,
+                 presence_window: float = PRESENCE_WINDOW):
+        # Connections come over channel, so worker has no listening address. Groups of shards don't overlap,
+        # so each worker has its own message log
+        super().__init__(None, None, db_path, auth_window=auth_window, log_dir=log_dir, queue_limit=queue_limit,
+                         slow_consumer=slow_consumer, presence_window=presence_window)
+        self.shard = shard
+        self.channel = channel
+
+    def run(self):
+        self.channel.send(b'ready')
+        while True:
+            data, fds, _, _ = socket.recv_fds(self.channel, HANDOFF_HEADER.size + MAX_HANDOFF_SIZE, 1)
+            if not data:  # Dispatcher exited, connection threads are daemons and exit with worker
+                break
+            sock = socket.socket(fileno=fds[0])
+            sock.setblocking(True)
+            (codec,) = HANDOFF_HEADER.unpack_from(data)
+            client_socket = Connection.attach(sock, codec, data[HANDOFF_HEADER.size:], self.curve)
+            threading.Thread(target=self.serve_connection, args=(client_socket,), daemon=True).start()
+
+
+def _run_shard(shard: int, channel: socket.socket, db_path: str, auth_window: float, log_dir: str,
+               queue_limit: int, slow_consumer: str, metrics_port: int, metrics_interval: float, profile_path: str,
+               presence_window: float):
+    print(f"[INFO] Shard {shard} started")
+    # Every worker has its own metrics and profile
+    metrics.start(metrics_port + 1 + shard if metrics_port is not None else None, metrics_interval,
+                  f"{profile_path}.{shard}" if profile_path is not None else None)
+    ShardServer(shard, channel, db_path, auth_window, log_dir, queue_limit, slow_consumer, presence_window).run()
+
+
+class ShardDispatcher:
+    def __init__(self, host: str, port: int, db_path: str, shards: int, codecs=tuple(CODEC_NAMES.values()),
+                 backlog: int = LISTEN_BACKLOG, auth_window: float = AUTH_BATCH_WINDOW, log_dir: str = None,
+                 queue_limit: int = SEND_QUEUE_LIMIT, slow_consumer: str = SLOW_CONSUMER_POLICY,
+                 metrics_port: int = None, metrics_interval: float = None, profile_path: str = None,
+                 presence_window: float = PRESENCE_WINDOW):
+        self.codecs = codecs
+        self.curve = open_database(db_path).curve  # Announced in handshake, workers use the same database
+
+        # Spawned workers inherit only their own channel, so a worker sees EOF when dispatcher exits
+        context = multiprocessing.get_context('spawn')
+        self.channels = []
+        self.workers = []
+        for shard in range(shards):
+            channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            worker = context.Process(target=_run_shard, daemon=True, args=(
+                shard, worker_channel, db_path, auth_window, log_dir, queue_limit, slow_consumer, metrics_port,
+                metrics_interval, profile_path, presence_window))
+            worker.start()
+            worker_channel.close()
+            self.channels.append(channel)
+            self.workers.append(worker)
+        for channel in self.channels:  # Wait for workers to load database
+            if channel.recv(16) != b'ready':
+                raise RuntimeError("Shard worker failed to start")
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind((host, port))
+        self.server.listen(backlog)
+        print(f"[INFO] Server started on {host}:{port} ({shards} shards, curve {self.curve.name})")
+
+    # Handshake and authentication request are read here, the rest of connection is served by worker
+    def dispatch(self, sock, addr):
+        try:
+            sock.settimeout(HANDOFF_TIMEOUT)
+            client_socket = Connection(sock)
+            client_socket.server_handshake(self.codecs, self.curve)
+            request = client_socket.peek()
+            if request is None:
+                sock.close()
+                return
+            if request.get('action') != 'authentication':
+                raise ProtocolError(f"Action '{request.get('action')}' before authentication")
+            group_name = request.get('group_name')
+            if not isinstance(group_name, str):
+                raise ProtocolError("No group name in authentication request")
+            buffered = client_socket.detach()
+            if len(buffered) > MAX_HANDOFF_SIZE:
+                raise ProtocolError("Too much data before authentication")
+            sock.settimeout(None)
+        except (ConnectionResetError, ProtocolError, OSError) as e:
+            print(f"[WARNING] Connection from {addr} dropped: {e}")
+            sock.close()
+            return
+
+        shard = shard_of(group_name, len(self.channels))
+        try:
+            # One datagram per connection, so workers may be sent to from many threads
+            socket.send_fds(self.channels[shard], [HANDOFF_HEADER.pack(client_socket.codec.code) + buffered],
+                            [sock.fileno()])
+        except OSError as e:
+            print(f"[ERROR] Shard {shard} is unavailable: {e}")
+        sock.close()  # Worker has its own copy of descriptor
+
+    def run(self):
+        while True:
+            client_socket, addr = self.server.accept()
+            print(f"[INFO] Connection from {addr}")
+            threading.Thread(target=self.dispatch, args=(client_socket, addr)).start()
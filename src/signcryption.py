@@ -1,74 +1,133 @@
 """
 Implementation of signcryption scheme, proposed in https://arxiv.org/abs/1002.3316
 """
-from typing import List
+from typing import List, Dict
+from collections import OrderedDict
 import string
 import random
-from math import floor, ceil, log2, sqrt
-from base64 import b64encode, b64decode
+import threading
+from math import floor, ceil, log2
+from base64 import b64decode
 import time
+import secrets
 
-from ecpy.curves import Curve, TwistedEdwardCurve
+from ecpy.curves import Curve
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA256
 from typing import Tuple
 from Crypto.Util.Padding import pad, unpad
-from sympy import isprime
 
 from constants import CURVE, IV
+from ecmath import (mul_generator, multi_scalar_mul, is_identity, is_supported, FixedBaseTable, encode_point,
+                    decode_point, random_scalar, clear_decompressed)
+from metrics import instrumented
 
+BATCH_SECURITY_BITS = 128  # Size of random coefficients in batch verification
+PEER_KEY_CACHE_SIZE = 256  # Decoded peer public keys kept in memory
+PEER_TABLE_THRESHOLD = 8  # Uses of peer key after which its fixed-base table is built
+PEER_TABLE_WINDOW = 4
 
-# Returns None if curve is suitable, otherwise reason why it's not suitable
-def check_curve(curve: Curve) -> str | None:
-    if type(curve) == TwistedEdwardCurve:
-        return "TwistedEdwardCurve"
+_xr_moduli = {}  # Map curve name to 2^ceil(f/2), where f is bit length of curve order
 
-    q = curve.field
-    n = curve.order
-    a, b = curve.a, curve.b
 
-    if not isprime(q):
-        return "'q' is not prime"
+# xR_wave = 2^ceil(f/2) * (R.x mod 2^ceil(f/2)), f = floor(log2(n)) + 1
+def _xr_wave(curve: Curve, R) -> int:
+    w = _xr_moduli.get(curve.name)
+    if w is None:
+        f = floor(log2(curve.order)) + 1  # float log2, same value as on other peers
+        w = _xr_moduli[curve.name] = 2 ** ceil(f / 2)
+    return w * (R.x % w)
 
-    # Check non singular
-    if 4 * (a ** 3) + 27 * (b ** 2) % q == 0:
-        return "singular curve"
 
-    # Guard against small subgroup attacks
-    if n <= 4 * sqrt(q):
-        return "small subgroup attacks"
+class PeerKey:
+    """
+    Decoded public key of a peer. After PEER_TABLE_THRESHOLD uses a fixed-base table of the key is built,
+    so scalar multiplications by it need no doublings. Pickled as (curve name, encoded key).
+    """
+    __slots__ = ('curve', 'encoded', 'point', 'uses', 'table')
 
-    # Protect against other known attacks on special classes of elliptic curves
-    for i in range(1, 21):
-        if q ** i - 1 % n == 0:
-            return "small subgroup attacks"
+    def __init__(self, curve: Curve, encoded: List[int]):
+        self.curve = curve
+        self.encoded = encoded
+        self.point = decode_point(curve, encoded)
+        self.uses = 0
+        self.table = None
 
-    # Intractability of ECDLP
-    if n <= 2 ** 160:
-        return "ECDLP is tractable"
+    # Point or its table, for ecmath multi-scalar multiplication
+    def base(self):
+        if self.table is None:
+            self.uses += 1
+            if self.uses < PEER_TABLE_THRESHOLD or not is_supported(self.curve):
+                return self.point
+            self.table = FixedBaseTable(self.curve, self.point, PEER_TABLE_WINDOW)
+        return self.table
 
-    return None
+    def __reduce__(self):
+        return _cached_peer_key, (self.curve.name, self.encoded)
+
+
+class KeyCache:
+    # LRU cache of PeerKey objects by curve and encoded key
+
+    def __init__(self, size: int = PEER_KEY_CACHE_SIZE):
+        self.size = size
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, curve: Curve, encoded: List[int]) -> PeerKey:
+        cache_key = (curve.name, bytes(encoded))
+        with self.lock:
+            peer = self.keys.get(cache_key)
+            if peer is not None:
+                self.keys.move_to_end(cache_key)
+                return peer
+        peer = PeerKey(curve, encoded)  # Decode outside of lock
+        with self.lock:
+            self.keys[cache_key] = peer
+            if len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+        return peer
+
+    def invalidate(self, curve: Curve, encoded: List[int]):
+        with self.lock:
+            self.keys.pop((curve.name, bytes(encoded)), None)
+
+
+peer_keys = KeyCache()
+
+
+def _cached_peer_key(curve_name: str, encoded: List[int]) -> PeerKey:
+    return peer_keys.get(Curve.get_curve(curve_name), encoded)
+
+
+def _peer_key(curve: Curve, key) -> PeerKey:
+    return key if isinstance(key, PeerKey) else peer_keys.get(curve, key)
 
 
 def gen_keys(curve: Curve) -> (int, List[int]):
-    priv_key = random.randint(1, curve.order - 1)
-    pub_key = curve.encode_point(priv_key * curve.generator)
+    priv_key = random_scalar(curve)
+    pub_key = encode_point(curve, mul_generator(curve, priv_key))
     return priv_key, pub_key
 
 
+@instrumented('crypto_seconds')
 def signcryption(curve: Curve, message: str, send_id: str, recv_id: str, send_priv_key: int,
-                 recv_pub_key: List[int]) -> (List[int], str, int):
-    recv_pub_key = curve.decode_point(recv_pub_key)
+                 recv_pub_key: List[int] | PeerKey) -> (List[int], bytes, int):
+    return _signcrypt(curve, message.encode("utf-8"), send_id, recv_id, send_priv_key, recv_pub_key)
+
+
+def _signcrypt(curve: Curve, data: bytes, send_id: str, recv_id: str, send_priv_key: int,
+               recv_pub_key: List[int] | PeerKey) -> (List[int], bytes, int):
+    recv_pub_key = _peer_key(curve, recv_pub_key).base()
 
     while True:
         # 2
-        r = random.randint(1, curve.order - 1)
+        r = random_scalar(curve)
         # 3
-        R = r * curve.generator
+        R = mul_generator(curve, r)
         # 4
-        f = floor(log2(curve.order)) + 1
-        xR_wave = (2 ** ceil(f / 2)) * (R.x % (2 ** ceil(f / 2)))
-        K = (r + xR_wave * send_priv_key) * recv_pub_key
+        xR_wave = _xr_wave(curve, R)
+        K = multi_scalar_mul(curve, [(r + xR_wave * send_priv_key, recv_pub_key)])
         if K.is_infinity:
             continue
 
@@ -76,57 +135,238 @@ def signcryption(curve: Curve, message: str, send_id: str, recv_id: str, send_pr
         k = SHA256.new(k_input.encode()).digest()
         # 5
         cipher = AES.new(k, AES.MODE_CBC, iv=IV)
-        C = cipher.encrypt(pad(message.encode("utf-8"), AES.block_size))
+        C = cipher.encrypt(pad(data, AES.block_size))
         # 6
         t_input = C + (str(R.x) + send_id + str(R.y) + recv_id).encode()
         t = SHA256.new(t_input).digest()
         t = int.from_bytes(t, 'big')
         s = (t * send_priv_key - r) % curve.order
 
-        R = curve.encode_point(R)
-        C = b64encode(C).decode("utf-8")
+        R = encode_point(curve, R)
         return R, C, s
 
 
-def unsigncryption(curve: Curve, signcrypted_data: Tuple[List[int], str, int], send_id: str, recv_id: str,
-                   send_pub_key: List[int],
-                   recv_priv_key: int) -> str | None:
+# Steps 1-4 of unsigncryption, returns decrypted bytes and values for the signature check
+def _unsigncrypt(curve: Curve, signcrypted_data: Tuple[List[int], bytes, int], send_id: str, recv_id: str,
+                 send_pub_key: List[int] | PeerKey, recv_priv_key: int):
     R, C, s = signcrypted_data
-    send_pub_key = curve.decode_point(send_pub_key)
-    R = curve.decode_point(R)
-    C = b64decode(C.encode("utf-8"))
+    send_pub_key = _peer_key(curve, send_pub_key)
+    R = decode_point(curve, R)
+    if isinstance(C, str):  # base64 encoded
+        C = b64decode(C.encode("utf-8"))
 
     # 2
-    f = floor(log2(curve.order)) + 1
-    xR_wave = (2 ** ceil(f / 2)) * (R.x % (2 ** ceil(f / 2)))
-    K = recv_priv_key * (R + xR_wave * send_pub_key)
+    xR_wave = _xr_wave(curve, R)
+    K = multi_scalar_mul(curve, [(recv_priv_key, R), (recv_priv_key * xR_wave, send_pub_key.base())])
     k_input = str(K.x) + str(send_id) + str(K.y) + str(recv_id)
     k = SHA256.new(k_input.encode()).digest()
     # 3
     cipher = AES.new(k, AES.MODE_CBC, iv=IV)
     M = unpad(cipher.decrypt(C), AES.block_size)
-    M = M.decode("utf-8")
     # 4
     t_input = C + (str(R.x) + str(send_id) + str(R.y) + str(recv_id)).encode()
     t = SHA256.new(t_input).digest()
     t = int.from_bytes(t, 'big')
+    return M, (s, R, t, send_pub_key)
 
-    if (s * curve.generator) + R == t * send_pub_key:
-        return M
+
+@instrumented('crypto_seconds')
+def unsigncryption(curve: Curve, signcrypted_data: Tuple[List[int], bytes, int], send_id: str, recv_id: str,
+                   send_pub_key: List[int] | PeerKey,
+                   recv_priv_key: int) -> str | None:
+    M, (s, R, t, send_pub_key) = _unsigncrypt(curve, signcrypted_data, send_id, recv_id, send_pub_key,
+                                              recv_priv_key)
+
+    # s * G + R == t * P_a  <=>  s * G + R - t * P_a is the point at infinity
+    if is_identity(curve, [(-t, send_pub_key.base()), (1, R)], gen_scalar=s):
+        return M.decode("utf-8")
     else:
         return None
 
 
-def main():
-    # Test curves
-    print("Checking if curves suitable for signcryption...")
-    for curve_name in CURVE.get_curve_names():
-        curve = Curve.get_curve(curve_name)
-        res = check_curve(curve)
-        if res:
-            print(f"{curve.name}: BAD ({res})")
+# Random linear combination check: sum(z_i * (s_i * G + R_i - t_i * P_i)) is the point at infinity
+def _batch_verify(curve: Curve, checks) -> bool:
+    gen_scalar = 0
+    terms = []
+    senders = {}  # Merge terms of the same sender public key
+    for s, R, t, send_pub_key in checks:
+        z = secrets.randbits(BATCH_SECURITY_BITS) | 1
+        gen_scalar += z * s
+        terms.append((z, R))
+        if send_pub_key in senders:
+            senders[send_pub_key][0] -= z * t
         else:
-            print(f"{curve.name}: OKAY")
+            senders[send_pub_key] = [-z * t, send_pub_key.base()]
+    terms.extend((k, P) for k, P in senders.values())
+    return is_identity(curve, terms, gen_scalar=gen_scalar)
+
+
+# Returns indexes of bad checks, splitting the batch in halves until bad items are isolated
+def _find_bad(curve: Curve, checks, indexes) -> List[int]:
+    if len(indexes) == 1:
+        s, R, t, send_pub_key = checks[indexes[0]]
+        return [] if is_identity(curve, [(-t, send_pub_key.base()), (1, R)], gen_scalar=s) else indexes
+    if _batch_verify(curve, [checks[i] for i in indexes]):
+        return []
+    mid = len(indexes) // 2
+    return _find_bad(curve, checks, indexes[:mid]) + _find_bad(curve, checks, indexes[mid:])
+
+
+@instrumented('crypto_seconds')
+def unsigncryption_batch(curve: Curve,
+                         items: List[Tuple[Tuple[List[int], bytes, int], str, str, List[int] | PeerKey]],
+                         recv_priv_key: int) -> List[str | None]:
+    """
+    Unsigncrypt many messages, verifying all signatures with one batch check.
+    items: (signcrypted_data, send_id, recv_id, send_pub_key) tuples.
+    Returns message for every item, None if item is malformed or its signature is invalid.
+    """
+    results = [None] * len(items)
+    checks, indexes = [], []
+    for i, (signcrypted_data, send_id, recv_id, send_pub_key) in enumerate(items):
+        try:
+            M, check = _unsigncrypt(curve, signcrypted_data, send_id, recv_id, send_pub_key, recv_priv_key)
+            results[i] = M.decode("utf-8")
+        except ValueError:
+            continue
+        checks.append(check)
+        indexes.append(i)
+
+    if checks:
+        for bad in _find_bad(curve, checks, list(range(len(checks)))):
+            results[indexes[bad]] = None
+    return results
+
+
+# Encrypt message with random content key, returns payload and key data (content key + payload hash) to wrap
+def _encrypt_payload(message: str) -> (bytes, bytes):
+    content_key = secrets.token_bytes(32)
+    cipher = AES.new(content_key, AES.MODE_CBC, iv=IV)
+    payload = cipher.encrypt(pad(message.encode("utf-8"), AES.block_size))
+    return payload, content_key + SHA256.new(payload).digest()
+
+
+@instrumented('crypto_seconds')
+def signcryption_multi(curve: Curve, message: str, send_id: str, recipients: Dict[str, List[int] | PeerKey],
+                       send_priv_key: int) -> (bytes, Dict[str, Tuple[List[int], bytes, int]]):
+    """
+    Multi-recipient signcryption: message is encrypted once with a random content key, content key and hash
+    of the encrypted payload are signcrypted to every recipient.
+    recipients: map recipient id to public key.
+    Returns encrypted payload and map recipient id to its signcrypted key wrap.
+    """
+    payload, key_data = _encrypt_payload(message)
+    wraps = {}
+    for recv_id, recv_pub_key in recipients.items():
+        wraps[recv_id] = _signcrypt(curve, key_data, send_id, recv_id, send_priv_key, recv_pub_key)
+    return payload, wraps
+
+
+@instrumented('crypto_seconds')
+def unsigncryption_multi(curve: Curve, payload: bytes, wrap: Tuple[List[int], bytes, int], send_id: str,
+                         recv_id: str, send_pub_key: List[int] | PeerKey, recv_priv_key: int) -> str | None:
+    key_data, (s, R, t, send_pub_key) = _unsigncrypt(curve, wrap, send_id, recv_id, send_pub_key, recv_priv_key)
+    if not is_identity(curve, [(-t, send_pub_key.base()), (1, R)], gen_scalar=s):
+        return None
+
+    content_key, payload_hash = key_data[:32], key_data[32:]
+    if SHA256.new(payload).digest() != payload_hash:  # Payload is not the one signed by sender
+        return None
+    cipher = AES.new(content_key, AES.MODE_CBC, iv=IV)
+    return unpad(cipher.decrypt(payload), AES.block_size).decode("utf-8")
+
+
+# Chunk i is encrypted with AES-GCM, nonce is i. Chain hash of chunks: h_i = SHA256(h_(i-1) + ciphertext_i + tag_i)
+def _chunk_cipher(content_key: bytes, index: int):
+    return AES.new(content_key, AES.MODE_GCM, nonce=index.to_bytes(12, 'big'))
+
+
+def _chain(chain_hash: bytes, chunk: bytes) -> bytes:
+    return SHA256.new(chain_hash + chunk).digest()
+
+
+class StreamSigncrypter:
+    """
+    Streaming multi-recipient signcryption of a byte stream in chunks, bound to one key agreement.
+    start() signcrypts random content key and hash of header (stream metadata) to every recipient, chunk() encrypts
+    and authenticates one chunk, finish() signcrypts chain hash of all chunks and their count to every recipient,
+    so the whole sequence is signed by sender.
+    """
+
+    def __init__(self, curve: Curve, send_id: str, recipients: Dict[str, List[int] | PeerKey], send_priv_key: int,
+                 header: bytes = b''):
+        self.curve = curve
+        self.send_id = send_id
+        self.recipients = recipients
+        self.send_priv_key = send_priv_key
+        self.header = header
+        self.content_key = secrets.token_bytes(32)
+        self.chain_hash = SHA256.new(header).digest()
+        self.count = 0
+
+    def _signcrypt_all(self, data: bytes) -> Dict[str, Tuple[List[int], bytes, int]]:
+        return {recv_id: _signcrypt(self.curve, data, self.send_id, recv_id, self.send_priv_key, recv_pub_key)
+                for recv_id, recv_pub_key in self.recipients.items()}
+
+    # Key wraps: map recipient id to signcrypted content key
+    def start(self) -> Dict[str, Tuple[List[int], bytes, int]]:
+        return self._signcrypt_all(self.content_key + SHA256.new(self.header).digest())
+
+    # Encrypted chunk: ciphertext + 16 bytes tag
+    def chunk(self, data: bytes) -> bytes:
+        ciphertext, tag = _chunk_cipher(self.content_key, self.count).encrypt_and_digest(data)
+        chunk = ciphertext + tag
+        self.chain_hash = _chain(self.chain_hash, chunk)
+        self.count += 1
+        return chunk
+
+    # Signatures: map recipient id to signcrypted chain hash and number of chunks
+    def finish(self) -> Dict[str, Tuple[List[int], bytes, int]]:
+        return self._signcrypt_all(self.chain_hash + self.count.to_bytes(8, 'big'))
+
+
+class StreamUnsigncrypter:
+    """
+    Receiving side of StreamSigncrypter, memory use doesn't depend on stream size. Every method raises ValueError
+    if data is not authentic. Decrypted chunks must not be trusted until finish() succeeded.
+    """
+
+    def __init__(self, curve: Curve, wrap: Tuple[List[int], bytes, int], send_id: str, recv_id: str,
+                 send_pub_key: List[int] | PeerKey, recv_priv_key: int, header: bytes = b''):
+        self.curve = curve
+        self.send_id = send_id
+        self.recv_id = recv_id
+        self.send_pub_key = send_pub_key
+        self.recv_priv_key = recv_priv_key
+        key_data = self._unsigncrypt(wrap)
+        if len(key_data) != 64 or key_data[32:] != SHA256.new(header).digest():
+            raise ValueError("Stream key wrap doesn't match header")
+        self.content_key = key_data[:32]
+        self.chain_hash = SHA256.new(header).digest()
+        self.count = 0
+
+    def _unsigncrypt(self, wrap) -> bytes:
+        data, (s, R, t, send_pub_key) = _unsigncrypt(self.curve, wrap, self.send_id, self.recv_id, self.send_pub_key,
+                                                    self.recv_priv_key)
+        if not is_identity(self.curve, [(-t, send_pub_key.base()), (1, R)], gen_scalar=s):
+            raise ValueError("Invalid stream signature")
+        return data
+
+    # Chunks must come in order
+    def chunk(self, chunk: bytes) -> bytes:
+        ciphertext, tag = chunk[:-16], chunk[-16:]
+        data = _chunk_cipher(self.content_key, self.count).decrypt_and_verify(ciphertext, tag)
+        self.chain_hash = _chain(self.chain_hash, chunk)
+        self.count += 1
+        return data
+
+    def finish(self, wrap: Tuple[List[int], bytes, int]):
+        if self._unsigncrypt(wrap) != self.chain_hash + self.count.to_bytes(8, 'big'):
+            raise ValueError("Stream was modified or truncated")
+
+
+def main():
+    # Curves are checked by curve_audit.py
 
     # Test signcryption
     ID_A, ID_B = 'Alice', 'Bob'
@@ -148,6 +388,22 @@ def main():
     curve_names = ['NIST-P192', 'NIST-P224', 'NIST-P256']
     msg_num = 200
 
+    print("\nGenerator multiplication: generic double-and-add vs fixed-base table")
+    for curve_name in curve_names:
+        curve = Curve.get_curve(curve_name)
+        scalars = [random.randint(1, curve.order - 1) for _ in range(msg_num)]
+        g_start = time.time()
+        for k in scalars:
+            k * curve.generator
+        g_end = time.time()
+        mul_generator(curve, 1)  # Build table outside of timing
+        f_start = time.time()
+        for k in scalars:
+            mul_generator(curve, k)
+        f_end = time.time()
+        generic, fixed = (g_end - g_start) / msg_num, (f_end - f_start) / msg_num
+        print(f"\t{curve.name}: generic {generic} s/iter, fixed-base {fixed} s/iter ({generic / fixed:.1f}x)")
+
     print("\nTime test")
     for msg_size in msg_sizes:
         print(f"msg size: {msg_size}")
@@ -166,6 +422,11 @@ def main():
                                   signcrypted_msgs]
             u_end = time.time()
             print(f"\t\tunsigncryption: {(u_end - u_start) / msg_num} s/iter")
+            clear_decompressed()  # R of every message is decoded again, as for messages not seen before
+            b_start = time.time()
+            unsigncryption_batch(curve, [(s_msg, 'Alice', 'Bob', pub_A) for s_msg in signcrypted_msgs], priv_B)
+            b_end = time.time()
+            print(f"\t\tunsigncryption_batch: {(b_end - b_start) / msg_num} s/iter")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+"""
+Storage backends for users and groups. open_database() picks one by file extension:
+.json - ServerDatabase (whole file is loaded at startup), anything else - SqliteDatabase.
+All keys of a database are on one curve (JSON: "curve" key, SQLite: settings table, default constants.CURVE),
+server tells clients to use it. Curve of SQLite database is set by the first imported or added user.
+
+SqliteDatabase answers lookups with indexed queries and keeps recent answers in a small cache. The cache is
+dropped when PRAGMA data_version changes, i.e. when other process (this module's CLI) changed the database,
+so users and memberships can be added or removed while the server is running.
+
+Command line:
+    storage.py import server_db.json server.db
+    storage.py add-user server.db username keys.json
+    storage.py remove-user server.db username
+    storage.py add-member server.db group_name username
+    storage.py remove-member server.db group_name username
+"""
+import argparse
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from constants import CURVE
+from ecmath import convert_point, curve_by_name
+from server_structs import ServerDatabase
+
+DB_CACHE_SIZE = 4096  # Cached lookups of SqliteDatabase
+# Not INSERT OR REPLACE: replaced row would lose its memberships (ON DELETE CASCADE)
+UPSERT_USER = "INSERT INTO users VALUES (?, ?) ON CONFLICT (username) DO UPDATE SET public_key = excluded.public_key"
+
+
+# Keys are stored compressed, server converts them to the form of every connection
+def _key_blob(curve, public_key) -> bytes:
+    return bytes(convert_point(curve, public_key, True))
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    public_key BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS memberships (
+    group_name TEXT NOT NULL,
+    username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+    PRIMARY KEY (group_name, username)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA journal_mode = WAL")  # Readers are not blocked by CLI updates
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_curve(conn: sqlite3.Connection):
+    row = conn.execute("SELECT value FROM settings WHERE name = 'curve'").fetchone()
+    return curve_by_name(row[0]) if row is not None else CURVE
+
+
+# Keys of database must be on one curve, it can be changed only while there are no users
+def set_curve(conn: sqlite3.Connection, curve):
+    current = get_curve(conn)
+    if current.name == curve.name:
+        return
+    if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None:
+        raise ValueError(f"Keys of database are on curve '{current.name}', not '{curve.name}'")
+    conn.execute("INSERT OR REPLACE INTO settings VALUES ('curve', ?)", (curve.name,))
+
+
+class SqliteDatabase:
+    # Same lookups as ServerDatabase
+
+    def __init__(self, path: str, cache_size: int = DB_CACHE_SIZE):
+        self.conn = connect(path)
+        self.curve = get_curve(self.conn)  # Can't change while server runs: database has users
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # Map (query, args) to result
+        self.cache_size = cache_size
+        self.data_version = None
+
+    def _query(self, sql: str, args: tuple, fetch):
+        key = (sql, args)
+        with self.lock:
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != self.data_version:  # Database was changed by other connection
+                self.cache.clear()
+                self.data_version = data_version
+            elif key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+            result = fetch(self.conn.execute(sql, args))
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return result
+
+    def check_access_to_group(self, username, group_name):
+        return self._query("SELECT 1 FROM memberships WHERE group_name = ? AND username = ?",
+                           (group_name, username), lambda cursor: cursor.fetchone() is not None)
+
+    def get_group_members(self, group_name) -> list:
+        return self._query("SELECT username FROM memberships WHERE group_name = ?", (group_name,),
+                           lambda cursor: [username for (username,) in cursor])
+
+    # Returns None if there is no such user
+    def get_public_key(self, username):
+        row = self._query("SELECT public_key FROM users WHERE username = ?", (username,),
+                          lambda cursor: cursor.fetchone())
+        return list(row[0]) if row is not None else None
+
+
+# Adds users or replaces their keys in one transaction, users: [(username, public_key)] with keys on curve
+def upsert_users(conn: sqlite3.Connection, curve, users, group_name: str = None):
+    with conn:
+        set_curve(conn, curve)
+        conn.executemany(UPSERT_USER, [(username, _key_blob(curve, public_key)) for username, public_key in users])
+        if group_name is not None:
+            conn.executemany("INSERT OR IGNORE INTO memberships VALUES (?, ?)",
+                             [(group_name, username) for username, _ in users])
+
+
+def open_database(path: str):
+    if path.endswith('.json'):
+        return ServerDatabase(path)
+    return SqliteDatabase(path)
+
+
+def import_json(json_path: str, db_path: str) -> (int, int):
+    with open(json_path, 'r') as fp:
+        data = json.load(fp)
+    curve = curve_by_name(data.get('curve', CURVE.name))
+    conn = connect(db_path)
+    try:
+        with conn:
+            set_curve(conn, curve)
+            conn.executemany(UPSERT_USER,
+                             [(user['username'], _key_blob(curve, user['public_key'])) for user in data['users']])
+            memberships = [(group['group_name'], username)
+                           for group in data['groups'] for username in group['members']]
+            # Users of database count too, foreign key would fail on the first unknown one without naming it
+            known = {username for (username,) in conn.execute("SELECT username FROM users")}
+            for group_name, username in memberships:
+                if username not in known:
+                    raise ValueError(f"Group '{group_name}' has unknown member '{username}'")
+            conn.executemany("INSERT OR IGNORE INTO memberships VALUES (?, ?)", memberships)
+    finally:
+        conn.close()
+    return len(data['users']), len(memberships)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage SQLite user/group store, also while server is running")
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('import', help="import JSON database")
+    command.add_argument("json_path", type=str)
+    command.add_argument("db_path", type=str)
+    command = commands.add_parser('add-user', help="add user or replace its public key")
+    command.add_argument("db_path", type=str)
+    command.add_argument("username", type=str)
+    command.add_argument("keys_path", type=str, help="json with public key of user")
+    command = commands.add_parser('remove-user', help="remove user and its memberships")
+    command.add_argument("db_path", type=str)
+    command.add_argument("username", type=str)
+    for name in ('add-member', 'remove-member'):
+        command = commands.add_parser(name, help=f"{name.split('-')[0]} user to/from group")
+        command.add_argument("db_path", type=str)
+        command.add_argument("group_name", type=str)
+        command.add_argument("username", type=str)
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        try:
+            users, memberships = import_json(args.json_path, args.db_path)
+        except ValueError as e:
+            print(f"[ERROR] {e}")
+            return
+        print(f"[INFO] Imported {users} users and {memberships} memberships")
+        return
+
+    conn = connect(args.db_path)
+    try:
+        with conn:
+            if args.command == 'add-user':
+                with open(args.keys_path, 'r') as fp:
+                    keys = json.load(fp)
+                curve = curve_by_name(keys.get('curve', CURVE.name))
+                set_curve(conn, curve)
+                conn.execute(UPSERT_USER, (args.username, _key_blob(curve, keys['public'])))
+            elif args.command == 'remove-user':
+                conn.execute("DELETE FROM users WHERE username = ?", (args.username,))
+            elif args.command == 'add-member':
+                conn.execute("INSERT OR IGNORE INTO memberships VALUES (?, ?)", (args.group_name, args.username))
+            else:
+                conn.execute("DELETE FROM memberships WHERE group_name = ? AND username = ?",
+                             (args.group_name, args.username))
+    except sqlite3.IntegrityError:
+        print(f"[ERROR] No user '{args.username}'")
+        return
+    except ValueError as e:
+        print(f"[ERROR] {e}")
+        return
+    finally:
+        conn.close()
+    print("[INFO] Done")
+
+
+if __name__ == "__main__":
+    main()
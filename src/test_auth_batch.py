@@ -0,0 +1,53 @@
+"""
+Checks of batched ZKKSP verification. Run: python -m pytest -q src
+"""
+import secrets
+
+from ecpy.curves import Curve
+
+from auth_batch import AuthBatcher
+from ecmath import decode_point, encode_point, mul_generator
+from signcryption import gen_keys, peer_keys
+
+CURVE = Curve.get_curve('NIST-P192')
+
+
+# (public_key, commitment, challenge, zkksp_response) of user who knows its private key
+def _proof(valid: bool = True):
+    private_key, public_key = gen_keys(CURVE)
+    r, challenge = secrets.randbelow(CURVE.order - 1) + 1, secrets.randbelow(CURVE.order - 1) + 1
+    commitment = encode_point(CURVE, mul_generator(CURVE, r))
+    return public_key, commitment, challenge, (r + challenge * private_key + (0 if valid else 1)) % CURVE.order
+
+
+class _BrokenKey:
+    def base(self):
+        raise RuntimeError("broken key")
+
+
+def test_verify():
+    batcher = AuthBatcher(CURVE, window=0.05, max_size=8)
+    proofs = [_proof(i not in (3, 9)) for i in range(12)]
+    futures = [batcher.submit(*proof) for proof in proofs]
+    assert [future.result(timeout=5) for future in futures] == [i not in (3, 9) for i in range(12)]
+
+    public_key, commitment, challenge, zkksp_response = _proof()
+    for response in (float(zkksp_response), -zkksp_response, zkksp_response + CURVE.order, str(zkksp_response)):
+        assert not batcher.verify(public_key, commitment, challenge, response)
+    assert not batcher.verify(public_key, [2, *b'\xff' * (len(commitment) - 1)], challenge, zkksp_response)
+    assert not batcher.verify(public_key, None, challenge, zkksp_response)
+    assert batcher.verify(public_key, commitment, challenge, zkksp_response)
+
+
+# Error in batch check doesn't fail the other proofs of batch, the proof that raised fails
+def test_find_bad_fallback(capsys):
+    batcher = AuthBatcher(CURVE)
+    checks = []
+    for i in range(6):
+        public_key, commitment, challenge, zkksp_response = _proof(i != 1)
+        checks.append((zkksp_response, -decode_point(CURVE, commitment), challenge, peer_keys.get(CURVE, public_key)))
+    assert batcher.find_bad(checks) == {1}
+    s, R, t, _ = checks[4]
+    checks[4] = s, R, t, _BrokenKey()
+    assert batcher.find_bad(checks) == {1, 4}
+    assert '[ERROR] ZKKSP batch check failed' in capsys.readouterr().out
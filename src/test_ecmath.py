@@ -0,0 +1,70 @@
+"""
+Checks of fast curve arithmetic against ecpy. Run: python -m pytest -q src
+"""
+import secrets
+
+import pytest
+from ecpy.curves import Curve
+
+from ecmath import (mul_generator, multi_scalar_mul, is_identity, generator_table, encode_point, decode_point,
+                    convert_point, sqrt_mod)
+
+# P-224 has q = 1 mod 4, so its points are decompressed with Tonelli-Shanks
+CURVES = ['NIST-P192', 'NIST-P224', 'NIST-P256', 'secp256k1', 'Brainpool-p256r1']
+
+
+def _random_point(curve):
+    return secrets.randbelow(curve.order - 1) * curve.generator
+
+
+@pytest.mark.parametrize('name', CURVES)
+def test_mul_generator(name):
+    curve = Curve.get_curve(name)
+    for k in [0, 1, 2, curve.order - 1, curve.order, curve.order + 5, *(secrets.randbelow(curve.order)
+                                                                          for _ in range(5))]:
+        assert mul_generator(curve, k) == k * curve.generator
+
+
+@pytest.mark.parametrize('name', CURVES)
+def test_multi_scalar_mul(name):
+    curve = Curve.get_curve(name)
+    points = [_random_point(curve) for _ in range(3)]
+    scalars = [secrets.randbelow(curve.order) for _ in range(3)]
+    gen_scalar = secrets.randbelow(curve.order)
+    expected = gen_scalar * curve.generator
+    for k, P in zip(scalars, points):
+        expected = expected + k * P
+    terms = list(zip(scalars, points))
+    assert multi_scalar_mul(curve, terms, gen_scalar) == expected
+    # Point given as its fixed-base table, scalars 1 and -1, point at infinity
+    assert multi_scalar_mul(curve, [(scalars[0], generator_table(curve)), (1, points[1])]) == \
+        scalars[0] * curve.generator + points[1]
+    assert multi_scalar_mul(curve, [(curve.order - 1, points[0]), (5, curve.infinity)]) == -points[0]
+    assert is_identity(curve, [(1, points[0]), (curve.order - 1, points[0])])
+    assert not is_identity(curve, terms, gen_scalar)
+
+
+@pytest.mark.parametrize('name', CURVES)
+def test_point_encoding(name):
+    curve = Curve.get_curve(name)
+    for _ in range(5):
+        P = _random_point(curve)
+        compressed, uncompressed = encode_point(curve, P), encode_point(curve, P, False)
+        assert decode_point(curve, compressed) == P == decode_point(curve, uncompressed)
+        assert convert_point(curve, compressed, False) == list(uncompressed)
+        assert convert_point(curve, uncompressed, True) == list(compressed)
+    with pytest.raises(ValueError):
+        decode_point(curve, [4, *bytes(len(uncompressed) - 1)])
+    with pytest.raises(ValueError):
+        convert_point(curve, compressed[:-1], False)
+
+
+@pytest.mark.parametrize('name', CURVES)
+def test_sqrt_mod(name):
+    q = Curve.get_curve(name).field
+    for _ in range(10):
+        a = secrets.randbelow(q)
+        root = sqrt_mod(a * a % q, q)
+        assert root in (a, q - a) or a == 0 and root == 0
+    non_residue = next(a for a in range(2, 100) if pow(a, (q - 1) // 2, q) == q - 1)
+    assert sqrt_mod(non_residue, q) is None
@@ -0,0 +1,84 @@
+"""
+Checks of the append-only message log. Run: python -m pytest -q src
+"""
+import json
+import os
+import time
+
+from message_log import GroupLog, MessageLog
+from protocol import Opaque
+
+_R = [2, *range(1, 25)]
+
+
+def _request(recipient: str, text: str) -> dict:
+    return {'action': 'send_message', 'group': 'gr1', 'reciever': recipient,
+            'signcrypted_msg': (_R, text.encode().ljust(96, b'.'), 12345)}
+
+
+def _texts(log: GroupLog, recipient: str) -> list:
+    return [bytes(request['signcrypted_msg'].value()[1]).rstrip(b'.').decode()
+            for _, _, request in log.backlog(recipient)]
+
+
+def test_backlog_and_cursors(tmp_path):
+    log = GroupLog(str(tmp_path))
+    for i in range(5):
+        log.append('Alice', _request('Bob', f'to bob {i}'), ['Bob'])
+    log.append('Bob', _request('Clark', 'to clark'), ['Clark', 'Alice'])
+    assert log.pending('Bob') == 5 and log.pending('Clark') == 1 and log.pending('Daniel') == 0
+
+    position, sender, request = log.backlog('Clark')[0]
+    assert sender == 'Bob' and isinstance(request['signcrypted_msg'], Opaque)  # Payload is a slice of the map
+    assert _texts(log, 'Clark') == ['to clark'] == _texts(log, 'Alice')
+
+    backlog = log.backlog('Bob', max_size=1)  # At least one record
+    assert len(backlog) == 1
+    log.delivered('Bob', backlog[0][0])
+    assert log.pending('Bob') == 4 and _texts(log, 'Bob') == [f'to bob {i}' for i in range(1, 5)]
+    log.delivered('Bob', backlog[0][0])  # Cursor doesn't go back
+    assert log.pending('Bob') == 4
+    log.close()
+
+
+# Index is rebuilt from record headers, cursors are the saved ones: messages after last save are sent again
+def test_restart_recovery(tmp_path):
+    log = GroupLog(str(tmp_path))
+    positions = [log.append('Alice', _request('Bob', f'message {i}'), ['Bob']) for i in range(4)]
+    log.delivered('Bob', positions[0])
+    log.save()
+    log.delivered('Bob', positions[2])  # Not saved before crash
+
+    recovered = GroupLog(str(tmp_path))
+    assert recovered.positions == {'Bob': positions} and recovered.pending('Bob') == 3
+    position = recovered.append('Alice', _request('Bob', 'after restart'), ['Bob'])
+    assert position > positions[-1]
+    assert _texts(recovered, 'Bob') == ['message 1', 'message 2', 'message 3', 'after restart']
+    recovered.close()
+    log.close()
+
+
+def test_rotation(tmp_path):
+    log = GroupLog(str(tmp_path), segment_size=512, max_segments=2)
+    assert log.append('Alice', _request('Bob', 'x' * 600), ['Bob']) is None  # Larger than segment
+    positions = [log.append('Alice', _request('Bob', f'message {i}'), ['Bob']) for i in range(10)]
+    assert len(log.segments) == 2 and sorted(os.listdir(tmp_path)) == \
+        sorted([os.path.basename(segment.path) for segment in log.segments] + ['cursors.json'])
+
+    retained = log.positions['Bob']  # Records of deleted segments are dropped from index
+    assert len(retained) < len(positions) and retained == positions[-len(retained):]
+    assert retained[0] == log.segments[0].base
+    assert _texts(log, 'Bob') == [f'message {i}' for i in range(10 - len(retained), 10)]
+    log.close()
+    assert GroupLog(str(tmp_path), segment_size=512, max_segments=2).positions == {'Bob': retained}
+
+
+def test_cursors_saved_periodically(tmp_path):
+    log = MessageLog(str(tmp_path), save_interval=0.05)
+    group = log.group('gr1')
+    assert log.group('gr1') is group
+    group.delivered('Bob', group.append('Alice', _request('Bob', 'hello'), ['Bob']))
+    time.sleep(0.3)
+    assert not group.changed
+    with open(os.path.join(group.path, 'cursors.json'), 'r') as fp:
+        assert json.load(fp) == {'Bob': 1}
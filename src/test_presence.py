@@ -0,0 +1,98 @@
+"""
+Checks of coalesced presence messages. Run: python -m pytest -q src
+"""
+import os
+
+from ecmath import convert_point
+from presence import Presence
+from server_structs import ServerDatabase, Sessions
+
+DATABASE = ServerDatabase(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'server_db.json'))
+
+
+def _key(username: str) -> list:
+    return DATABASE.get_public_key(username)
+
+
+# Presence with flusher thread that doesn't run during test (flush() is called by test), sockets are usernames
+def _presence(offline: bool = False):
+    sessions, sent = Sessions(), []
+    presence = Presence(DATABASE.curve, DATABASE, sessions, lambda sock, message, frames: sent.append(
+        (sock, message, frames)), window=3600, offline=offline)
+    return presence, sessions, sent
+
+
+def _join(presence: Presence, sessions: Sessions, username: str, seen: dict = None) -> dict:
+    group = presence.group('gr1')
+    with group.lock:
+        sessions.add_session(username, username, 'gr1')
+        return presence.join('gr1', group, username, _key(username), seen)
+
+
+def _leave(presence: Presence, sessions: Sessions, username: str):
+    sessions.del_session(username)
+    presence.leave('gr1', username)
+
+
+def _received(sent: list) -> dict:
+    assert len({id(frames) for _, _, frames in sent}) == 1  # Encoded once for all members
+    return {sock: message for sock, message, _ in sent}
+
+
+# Changes of a window go to every member as one message
+def test_coalescing():
+    presence, sessions, sent = _presence()
+    for username in ('Alice', 'Bob', 'Clark'):
+        _join(presence, sessions, username)
+    presence.flush()
+    message = {'action': 'presence', 'joined': {usr: _key(usr) for usr in ('Alice', 'Bob', 'Clark')}, 'left': []}
+    assert _received(sent) == {usr: message for usr in ('Alice', 'Bob', 'Clark')}
+
+    sent.clear()
+    _leave(presence, sessions, 'Bob')
+    _leave(presence, sessions, 'Clark')
+    _join(presence, sessions, 'Clark')  # Reconnect within window
+    presence.flush()
+    message = {'action': 'presence', 'joined': {'Clark': _key('Clark')}, 'left': ['Bob']}
+    assert _received(sent) == {'Alice': message, 'Clark': message}
+    assert presence.group('gr1').members == {'Alice': _key('Alice'), 'Clark': _key('Clark')}
+
+    sent.clear()
+    presence.flush()
+    assert sent == []
+
+
+# Joined member is announced to others before the window ends, so they know its key before its messages
+def test_announce():
+    presence, sessions, sent = _presence()
+    _join(presence, sessions, 'Alice')
+    presence.flush()
+    sent.clear()
+    _join(presence, sessions, 'Bob')
+    presence.announce('gr1', 'Bob')
+    message = {'action': 'presence', 'joined': {'Bob': _key('Bob')}, 'left': []}
+    assert _received(sent) == {'Alice': message, 'Bob': message}
+    sent.clear()
+    presence.announce('gr1', 'Bob')
+    assert sent == []
+
+
+# Joining member gets member lists of last presence message and the changes since then
+def test_join_snapshot():
+    presence, sessions, sent = _presence(offline=True)
+    _join(presence, sessions, 'Alice')
+    presence.flush()
+    group = presence.group('gr1')
+    with group.lock:
+        members, offline = presence.snapshot('gr1', group)
+        assert presence.snapshot('gr1', group)[0] is members  # Encoded once until next presence message
+        seen = group.members
+    assert members.value() == {'Alice': convert_point(DATABASE.curve, _key('Alice'), True)}
+    assert offline.value() == {usr: convert_point(DATABASE.curve, _key(usr), True) for usr in ('Bob', 'Clark')}
+
+    # Presence message was sent while stored messages of Bob were sent: Bob gets its changes too
+    _join(presence, sessions, 'Clark')
+    presence.flush()
+    _leave(presence, sessions, 'Alice')
+    assert _join(presence, sessions, 'Bob', seen) == \
+        {'action': 'presence', 'joined': {'Clark': _key('Clark'), 'Bob': _key('Bob')}, 'left': ['Alice']}
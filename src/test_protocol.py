@@ -0,0 +1,192 @@
+"""
+Checks of wire codecs and framing. Run: python -m pytest -q src
+"""
+import json
+import secrets
+import socket
+
+import pytest
+from ecpy.curves import Curve
+
+from ecmath import encode_point, convert_point
+from protocol import (SCHEMAS, JSON_CODEC, BINARY_CODEC, COMPRESSED_POINTS, FRAME_HEADER, SPLICE_SIZE, JsonCodec,
+                      BinaryCodec, Connection, FrameReader, Opaque, OutboundQueue, ProtocolError, SlowConsumerError,
+                      codec_for, encode_frame)
+
+CURVE = Curve.get_curve('NIST-P192')
+
+
+def _random_point(curve):
+    return secrets.randbelow(curve.order - 1) * curve.generator
+
+
+_R = list(encode_point(CURVE, _random_point(CURVE)))
+_KEY = list(encode_point(CURVE, _random_point(CURVE)))
+_WRAP = (_R, b'\x00wrapped key', 2 ** 100 + 7)
+MESSAGES = [
+    {'action': 'authentication', 'username': 'Alice', 'group_name': 'gr1', 'commitment': _KEY},
+    {'action': 'prove', 'zkksp_response': 2 ** 190 + 1},
+    {'action': 'send_message', 'group': 'gr1', 'reciever': 'Bob', 'signcrypted_msg': (_R, b'ciphertext', 12345)},
+    {'action': 'send_multi', 'group': 'gr1', 'payload': bytes(range(256)), 'wraps': {'Bob': _WRAP, 'Clark': _WRAP}},
+    {'action': 'file_start', 'group': 'gr1', 'stream': 3, 'name': 'notes.txt', 'size': 0, 'wraps': {}},
+    {'action': 'file_chunk', 'stream': 3, 'data': b''},
+    {'action': 'file_end', 'stream': 3, 'wraps': {'Bob': _WRAP}},
+    {'status': 'challenge', 'challenge': 0},
+    {'status': 'success', 'members': {'Alice': _KEY, 'Боб': _KEY}, 'offline': {}, 'offline_delivery': 1,
+     'backlog': 2},
+    {'status': 'denied', 'reason': 'Invalid proof'},
+    {'action': 'msg', 'sender': 'Alice', 'signcrypted_msg': _WRAP},
+    {'action': 'multi_msg', 'sender': 'Alice', 'payload': b'payload', 'signcrypted_msg': _WRAP},
+    {'action': 'file_offer', 'sender': 'Alice', 'stream': 1, 'name': 'a.bin', 'size': 10, 'signcrypted_msg': _WRAP},
+    {'action': 'file_data', 'sender': 'Alice', 'stream': 1, 'data': b'0123456789'},
+    {'action': 'file_done', 'sender': 'Alice', 'stream': 1, 'signcrypted_msg': _WRAP},
+    {'action': 'presence', 'joined': {'Daniel': _KEY}, 'left': ['Bob', 'Clark']},
+]
+
+
+def test_messages_cover_schemas():
+    assert sorted({(key, message[key]) for message in MESSAGES for key in ('action', 'status') if key in message}) \
+        == sorted((key, value) for key, value, _ in SCHEMAS.values())
+
+
+# Decoded message has the same values, signcrypted fields come back as tuples
+@pytest.mark.parametrize('codec', [JsonCodec, BinaryCodec])
+@pytest.mark.parametrize('message', MESSAGES)
+def test_codec_round_trip(codec, message):
+    assert codec.decode(codec.encode(message)) == message
+
+
+@pytest.mark.parametrize('code', [JSON_CODEC, BINARY_CODEC])
+@pytest.mark.parametrize('compressed', [True, False])
+def test_point_codec_converts_points(code, compressed):
+    codec = codec_for(code | (COMPRESSED_POINTS if compressed else 0), CURVE)
+    message = {'status': 'success', 'members': {'Alice': _KEY}, 'offline': {'Bob': _KEY},
+               'offline_delivery': 0, 'backlog': 0}
+    decoded = codec.decode(b''.join(bytes(part) for part in codec.frame(message))[FRAME_HEADER.size:])
+    key = convert_point(CURVE, _KEY, compressed)
+    assert decoded['members'] == {'Alice': key} and decoded['offline'] == {'Bob': key}
+
+
+def test_point_codec_rejects_invalid_point():
+    codec = codec_for(BINARY_CODEC, CURVE)  # Uncompressed points, compressed R has to be decompressed
+    bad = [2, *b'\xff' * (len(_R) - 1)]  # x >= q
+    with pytest.raises(ProtocolError):
+        codec.encode({'action': 'msg', 'sender': 'Alice', 'signcrypted_msg': (bad, b'', 1)})
+
+
+@pytest.mark.parametrize('message', MESSAGES)
+def test_truncated_binary_message(message):
+    payload = BinaryCodec.encode(message)
+    for size in range(len(payload)):
+        with pytest.raises(ProtocolError):
+            BinaryCodec.decode(payload[:size])
+        with pytest.raises(ProtocolError):
+            BinaryCodec.decode(payload[:size], opaque=True)
+    with pytest.raises(ProtocolError):
+        BinaryCodec.decode(payload + b'\x00')
+
+
+# Server forwards payload fields as received, they are decoded only for JSON connections or other point form
+@pytest.mark.parametrize('code', [JSON_CODEC, BINARY_CODEC])
+@pytest.mark.parametrize('compressed', [True, False])
+def test_opaque_relay(code, compressed):
+    payload = bytes(range(256)) * (SPLICE_SIZE // 256)
+    message = {'action': 'send_multi', 'group': 'gr1', 'payload': payload, 'wraps': {'Bob': _WRAP}}
+    received = codec_for(BINARY_CODEC | COMPRESSED_POINTS, CURVE, opaque=True).decode(BinaryCodec.encode(message))
+    assert isinstance(received['payload'], Opaque) and isinstance(received['wraps']['Bob'], Opaque)
+    codec = codec_for(code | (COMPRESSED_POINTS if compressed else 0), CURVE)
+    frame = codec.frame({'action': 'multi_msg', 'sender': 'Alice', 'payload': received['payload'],
+                         'signcrypted_msg': received['wraps']['Bob']})
+    R, C, s = _WRAP
+    assert codec.decode(b''.join(bytes(part) for part in frame)[FRAME_HEADER.size:]) == \
+        {'action': 'multi_msg', 'sender': 'Alice', 'payload': payload,
+         'signcrypted_msg': (convert_point(CURVE, R, compressed), C, s)}
+    if code == BINARY_CODEC:  # Large payload is sent from received frame, not copied
+        assert any(part is received['payload'].data for part in frame)
+
+
+@pytest.mark.parametrize('payload', [
+    b'', b'{', b'[1, 2]', b'\xff\xfe', b'{"action": "unknown"}', b'{"action": ["prove"]}', b'{"action": "prove"}',
+    b'{"action": "prove", "zkksp_response": 1.5}', b'{"action": "prove", "zkksp_response": -1}',
+    b'{"action": "prove", "zkksp_response": true}', b'{"action": "prove", "zkksp_response": "1"}',
+    b'{"action": "authentication", "username": "Alice", "group_name": "gr1", "commitment": [256]}',
+    b'{"action": "authentication", "username": 1, "group_name": "gr1", "commitment": [2]}',
+    b'{"action": "file_chunk", "stream": 1, "data": "not base64!"}',
+    b'{"action": "msg", "sender": "Alice", "signcrypted_msg": [[2], "", 1, 2]}',
+    b'{"action": "file_end", "stream": 1, "wraps": []}',
+    b'{"action": "presence", "joined": {}, "left": "Bob"}',
+])
+def test_malformed_json_message(payload):
+    with pytest.raises(ProtocolError):
+        JsonCodec.decode(payload)
+
+
+def test_unknown_binary_message_type():
+    with pytest.raises(ProtocolError):
+        BinaryCodec.decode(bytes([255]))
+    with pytest.raises(ProtocolError):
+        codec_for(7, CURVE)
+
+
+def test_frame_reader():
+    reader = FrameReader(max_frame_size=100)
+    frames = [json.dumps(message, default=str).encode()[:90] for message in MESSAGES[:3]]
+    data = b''.join(encode_frame(frame) for frame in frames)
+    received = []
+    for i in range(0, len(data), 7):  # Frames split between reads
+        received += reader.feed(data[i:i + 7])
+    assert received == frames and not reader.buffer
+    assert reader.feed(encode_frame(b'x' * 100)[:-1]) == []
+    with pytest.raises(ProtocolError):
+        FrameReader(max_frame_size=100).feed(encode_frame(b'x' * 101))
+
+
+def _drain(queue: OutboundQueue) -> bytes:
+    data = b''
+    while (batch := queue.get()) is not None:
+        data += b''.join(batch)
+    return data
+
+
+# Own frames are always queued, frames of other connections over the limit are handled by policy
+@pytest.mark.parametrize('policy', ['drop', 'disconnect', 'spill'])
+def test_outbound_queue(policy):
+    queue = OutboundQueue(limit=100, policy=policy, spill_limit=150)
+    assert queue.put([b'a' * 60], own=False) and queue.put([b'b' * 60])
+    if policy == 'spill':
+        assert queue.put([b'c' * 60], own=False) and queue.put([b'd', b'd' * 59], own=False)
+        assert not queue.put([b'e' * 60], own=False)  # Over spill limit
+        assert queue.put([b'f' * 60]) and queue.spilled == 180
+        expected = 'abcdf'
+    else:
+        assert not queue.put([b'c' * 60], own=False)
+        expected = 'ab'
+    assert queue.dropped == 1 and queue.peak == 60 * len(expected)
+    assert _drain(queue) == b''.join(c.encode() * 60 for c in expected)
+    assert queue.depth() == 0 and queue.spill is None
+    assert queue.put([b'g' * 60], own=False)  # Writer caught up, frames go to memory again
+
+    queue.clear()
+    assert not queue.put([b'h']) and queue.get() is None
+
+
+@pytest.mark.parametrize('policy', ['drop', 'disconnect', 'spill'])
+def test_post_to_slow_consumer(policy):
+    sock, peer = socket.socketpair()
+    connection = Connection(sock)
+    connection.codec = codec_for(BINARY_CODEC, CURVE)
+    connection.outbound = OutboundQueue(limit=100, policy=policy, spill_limit=100)  # No writer, nothing is sent
+    message = {'action': 'file_data', 'sender': 'Alice', 'stream': 1, 'data': bytes(60)}
+    connection.post(message)
+    if policy == 'spill':
+        connection.post(message)
+    with pytest.raises(SlowConsumerError) as error:
+        connection.post(message)
+    if policy == 'drop':
+        assert not error.value.evicted and not connection.outbound.closed
+    else:
+        assert error.value.evicted and peer.recv(1) == b''  # Receiver is disconnected
+        with pytest.raises(ConnectionResetError):  # and not reported as slow consumer again
+            connection.post(message)
+    sock.close()
+    peer.close()
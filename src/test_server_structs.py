@@ -0,0 +1,38 @@
+"""
+Tests of server session registry. Run: python -m pytest -q src
+"""
+from server_structs import Sessions
+
+
+def test_sessions_indexes():
+    sessions, alice, bob = Sessions(), object(), object()
+    assert sessions.add_session(alice, 'Alice', 'gr1')
+    assert sessions.add_session(bob, 'Bob', 'gr1')
+    assert not sessions.add_session(object(), 'Alice', 'gr1')  # Second session of user in group
+    assert sessions.get_socket('Alice', 'gr1') is alice and sessions.get_username(bob) == 'Bob'
+    assert set(sessions.get_group_sockets('gr1')) == {alice, bob} and sessions.group_sizes() == {'gr1': 2}
+    sessions.del_session(alice)
+    sessions.del_session(alice)
+    assert sessions.get_socket('Alice', 'gr1') is None and sessions.get_group_sockets('gr1') == [bob]
+
+
+# Socket with a session can't get another one, its old entries would stay after it disconnects
+def test_socket_has_one_session():
+    sessions, clark = Sessions(), object()
+    assert sessions.add_session(clark, 'Clark', 'gr1')
+    assert not sessions.add_session(clark, 'Clark', 'gr2')
+    sessions.del_session(clark)
+    assert sessions.get_socket('Clark', 'gr1') is None and sessions.get_socket('Clark', 'gr2') is None
+    assert sessions.group_sizes() == {}
+    assert sessions.add_session(object(), 'Clark', 'gr1')
+
+
+# Other connections don't send to joining session before its success response and presence
+def test_joining_session_is_hidden():
+    sessions, alice, bob = Sessions(), object(), object()
+    assert sessions.add_session(alice, 'Alice', 'gr1')
+    assert sessions.add_session(bob, 'Bob', 'gr1', joining=True)
+    assert not sessions.add_session(object(), 'Bob', 'gr1')
+    assert sessions.get_socket('Bob', 'gr1') is None and sessions.get_group_sockets('gr1') == [alice]
+    sessions.joined(bob)
+    assert sessions.get_socket('Bob', 'gr1') is bob and set(sessions.get_group_sockets('gr1')) == {alice, bob}
@@ -0,0 +1,126 @@
+"""
+Checks of signcryption scheme and its batch verification. Run: python -m pytest -q src
+"""
+import pytest
+from ecpy.curves import Curve
+
+from signcryption import gen_keys, signcryption, unsigncryption, unsigncryption_batch, signcryption_multi, \
+    unsigncryption_multi, StreamSigncrypter, StreamUnsigncrypter, _unsigncrypt, _batch_verify, _find_bad
+
+CURVE = Curve.get_curve('NIST-P192')
+KEYS = {name: gen_keys(CURVE) for name in ('Alice', 'Bob', 'Clark')}
+
+
+def _signcrypt_to_bob(message: str, send_id: str):
+    return signcryption(CURVE, message, send_id, 'Bob', KEYS[send_id][0], KEYS['Bob'][1])
+
+
+# Wrong key gives random plaintext: its padding is usually invalid (ValueError), else signature check fails
+def _rejected(unsigncrypt, *args) -> bool:
+    try:
+        return unsigncrypt(*args) is None
+    except ValueError:
+        return True
+
+
+def test_signcryption_round_trip():
+    signcrypted = _signcrypt_to_bob('hello', 'Alice')
+    assert unsigncryption(CURVE, signcrypted, 'Alice', 'Bob', KEYS['Alice'][1], KEYS['Bob'][0]) == 'hello'
+    R, C, s = signcrypted
+    assert unsigncryption(CURVE, (R, C, (s + 1) % CURVE.order), 'Alice', 'Bob', KEYS['Alice'][1],
+                          KEYS['Bob'][0]) is None
+
+
+# Bad signatures among valid ones of the same and of other senders are located
+def test_find_bad():
+    checks = []
+    for i in range(8):
+        send_id = 'Alice' if i % 3 else 'Clark'
+        _, check = _unsigncrypt(CURVE, _signcrypt_to_bob(f'message {i}', send_id), send_id, 'Bob', KEYS[send_id][1],
+                                KEYS['Bob'][0])
+        checks.append(check)
+    indexes = list(range(len(checks)))
+    assert _batch_verify(CURVE, checks) and _find_bad(CURVE, checks, indexes) == []
+    for bad in ([3], [0, 5], [1, 2, 6, 7], indexes):
+        tampered = [((s + 1) % CURVE.order if i in bad else s, R, t, P) for i, (s, R, t, P) in enumerate(checks)]
+        assert not _batch_verify(CURVE, tampered)
+        assert _find_bad(CURVE, tampered, indexes) == bad
+
+
+def test_unsigncryption_batch():
+    items = [(_signcrypt_to_bob(f'message {i}', send_id), send_id, 'Bob', KEYS[send_id][1])
+             for i, send_id in enumerate(['Alice', 'Clark'] * 3)]
+    (R, C, s), send_id, recv_id, send_pub_key = items[2]
+    items[2] = (R, C, (s + 1) % CURVE.order), send_id, recv_id, send_pub_key  # Forged signature
+    items[4] = (R, C[:-1], s), send_id, recv_id, send_pub_key  # Malformed ciphertext
+    items[5] = items[5][0], 'Alice', recv_id, KEYS['Alice'][1]  # Other sender
+    assert unsigncryption_batch(CURVE, items, KEYS['Bob'][0]) == \
+        ['message 0', 'message 1', None, 'message 3', None, None]
+    assert unsigncryption_batch(CURVE, [], KEYS['Bob'][0]) == []
+
+
+# Payload is encrypted once, every recipient unwraps its content key with its own key
+def test_multi_recipient():
+    recipients = {name: KEYS[name][1] for name in ('Bob', 'Clark')}
+    payload, wraps = signcryption_multi(CURVE, 'hello all', 'Alice', recipients, KEYS['Alice'][0])
+    assert set(wraps) == set(recipients)
+    for name, wrap in wraps.items():
+        assert unsigncryption_multi(CURVE, payload, wrap, 'Alice', name, KEYS['Alice'][1], KEYS[name][0]) == \
+            'hello all'
+
+    other_payload, _ = signcryption_multi(CURVE, 'hello all', 'Alice', recipients, KEYS['Alice'][0])
+    assert unsigncryption_multi(CURVE, other_payload, wraps['Bob'], 'Alice', 'Bob', KEYS['Alice'][1],
+                                KEYS['Bob'][0]) is None
+    R, C, s = wraps['Bob']
+    assert unsigncryption_multi(CURVE, payload, (R, C, (s + 1) % CURVE.order), 'Alice', 'Bob', KEYS['Alice'][1],
+                                KEYS['Bob'][0]) is None
+    assert _rejected(unsigncryption_multi, CURVE, payload, wraps['Clark'], 'Alice', 'Bob', KEYS['Alice'][1],
+                     KEYS['Bob'][0])
+
+
+def _stream(chunks, header: bytes = b'notes.txt'):
+    signcrypter = StreamSigncrypter(CURVE, 'Alice', {name: KEYS[name][1] for name in ('Bob', 'Clark')},
+                                    KEYS['Alice'][0], header)
+    return signcrypter.start(), [signcrypter.chunk(data) for data in chunks], signcrypter.finish()
+
+
+def _receiver(wrap, recv_id: str = 'Bob', header: bytes = b'notes.txt') -> StreamUnsigncrypter:
+    return StreamUnsigncrypter(CURVE, wrap, 'Alice', recv_id, KEYS['Alice'][1], KEYS[recv_id][0], header)
+
+
+def test_stream():
+    data = [b'x' * 5000, b'', b'tail']
+    wraps, chunks, signatures = _stream(data)
+    for name in ('Bob', 'Clark'):
+        receiver = _receiver(wraps[name], name)
+        assert [receiver.chunk(chunk) for chunk in chunks] == data
+        receiver.finish(signatures[name])
+    wraps, _, signatures = _stream([])
+    _receiver(wraps['Bob']).finish(signatures['Bob'])
+
+
+# Every change of stream is detected, at the latest by finish()
+def test_stream_rejects_modified():
+    wraps, chunks, signatures = _stream([b'0', b'1', b'2'])
+    receiver = _receiver(wraps['Bob'])
+    for chunk in chunks[:2]:
+        receiver.chunk(chunk)
+    with pytest.raises(ValueError):  # Truncated
+        receiver.finish(signatures['Bob'])
+    with pytest.raises(ValueError):  # Reordered
+        _receiver(wraps['Bob']).chunk(chunks[1])
+    with pytest.raises(ValueError):  # Modified chunk
+        _receiver(wraps['Bob']).chunk(bytes([chunks[0][0] ^ 1]) + chunks[0][1:])
+    with pytest.raises(ValueError):  # Chunk of other stream with the same header
+        _receiver(wraps['Bob']).chunk(_stream([b'0'])[1][0])
+    with pytest.raises(ValueError):  # Other header
+        _receiver(wraps['Bob'], header=b'other.txt')
+    with pytest.raises(ValueError):  # Wrap of other recipient
+        _receiver(wraps['Clark'])
+
+    receiver = _receiver(wraps['Bob'])
+    for chunk in chunks:
+        receiver.chunk(chunk)
+    with pytest.raises(ValueError):  # Signature of other recipient
+        receiver.finish(signatures['Clark'])
+    receiver.finish(signatures['Bob'])
@@ -0,0 +1,65 @@
+"""
+Checks of SQLite user/group store. Run: python -m pytest -q src
+"""
+import json
+import os
+
+import pytest
+
+from ecmath import convert_point
+from server_structs import ServerDatabase
+from storage import SqliteDatabase, connect, import_json, upsert_users
+
+JSON_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'server_db.json')
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'server.db')
+    assert import_json(JSON_DB, path) == (4, 5)
+    return path
+
+
+# Same answers as the JSON database, keys are stored compressed
+def test_import(db_path):
+    db, json_db = SqliteDatabase(db_path), ServerDatabase(JSON_DB)
+    assert db.curve.name == json_db.curve.name
+    for group_name in ('gr1', 'gr2', 'gr3'):
+        assert sorted(db.get_group_members(group_name)) == sorted(json_db.get_group_members(group_name))
+        for username in ('Alice', 'Bob', 'Clark', 'Daniel', 'Mallory'):
+            assert db.check_access_to_group(username, group_name) == \
+                json_db.check_access_to_group(username, group_name)
+    for username in ('Alice', 'Daniel'):
+        assert db.get_public_key(username) == convert_point(db.curve, json_db.get_public_key(username), True)
+    assert db.get_public_key('Mallory') is None
+
+
+# Changes made by other connection (CLI) are seen by the next lookup, cached answers are used until then
+def test_changes_invalidate_cache(db_path):
+    db = SqliteDatabase(db_path)
+    members = db.get_group_members('gr2')
+    assert db.get_group_members('gr2') is members
+
+    conn = connect(db_path)
+    upsert_users(conn, db.curve, [('Eve', db.get_public_key('Alice'))], 'gr2')
+    assert sorted(db.get_group_members('gr2')) == ['Clark', 'Daniel', 'Eve']
+    assert db.check_access_to_group('Eve', 'gr2') and db.get_public_key('Eve') == db.get_public_key('Alice')
+
+    assert db.check_access_to_group('Clark', 'gr1')
+    with conn:
+        conn.execute("DELETE FROM users WHERE username = 'Clark'")  # Memberships are deleted too
+    assert not db.check_access_to_group('Clark', 'gr1') and sorted(db.get_group_members('gr1')) == ['Alice', 'Bob']
+    conn.close()
+
+
+def test_import_rejects_unknown_member(db_path, tmp_path):
+    with open(JSON_DB, 'r') as fp:
+        data = json.load(fp)
+    data['users'] = data['users'][:1]
+    data['groups'] = [{'group_name': 'gr3', 'members': ['Alice', 'Mallory']}]
+    json_path = str(tmp_path / 'bad.json')
+    with open(json_path, 'w') as fp:
+        json.dump(data, fp)
+    with pytest.raises(ValueError, match="Mallory"):
+        import_json(json_path, db_path)
+    assert SqliteDatabase(db_path).get_group_members('gr3') == []